@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the motion post-processing pipeline. Run on the Pi against some recorded segments, e.g.
+    python3 benchmark_motion.py decode /home/piuser/videos/buffer_old
+"""
+import os
+import sys
+import time
+import glob
+import resource
+import argparse
+import tempfile
+import json
+import subprocess
+import cv2
+import numpy as np
+
+import motion_postprocess_lib as lib
+from segment_decoder import SegmentDecoder, DECODE_BACKENDS, backend_available
+from motion_scoring import DETECTORS, make_detector, load_region, motion_from_ratios
+
+
+def extract_sample_frames_jpeg(input_path, tmp_dir):
+    """The old extraction path (ffmpeg → jpeg files → cv2.imread), kept here to compare against."""
+    vf_filter = f"scale={lib.LQ_WIDTH}:{lib.LQ_HEIGHT},format=yuv420p"
+    output_pattern = os.path.join(tmp_dir, "frame_%04d.jpg")
+    cmd = [
+        "ffmpeg", "-hide_banner",
+        "-loglevel", "warning",
+        "-skip_frame", "nokey",
+        "-i", input_path,
+        "-vf", vf_filter,
+        "-fps_mode", "vfr",
+        "-q:v", "4",
+        "-y", output_pattern
+    ]
+    subprocess.run(cmd, check=True)
+
+    frames = []
+    for file in sorted(os.listdir(tmp_dir)):
+        path = os.path.join(tmp_dir, file)
+        frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if frame is not None:
+            frames.append(frame)
+        os.remove(path)
+    return frames
+
+
+def score_frames_loop(frames, pixel_thresh):
+    """The old per-pair python loop from detect_motion, kept here to compare against."""
+    frames = [cv2.GaussianBlur(f, (7,7), 0) for f in frames]
+    total_pixels = frames[0].size
+    ratios = []
+    for a, b in zip(frames, frames[1:]):
+        diff = cv2.absdiff(a, b)
+        motion_mask = diff > pixel_thresh
+        ratios.append(np.count_nonzero(motion_mask) / total_pixels)
+    return ratios
+
+
+def find_segments(paths, limit):
+    segments = []
+    for path in paths:
+        if os.path.isdir(path):
+            segments.extend(sorted(glob.glob(os.path.join(path, "*.h264"))))
+        else:
+            segments.append(path)
+    return segments[:limit] if limit else segments
+
+
+def cpu_seconds():
+    """User+system CPU of this process and its (waited-for) children, e.g. ffmpeg."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def pid_cpu_seconds(pid):
+    """User+system CPU of a still-running process (e.g. the persistent decoder's ffmpeg), from /proc."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def time_extractor(name, extract, segments, running_child=None):
+    """running_child: callable returning the pid of a long-lived child whose CPU should be counted too."""
+    def total_cpu():
+        pid = running_child() if running_child else None
+        return cpu_seconds() + (pid_cpu_seconds(pid) if pid else 0)
+
+    extract(segments[0]) # warm up (and start the persistent decoder)
+    n_frames = 0
+    cpu_start = total_cpu()
+    wall_start = time.perf_counter()
+    for seg in segments:
+        n_frames += len(extract(seg))
+    wall = time.perf_counter() - wall_start
+    cpu = total_cpu() - cpu_start
+    print(f"{name:>16}: {len(segments)} segments, {n_frames} frames, "
+          f"{wall:.2f}s wall, {cpu:.2f}s cpu, "
+          f"{n_frames / wall:.1f} frames/s, {1000 * cpu / max(n_frames, 1):.1f} ms cpu/frame")
+
+
+def bench_decode(args):
+    segments = find_segments(args.paths, args.limit)
+    if not segments:
+        sys.exit("no .h264 segments found")
+
+    backends = args.backends or [b for b in DECODE_BACKENDS if b != "stub" and backend_available(b)]
+    decoders = {backend: SegmentDecoder(lib.LQ_WIDTH, lib.LQ_HEIGHT, backend=backend) for backend in backends}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for _ in range(args.repeat):
+            time_extractor("jpeg", lambda seg: extract_sample_frames_jpeg(seg, tmp_dir), segments)
+            for backend, decoder in decoders.items():
+                # same API and output for every backend, so the numbers are like for like
+                time_extractor(f"{backend} pipe", lambda seg: lib.extract_sample_frames(seg, backend=backend), segments)
+                time_extractor(f"{backend} worker", decoder.extract, segments,
+                               running_child=lambda: decoder.process.pid if decoder.process else None)
+                if decoder.backend != backend:
+                    print(f"  ({backend} worker fell back to {decoder.backend} partway)")
+    for decoder in decoders.values():
+        decoder.close()
+
+
+def load_segment_frames(args):
+    """Decoded keyframes for each segment, or random frames (7 per segment, like a 20s segment) with --synthetic."""
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, (7, lib.LQ_HEIGHT, lib.LQ_WIDTH), dtype=np.uint8) for _ in range(args.synthetic)]
+    segments = find_segments(args.paths, args.limit)
+    if not segments:
+        sys.exit("no .h264 segments found (or pass --synthetic N)")
+    return [lib.extract_sample_frames(seg) for seg in segments]
+
+
+def bench_score(args):
+    all_frames = [frames for frames in load_segment_frames(args) if len(frames) >= 2]
+    for frames in all_frames:
+        assert np.allclose(score_frames_loop(frames, lib.PIXEL_THRESHOLD), lib.score_frames(frames)), "batched ratios differ"
+
+    for name, score in [("loop", score_frames_loop), ("batched", lambda f, t: lib.score_frames(f, t))]:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(args.repeat):
+            for frames in all_frames:
+                score(frames, lib.PIXEL_THRESHOLD)
+        n = args.repeat * len(all_frames)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        print(f"{name:>8}: {n} segments, {1000 * wall / n:.3f} ms wall/segment, {1000 * cpu / n:.3f} ms cpu/segment")
+
+
+def bench_workers(args):
+    """Backlog drain rate (decode + score, in recording order) for each worker count."""
+    segments = find_segments(args.paths, args.limit)
+    if not segments:
+        sys.exit("no .h264 segments found")
+
+    for workers in args.workers:
+        analyzer = lib.SegmentAnalyzer(workers)
+        analyzer.result(analyzer.submit(segments[0])) # warm up (starts the pool/decoders)
+        wall_start = time.perf_counter()
+        tickets = [analyzer.submit(seg) for seg in segments]
+        for ticket in tickets:
+            analyzer.result(ticket)
+        wall = time.perf_counter() - wall_start
+        analyzer.close()
+        print(f"{workers} workers: {len(segments)} segments in {wall:.2f}s, {len(segments) / wall:.2f} segments/s "
+              f"({len(segments) * 20 / wall:.0f}x real time for 20s segments)")
+
+
+def load_labels(path):
+    """{segment file name: whether it has motion} from a JSON file, or {} without one."""
+    if not path:
+        return {}
+    with open(path) as f:
+        return {os.path.basename(name): bool(motion) for name, motion in json.load(f).items()}
+
+
+def synthetic_footage(n, seed=0, motion_every=4):
+    """
+    n labeled segments of a fake scene, 7 keyframes each: sensor noise, a slow brightness drift, an occasional
+    global lighting jump (the false positives frame differencing is prone to), and a block moving across
+    every motion_every-th segment. Returns [(name, frames, has_motion)].
+    """
+    rng = np.random.default_rng(seed)
+    scene = cv2.GaussianBlur(rng.integers(40, 200, (lib.LQ_HEIGHT, lib.LQ_WIDTH), dtype=np.uint8), (5, 5), 0).astype(np.int16)
+    footage = []
+    drift = lighting = 0
+    for i in range(n):
+        motion = i % motion_every == motion_every - 1
+        frames = []
+        for k in range(7):
+            drift = 0.8 * drift + rng.normal(0, 2)
+            if rng.random() < 0.05: # a cloud comes or goes, or auto-exposure steps
+                lighting = rng.choice([-10, 0, 10])
+            frame = scene + int(drift + lighting) + rng.integers(-6, 7, scene.shape)
+            if motion:
+                x = 10 + k * 20
+                frame[30:60, x:x + 15] = 230
+            frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+        footage.append((f"synthetic_{i:06d}.h264", np.array(frames), motion))
+    return footage
+
+
+def bench_detect(args):
+    """Replay footage through each detector in recording order: CPU per frame, and false positives against labels."""
+    if args.synthetic:
+        footage = synthetic_footage(args.synthetic)
+    else:
+        segments = find_segments(args.paths, args.limit)
+        if not segments:
+            sys.exit("no .h264 segments found (or pass --synthetic N)")
+        labels = load_labels(args.labels)
+        footage = [(os.path.basename(seg), lib.extract_sample_frames(seg), labels.get(os.path.basename(seg)))
+                   for seg in segments]
+
+    tile_grid = tuple(int(n) for n in args.tiles.split("x")) if args.tiles else None
+    region = load_region(args.roi, (lib.LQ_HEIGHT, lib.LQ_WIDTH), tile_grid)
+    if args.roi and region is None:
+        sys.exit(f"no ROI mask at {args.roi}")
+    for name in args.detectors:
+        detector = make_detector(name, args.pixel_thresh, region=region)
+        n_frames = 0
+        verdicts = []
+        cpu_start = time.process_time()
+        for seg, frames, label in footage:
+            ratios = detector.ratios(frames) if len(frames) else []
+            n_frames += len(frames)
+            verdicts.append((len(ratios) > 0 and bool(motion_from_ratios(ratios, args.change_ratio)), label))
+        cpu = time.process_time() - cpu_start
+
+        flagged = sum(motion for motion, _ in verdicts)
+        line = (f"{name:>10}: {len(footage)} segments, {1000 * cpu / max(n_frames, 1):.3f} ms cpu/frame, "
+                f"{flagged} flagged")
+        labeled = [(motion, label) for motion, label in verdicts if label is not None]
+        if labeled:
+            still = [motion for motion, label in labeled if not label]
+            moving = [motion for motion, label in labeled if label]
+            line += (f", false positives {sum(still)}/{len(still)} ({sum(still) / max(len(still), 1):.1%} of still segments)"
+                     f", missed {len(moving) - sum(moving)}/{len(moving)}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    decode = sub.add_parser("decode", help="keyframe extraction: jpeg temp files vs raw pipe vs persistent decoder, per backend")
+    decode.add_argument("paths", nargs="+", help=".h264 segments or directories of them")
+    decode.add_argument("--limit", type=int, default=0, help="only use the first N segments")
+    decode.add_argument("--repeat", type=int, default=1)
+    decode.add_argument("--backends", nargs="+", choices=DECODE_BACKENDS,
+                        help="decode backends to compare (default: every one available here)")
+    decode.set_defaults(func=bench_decode)
+
+    score = sub.add_parser("score", help="motion scoring: per-pair loop vs batched")
+    score.add_argument("paths", nargs="*", help=".h264 segments or directories of them")
+    score.add_argument("--synthetic", type=int, default=0, help="use N segments of random frames instead")
+    score.add_argument("--limit", type=int, default=0, help="only use the first N segments")
+    score.add_argument("--repeat", type=int, default=100)
+    score.set_defaults(func=bench_score)
+
+    workers = sub.add_parser("workers", help="backlog drain rate vs analysis worker count")
+    workers.add_argument("paths", nargs="+", help=".h264 segments or directories of them")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 3, 4])
+    workers.add_argument("--limit", type=int, default=0, help="only use the first N segments")
+    workers.set_defaults(func=bench_workers)
+
+    detect = sub.add_parser("detect", help="detector replay: cpu per frame and false-positive rate")
+    detect.add_argument("paths", nargs="*", help=".h264 segments or directories of them, in recording order")
+    detect.add_argument("--labels", help='JSON file of {"segment_000123.h264": true/false} (has motion)')
+    detect.add_argument("--synthetic", type=int, default=0, help="use N labeled segments of a fake scene instead")
+    detect.add_argument("--detectors", nargs="+", default=sorted(DETECTORS), choices=sorted(DETECTORS))
+    detect.add_argument("--pixel-thresh", type=int, default=lib.PIXEL_THRESHOLD)
+    detect.add_argument("--change-ratio", type=float, default=lib.CHANGE_RATIO)
+    detect.add_argument("--limit", type=int, default=0, help="only use the first N segments")
+    detect.add_argument("--roi", help="ROI mask image (white = watch) to score with")
+    detect.add_argument("--tiles", help="score a ROWSxCOLS tile grid, e.g. 3x4, triggering on the busiest tile")
+    detect.set_defaults(func=bench_detect)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,29 @@ import os
 import signal
 import logging
 import time
+import threading
+import numpy as np
+import metrics
 
 LOG_FILE = "/home/piuser/videos/logs/capture.log"
+METRICS_PATH = "/home/piuser/videos/metrics/capture.prom" # Prometheus text format, for node_exporter's textfile collector
 
 HQ_WIDTH = "1920"
 HQ_HEIGHT = "1080"
 HQ_FRAMERATE = 30
 
-_I_FRAME_EVERY = 3
+_I_FRAME_EVERY = 3 # keep in sync with motion_postprocess_lib.KEYFRAME_SECS
 HQ_INTRA = HQ_FRAMERATE * _I_FRAME_EVERY # record an I-frame every _I_FRAME_EVERY seconds, used for fast decoding of frames for ffmpeg to later extract. (the only way I could get speedup > 1) 
 _SECS_PER_SEGMENT = 20 # N seconds
 HQ_SEGMENT = str(_SECS_PER_SEGMENT*1000) # in milliseconds
 
 INITIAL_PAUSE_SECS = 10 # (wait to clear the buffer dir, start up everything, etc. )
 
+# Live motion scoring on the camera's low-res stream (capture_to_buffer(..., live_motion=True), needs python3-picamera2)
+LORES_WIDTH, LORES_HEIGHT = 160, 90 # same size the post-processor decodes keyframes at
+LIVE_SAMPLE_SECS = _I_FRAME_EVERY # score one lores frame per keyframe interval, so ratios mean the same as post-hoc ones
+LIVE_PIXEL_THRESHOLD = 10 # keep in sync with motion_postprocess_lib.PIXEL_THRESHOLD
+
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
 
@@ -28,7 +37,21 @@ logging.basicConfig(level=logging.DEBUG,
                         logging.StreamHandler()  # ensures output appears in journalctl/systemd logs
                     ])
 
-def capture_to_buffer(buffer_dir):
+_started = metrics.gauge("capture_started_timestamp_seconds", "When the current capture run started")
+_segments_total = metrics.counter("capture_segments_total", "Segments closed (live-motion capture only)")
+_bytes_total = metrics.counter("capture_bytes_total", "Encoded video bytes written (live-motion capture only)")
+_live_score_secs = metrics.histogram("capture_live_score_seconds", "Time to score one lores frame pair",
+                                     buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+def capture_to_buffer(buffer_dir, live_motion=False, metrics_path=METRICS_PATH, preview_port=None):
+    """
+    Record segments into buffer_dir. preview_port serves the stream live as it's encoded (see live_preview);
+    that needs the picamera2 recorder, so it implies live_motion.
+    """
+    metrics.expose(metrics_path)
+    _started.set(time.time())
+    if live_motion or preview_port:
+        return capture_to_buffer_live(buffer_dir, preview_port=preview_port)
     logging.info(f"Pausing for {INITIAL_PAUSE_SECS} secs to let things set up")
     time.sleep(INITIAL_PAUSE_SECS)
     logging.info("Starting capture loop...")
@@ -63,3 +86,141 @@ def capture_to_buffer(buffer_dir):
     signal.signal(signal.SIGINT, shutdown)
     process.wait()
 
+
+
+class LiveMotionScorer:
+    """Collects change ratios between consecutive lores samples, per segment."""
+    def __init__(self, pixel_thresh=LIVE_PIXEL_THRESHOLD):
+        from motion_scoring import MotionScorer
+        self.scorer = MotionScorer()
+        self.pixel_thresh = pixel_thresh
+        self.pair = np.empty((2, LORES_HEIGHT, LORES_WIDTH), dtype=np.uint8)
+        self.have_previous = False
+        self.ratios = []
+        self.lock = threading.Lock()
+
+    def add_frame(self, gray):
+        self.pair[1] = gray
+        if self.have_previous:
+            with _live_score_secs.time():
+                ratio = float(self.scorer.score(self.pair, self.pixel_thresh)[0])
+            with self.lock:
+                self.ratios.append(ratio)
+        self.pair[0] = self.pair[1]
+        self.have_previous = True
+
+    def take_ratios(self):
+        with self.lock:
+            ratios, self.ratios = self.ratios, []
+        return ratios
+
+
+def _segment_output_class():
+    from picamera2.outputs import Output
+
+    class SegmentOutput(Output):
+        """
+        Splits the encoded h264 into segment_%06d.h264 files like rpicam-vid --segment does,
+        starting a new file on the first keyframe after segment_ms.
+        """
+        def __init__(self, segment_pattern, segment_ms, on_segment_closed, preview=None):
+            super().__init__()
+            self.preview = preview # a LivePreview to pass every frame on to, or None
+            self.segment_pattern = segment_pattern
+            self.segment_us = segment_ms * 1000
+            self.on_segment_closed = on_segment_closed
+            self.segment_index = 0
+            self.segment_start = None
+            self.file = None
+            self.path = None
+
+        def _close_segment(self):
+            if self.file is None:
+                return
+            self.on_segment_closed(self.path)
+            self.file.close()
+            self.file = None
+
+        def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+            if audio:
+                return
+            if self.preview is not None:
+                self.preview.publish(frame, keyframe)
+            if keyframe and (self.file is None or timestamp - self.segment_start >= self.segment_us):
+                self._close_segment()
+                self.path = self.segment_pattern % self.segment_index
+                self.file = open(self.path, "wb")
+                self.segment_index += 1
+                self.segment_start = timestamp
+            if self.file is not None:
+                self.file.write(frame)
+                _bytes_total.inc(len(frame))
+
+        def stop(self):
+            super().stop()
+            self._close_segment()
+
+    return SegmentOutput
+
+
+def capture_to_buffer_live(buffer_dir, preview_port=None):
+    """
+    Same segments as capture_to_buffer, but recorded through picamera2 so the camera's tiny lores
+    YUV stream can be scored for motion while recording. Each segment gets a .motion.json sidecar
+    with its ratios as it closes, so the post-processor doesn't need to decode it again.
+    With preview_port, the encoded stream is also served live on that port.
+    """
+    from picamera2 import Picamera2
+    from picamera2.encoders import H264Encoder
+    from motion_scoring import write_motion_sidecar, sample_log
+
+    logging.info(f"Pausing for {INITIAL_PAUSE_SECS} secs to let things set up")
+    time.sleep(INITIAL_PAUSE_SECS)
+    logging.info("Starting live-motion capture loop...")
+    segment_pattern = os.path.join(buffer_dir, "segment_%06d.h264")
+    logging.debug(f"writing the output to {buffer_dir}")
+
+    scorer = LiveMotionScorer()
+
+    def on_segment_closed(path):
+        ratios = scorer.take_ratios()
+        write_motion_sidecar(path, ratios, LIVE_PIXEL_THRESHOLD)
+        _segments_total.inc()
+        if sample_log("live ratios"):
+            logging.debug(f"Closed {os.path.basename(path)} with live ratios {[f'{r:0.3f}' for r in ratios]}")
+
+    picam2 = Picamera2()
+    config = picam2.create_video_configuration(
+        main={"size": (int(HQ_WIDTH), int(HQ_HEIGHT))},
+        lores={"size": (LORES_WIDTH, LORES_HEIGHT), "format": "YUV420"},
+        controls={"FrameRate": HQ_FRAMERATE},
+    )
+    picam2.configure(config)
+    encoder = H264Encoder(iperiod=HQ_INTRA, repeat=True) # repeat=True is rpicam-vid's --inline
+    preview = None
+    if preview_port:
+        from live_preview import LivePreview
+        preview = LivePreview(preview_port)
+        preview.start()
+    output = _segment_output_class()(segment_pattern, int(HQ_SEGMENT), on_segment_closed, preview=preview)
+    picam2.start_recording(encoder, output)
+    logging.info("Started picamera2 recording")
+
+    stop = threading.Event()
+
+    # Handle clean shutdown
+    def shutdown(sig, frame):
+        logging.info("Received stop signal, terminating capture...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    try:
+        while not stop.is_set():
+            yuv = picam2.capture_array("lores")
+            scorer.add_frame(yuv[:LORES_HEIGHT, :LORES_WIDTH]) # the Y plane is the gray frame
+            stop.wait(LIVE_SAMPLE_SECS)
+    finally:
+        picam2.stop_recording()
+        logging.info("Capture stopped cleanly.")
@@ -2,11 +2,13 @@ import os
 from capture_lib import capture_to_buffer
 
 BUFFER_DIR = f"/home/piuser/videos/buffer"
+LIVE_MOTION = False # score motion on the camera's lores stream while recording (needs python3-picamera2)
+PREVIEW_PORT = None # e.g. 8090 to watch the stream live at http://<pi>:8090/live.h264 (also needs python3-picamera2)
 
 os.makedirs(BUFFER_DIR, exist_ok=True)
 
 def main():
-    capture_to_buffer(BUFFER_DIR)
+    capture_to_buffer(BUFFER_DIR, live_motion=LIVE_MOTION, preview_port=PREVIEW_PORT)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
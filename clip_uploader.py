@@ -1,15 +1,24 @@
-import os
 import time
+import json
+import hashlib
 import logging
 import requests
 from pathlib import Path
 from dotenv import load_dotenv
+from file_watcher import FileWatcher
+import metrics
 
 # === CONFIG ===
 WATCH_DIR = "/home/piuser/videos/clips"
-SERVER_URL = "http://192.168.0.61:5002/upload_clip"
+UPLOADS_URL = "http://192.168.0.61:5002/uploads"
+CHUNK_SIZE = 4 * 1024 * 1024  # bytes per PUT, so a dropped connection loses at most this much
+CHUNK_TIMEOUT = 60  # seconds
+CHUNK_RETRIES = 3
 SLEEP_INTERVAL = 2  # seconds
-STABILITY_CHECK_TIME = 5  # seconds to wait to confirm file size unchanged
+RETRY_INTERVAL = 30  # seconds before retrying a failed upload
+CLIP_SUFFIXES = (".mp4", ".h264")  # remuxed clips, or raw appended segments (see motion_postprocess_lib.CLIP_CONTAINER)
+METADATA_SUFFIX = ".meta.json"  # motion intervals written next to each clip, sent along with it
+METRICS_PATH = "/home/piuser/videos/metrics/uploader.prom"  # Prometheus text format, for node_exporter's textfile collector
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,70 +28,130 @@ logging.basicConfig(
 
 load_dotenv()
 
+session = requests.Session()  # keeps the connection to the server alive between chunks and clips
 
-def file_is_stable(file_path: Path) -> bool:
-    """Check if file size stays the same over a short period (not still being written)."""
-    size1 = file_path.stat().st_size
-    time.sleep(STABILITY_CHECK_TIME)
-    size2 = file_path.stat().st_size
-    return size1 == size2
+_uploads_total = metrics.counter("uploader_clips_total", "Clip upload attempts by result (ok, failed, busy)")
+_upload_bytes_total = metrics.counter("uploader_bytes_total", "Clip bytes sent to the server")
+_upload_secs = metrics.histogram("uploader_upload_seconds", "Time to upload one clip, including hashing")
+_pending = metrics.gauge("uploader_pending_clips", "Clips waiting to be (re)tried")
 
 
-def upload_clip(file_path: Path):
-    """Upload a completed clip to the server."""
+class ServerBusy(Exception):
+    """The server's encode queue is full; nothing should be uploaded for retry_after seconds."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"server busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def file_sha256(file_path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def send_chunk(upload_url: str, offset: int, chunk: bytes) -> int:
+    """PUT one chunk, retrying a few times. Returns the server's offset afterwards."""
+    headers = {"Upload-Offset": str(offset), "Chunk-SHA256": hashlib.sha256(chunk).hexdigest()}
+    for attempt in range(CHUNK_RETRIES):
+        try:
+            response = session.put(upload_url, data=chunk, headers=headers, timeout=CHUNK_TIMEOUT)
+            if response.status_code == 409: # we're out of step with the server, carry on from where it is
+                return response.json()["offset"]
+            response.raise_for_status()
+            return response.json()["offset"]
+        except requests.RequestException as e:
+            if attempt == CHUNK_RETRIES - 1:
+                raise
+            logging.warning(f"Chunk at {offset} failed ({e}), retrying")
+            time.sleep(2 ** attempt)
+
+
+def upload_clip(file_path: Path) -> bool:
+    """
+    Upload a completed clip to the server in chunks, resuming from wherever the server's copy got to.
+    Returns whether it was uploaded (and deleted). Raises ServerBusy if the server asks us to back off.
+    """
+    metadata_path = file_path.with_name(file_path.name + METADATA_SUFFIX)
+    start = time.monotonic()
     try:
-        with open(file_path, "rb") as f:
-            files = {"file": (file_path.name, f, "video/mp4")}
-            logging.info(f"Uploading {file_path.name} ...")
-            response = requests.post(SERVER_URL, files=files, timeout=120)
-        if response.status_code == 200:
-            logging.info(f"✅ Uploaded {file_path.name}")
-            file_path.unlink(missing_ok=True)
+        size = file_path.stat().st_size
+        metadata = json.loads(metadata_path.read_text()) if metadata_path.exists() else None
+        response = session.post(UPLOADS_URL, json={
+            "filename": file_path.name,
+            "size": size,
+            "sha256": file_sha256(file_path),
+            "metadata": metadata,
+        }, timeout=CHUNK_TIMEOUT)
+        if response.status_code in (429, 503):
+            retry_after = response.headers.get("Retry-After", "")
+            _uploads_total.inc(result="busy")
+            raise ServerBusy(int(retry_after) if retry_after.isdigit() else RETRY_INTERVAL)
+        response.raise_for_status()
+        upload_id, offset = response.json()["upload_id"], response.json()["offset"]
+        upload_url = f"{UPLOADS_URL}/{upload_id}"
+        if offset:
+            logging.info(f"Resuming {file_path.name} at {offset}/{size} bytes ...")
         else:
-            logging.error(f"❌ Upload failed ({response.status_code}): {response.text}")
+            logging.info(f"Uploading {file_path.name} ...")
+
+        with open(file_path, "rb") as f:
+            while offset < size:
+                f.seek(offset)
+                sent_from = offset
+                offset = send_chunk(upload_url, offset, f.read(CHUNK_SIZE))
+                _upload_bytes_total.inc(max(0, offset - sent_from))
+
+        logging.info(f"✅ Uploaded {file_path.name}")
+        _uploads_total.inc(result="ok")
+        _upload_secs.observe(time.monotonic() - start)
+        file_path.unlink(missing_ok=True)
+        metadata_path.unlink(missing_ok=True)
+        return True
+    except ServerBusy:
+        raise # main() holds off for Retry-After rather than counting it as a failure
+    except requests.HTTPError as e:
+        logging.error(f"❌ Upload failed ({e.response.status_code}): {e.response.text}")
     except Exception as e:
         logging.exception(f"Upload exception: {e}")
+    _uploads_total.inc(result="failed")
+    return False
 
 
 def main():
-    processed_files = set()
-    first_run = True
+    # clips are renamed into WATCH_DIR once complete, so anything the watcher hands out is ready to go
+    watcher = FileWatcher(WATCH_DIR, CLIP_SUFFIXES, poll_interval=SLEEP_INTERVAL)
+    retry_at = {}  # failed uploads -> when to try again
 
     logging.info(f"Watching directory: {WATCH_DIR}")
+    metrics.expose(METRICS_PATH)
 
     while True:
         try:
-            files = sorted(
-                f for f in os.listdir(WATCH_DIR) if f.lower().endswith(".mp4")
-            )
-            files = [f for f in files if f not in processed_files]
-
-            if not files:
-                time.sleep(SLEEP_INTERVAL)
-                continue
-
-            for i, filename in enumerate(files):
-                file_path = Path(WATCH_DIR) / filename
+            timeout = max(0, min(retry_at.values()) - time.time()) if retry_at else None
+            files = [Path(f) for f in watcher.next_batch(timeout=timeout)]
+            now = time.time()
+            files += [f for f, t in retry_at.items() if t <= now and f not in files]
 
+            files = sorted(files)
+            for i, file_path in enumerate(files):
                 if not file_path.exists():
+                    retry_at.pop(file_path, None)
                     continue
 
-                # Check stability before uploading
-                if not file_is_stable(file_path):
-                    logging.debug(f"File {file_path.name} still being written, skipping.")
-                    time.sleep(0.1)
-                    continue
-
-                # Upload
-                upload_clip(file_path)
-
-                if not first_run:
-                    processed_files.add(filename)
-
-                time.sleep(0.2)
-
-            first_run = False
-            time.sleep(SLEEP_INTERVAL)
+                try:
+                    uploaded = upload_clip(file_path)
+                except ServerBusy as e:
+                    logging.warning(f"Server is busy, holding {len(files) - i} clips for {e.retry_after}s")
+                    for f in files[i:]:
+                        retry_at[f] = time.time() + e.retry_after
+                    break
+                if uploaded:
+                    retry_at.pop(file_path, None)
+                else:
+                    retry_at[file_path] = time.time() + RETRY_INTERVAL
+            _pending.set(len(retry_at))
 
         except Exception as e:
             logging.exception(f"Main loop error: {e}")
@@ -0,0 +1,156 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+PRUNE_AT = 1000 # re-check which handed-out files still exist once this many are remembered
+
+
+def _inotify_fd(directory):
+    """An inotify fd watching directory for finished files, or None if inotify isn't available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return fd
+    except (OSError, AttributeError) as e:
+        logging.warning(f"inotify unavailable for {directory} ({e}), falling back to polling")
+        return None
+
+
+class FileWatcher:
+    """
+    Hands out files in a directory once they're finished being written, in sorted order.
+    Uses inotify close-write/moved-to events, or polls the directory where inotify isn't available.
+    Files already in the directory at startup are handed out first. suffix can be a tuple of suffixes.
+
+    newest_may_be_open: the newest file may still be being written (e.g. rpicam-vid's current segment),
+    so it's only handed out once it's closed or, when polling, once a newer file shows up.
+    Otherwise, when polling, a file is handed out once its size stays the same between two polls.
+
+    Only handed-out files that still exist are remembered (by name and mtime, so a reused name like a
+    restarted capture's segment_000000.h264 is seen as new), so memory stays bounded by the directory's size.
+    """
+    def __init__(self, directory, suffix, newest_may_be_open=False, poll_interval=2):
+        self.directory = directory
+        self.suffix = suffix
+        self.newest_may_be_open = newest_may_be_open
+        self.poll_interval = poll_interval
+        self.fd = _inotify_fd(directory) # set up before the first scan so nothing closes unseen in between
+        self.handed_out = {} # name -> mtime when handed out
+        self.pending = set()
+        self.sizes = {} # polling only: last seen size of files not yet handed out
+        self._scan(initial=True)
+
+    def _listdir(self):
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(self.suffix))
+
+    def _mtime(self, name):
+        try:
+            return os.stat(os.path.join(self.directory, name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_new(self, name):
+        return name not in self.handed_out or self.handed_out[name] != self._mtime(name)
+
+    def _prune(self, names):
+        names = set(names)
+        self.handed_out = {n: m for n, m in self.handed_out.items() if n in names}
+
+    def _scan(self, initial=False):
+        names = self._listdir()
+        self._prune(names)
+        candidates = [n for n in names if n not in self.pending and self._is_new(n)]
+        if self.newest_may_be_open and names and names[-1] in candidates:
+            candidates.remove(names[-1])
+        if self.fd is not None or initial or self.newest_may_be_open:
+            self.pending.update(candidates)
+            return
+        # polling without a "newest" rule: wait for the size to settle
+        sizes = {}
+        for name in candidates:
+            try:
+                sizes[name] = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            if self.sizes.get(name) == sizes[name]:
+                self.pending.add(name)
+                del sizes[name]
+        self.sizes = sizes
+
+    def _read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logging.warning(f"inotify queue overflowed for {self.directory}, rescanning")
+                self._scan()
+            elif name.endswith(self.suffix) and self._is_new(name):
+                self.pending.add(name)
+
+    def refresh(self):
+        """Pick up finished files without blocking, so len() is current."""
+        if self.fd is not None:
+            self._read_events(0)
+        else:
+            self._scan()
+
+    def __len__(self):
+        """Number of finished files waiting to be handed out."""
+        return len(self.pending)
+
+    def next_batch(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for finished files and return their paths, sorted.
+        Returns an empty list on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.pending:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return []
+            if self.fd is not None:
+                self._read_events(remaining)
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+                self._scan()
+        names = sorted(self.pending)
+        self.pending.clear()
+        for name in names:
+            self.handed_out[name] = self._mtime(name)
+        if len(self.handed_out) > PRUNE_AT:
+            self._prune(self._listdir())
+        return [os.path.join(self.directory, name) for name in names]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
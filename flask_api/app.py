@@ -1,14 +1,18 @@
-from flask import Flask, request, jsonify
-import os, subprocess, shutil, logging
-import requests
+from flask import Flask, Request, Response, request, jsonify, g
+import os, subprocess, logging, time
 from dotenv import load_dotenv
 from datetime import datetime
 import pytz
-import uuid
-import threading
-from zoneinfo import ZoneInfo
+import json
+import tempfile
+from resumable_uploads import ResumableUploads, UploadError, stream_to_file, METADATA_SUFFIX
+from encode_queue import EncodeQueue, EncodeWorkers, parse_devices
+from immich_uploader import ImmichUploader
+from fair_share import camera_from_filename, parse_weights
+from metrics_store import MetricsStore
+from clip_groups import ClipGroups
+from encode_policy import choose_encoder, choose_profile, encode_command, ENCODERS
 import re
-import pytz
 
 # Load environment variables
 load_dotenv()
@@ -20,12 +24,55 @@ IMMICH_UPLOAD_URL = str(os.getenv("IMMICH_UPLOAD_URL"))
 
 ENCODED_DIR = "/data/video/encoded"
 INCOMING_DIR = "/data/video/incoming"
+PARTIAL_DIR = "/data/video/partial"
+JOBS_DB = "/data/video/jobs.sqlite"
+
+# VAAPI render devices to encode on and how many encodes each can run at once (across all gunicorn workers)
+ENCODE_DEVICES = parse_devices(os.getenv("ENCODE_DEVICES", "/dev/dri/renderD129:1"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50")) # past this, uploads get a 503 with Retry-After
+JOB_RETENTION_SECS = 7 * 24 * 60 * 60
+H264_FRAMERATE = os.getenv("H264_FRAMERATE", "30") # raw .h264 clips carry no timestamps; keep in sync with capture_lib.HQ_FRAMERATE
+IMMICH_CONCURRENCY = int(os.getenv("IMMICH_CONCURRENCY", "4")) # uploads to Immich at once, across all gunicorn workers
+# cameras take turns at the encoder and Immich uploads; "devIdabc:2,devIddef:0.5" gives some a bigger or smaller share (default 1)
+CAMERA_WEIGHTS = parse_weights(os.getenv("CAMERA_WEIGHTS", ""))
+MAX_QUEUED_PER_CAMERA = int(os.getenv("MAX_QUEUED_PER_CAMERA", "20")) # past this, that camera's uploads get a 429
+ENCODE_SCHEDULING = os.getenv("ENCODE_SCHEDULING", "fair") # or "fifo"
+# "auto" uses av1_vaapi where the device exists, else software SVT-AV1/libaom, else a plain remux (see encode_policy)
+ENCODER = os.getenv("ENCODER", "auto")
+# "adaptive" picks a profile per clip from its motion and the queue backlog; or name one of encode_policy.PROFILES
+ENCODE_PROFILE = os.getenv("ENCODE_PROFILE", "adaptive")
+# join a long motion event's partial clips and its final one into one clip before encoding (see clip_groups)
+MERGE_MOTION_GROUPS = os.getenv("MERGE_MOTION_GROUPS", "1") == "1"
+CLIP_GROUP_HOLD_SECS = int(os.getenv("CLIP_GROUP_HOLD_SECS", "600")) # how long to wait for the rest of an event
 
 os.makedirs(INCOMING_DIR, exist_ok=True)
 os.makedirs(ENCODED_DIR, exist_ok=True)
 
+resumable_uploads = ResumableUploads(PARTIAL_DIR, INCOMING_DIR)
+encode_queue = EncodeQueue(JOBS_DB, ENCODE_DEVICES, MAX_QUEUED_JOBS, camera_weights=CAMERA_WEIGHTS,
+                           max_queued_per_camera=MAX_QUEUED_PER_CAMERA, scheduling=ENCODE_SCHEDULING)
+encode_queue.prune(JOB_RETENTION_SECS)
+
+# shared by all gunicorn workers through JOBS_DB, like the queues; served at GET /metrics
+metrics = MetricsStore(JOBS_DB)
+metrics.counter("ingest_clips_total", "Clips accepted for encoding, by camera")
+metrics.counter("ingest_bytes_total", "Bytes of clips accepted for encoding, by camera")
+metrics.counter("encodes_total", "Encode attempts by device, encoder, profile and result (ok, failed)")
+metrics.histogram("encode_seconds", "Time to encode one clip, by device and encoder")
+metrics.histogram("http_request_seconds", "Request handling time, by endpoint and status")
+
+class IngestRequest(Request):
+    """
+    Multipart file parts go straight into a temp file in INCOMING_DIR rather than werkzeug's default
+    spool (memory, then /tmp), so upload_clip can rename the part into place instead of copying it.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(dir=INCOMING_DIR, prefix=".upload-", suffix=".part")
+
+
 # Flask app setup
 app = Flask(__name__)
+app.request_class = IngestRequest
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # increase if needed, currently 2 GB
 
 # Setup logging
@@ -39,27 +86,15 @@ logging.basicConfig(
 )
 
 
-def encode_in_background_av1(input_path, av1_output_path):
-    """Run ffmpeg AV1 NVENC encode asynchronously."""
-    logging.info("Running background encode now")
-    print("Converting", input_path, "to", av1_output_path)
+def encode_in_background_av1(input_path, av1_output_path, device=None, profile="standard", encoder=None):
+    """Run the ffmpeg AV1 encode of input_path with the given encode_policy profile and encoder."""
+    device = device or next(iter(ENCODE_DEVICES))
+    encoder = encoder or choose_encoder(ENCODER, device)
+    logging.info(f"Encoding {os.path.basename(input_path)} with {encoder}, {profile} profile")
     assert not os.path.exists(av1_output_path)
 
     try:
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-hwaccel", "vaapi",
-            "-hwaccel_device", "/dev/dri/renderD129",
-            "-i", input_path,
-            "-vf", "hqdn3d=3:3:6:6,format=nv12,hwupload",
-            "-c:v", "av1_vaapi",
-            "-global_quality", "30", # Found through testing to be a as low as I could reasonably go without loosing too much quality
-            "-low_power", "0",
-            "-profile:v", "0",
-            "-c:a", "copy",
-            av1_output_path
-        ]
+        cmd = encode_command(input_path, av1_output_path, profile, encoder, device=device, framerate=H264_FRAMERATE)
 
         result = subprocess.run(
             cmd,
@@ -74,12 +109,21 @@ def encode_in_background_av1(input_path, av1_output_path):
         logging.error(f"[ERROR] FFmpeg failed for {input_path}")
         logging.error(f"Return code: {e.returncode}")
         logging.error("--- FFmpeg stdout ---" + e.stdout + "--- FFmpeg stderr ---" + e.stderr)
+        return False
+    except OSError as e:
+        # no ffmpeg, or the render device is missing: fail like a bad encode, so the next encoder down is tried
+        logging.error(f"[ERROR] Couldn't run FFmpeg for {input_path}: {e}")
+        return False
 
 
 def get_time_from_filename(filename):
     tz = pytz.timezone(os.getenv("TIMEZONE", "America/Denver"))
     # Extract the first datetime-like part: YYYYMMDD_HHMMSS
     m = re.search(r"(\d{8})-(\d{6})", filename)
+    if m is None:
+        # older clients put "None" in the filename when they couldn't get the time
+        logging.warning(f"No timestamp in {filename}, using the current time")
+        return datetime.now(tz).isoformat()
     date_part, time_part = m.group(1), m.group(2)
 
     # Parse into a datetime
@@ -91,7 +135,7 @@ def get_time_from_filename(filename):
 def get_video_info(video_filename):
     # output_file_name = f"{DEVICE_ID}_{timestampstr}_{clip_id}_{additional_note}_{motion_group_id}.mp4"
     # Save incoming file
-    base_name = os.path.basename(video_filename).replace(".mp4","")
+    base_name = os.path.splitext(os.path.basename(video_filename))[0]
     parts = base_name.split("_")
     device_id = parts[0]
     timestamp_str = parts[1]
@@ -103,48 +147,218 @@ def get_video_info(video_filename):
     return device_id, timestamp_str, timestamp_iso, clip_id, additional_note, motion_group_id
 
 
-def encode_and_upload(video_filename):
+def read_clip_metadata(video_filename):
+    """The metadata the camera sent with a clip ({"duration", "motion_intervals": [[start, end], ...]}), or None."""
+    try:
+        with open(os.path.join(INCOMING_DIR, video_filename + METADATA_SUFFIX)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def encode_and_upload(video_filename, encode_device=None):
     incoming_filepath = os.path.join(INCOMING_DIR, video_filename)
+    metadata = read_clip_metadata(video_filename)
+    if metadata:
+        motion_secs = sum(end - start for start, end in metadata.get("motion_intervals", []))
+        logging.info(f"{video_filename}: {motion_secs:.1f}s of motion in {metadata.get('duration')}s")
 
-    av1_video_filename = video_filename.replace(".mp4", ".mkv")
+    av1_video_filename = os.path.splitext(video_filename)[0] + ".mkv"
     output_path = os.path.join(ENCODED_DIR, av1_video_filename)
     logging.info(f"Encoding to: {output_path}")
-
-    encode_success = encode_in_background_av1(incoming_filepath, output_path)
+    if os.path.exists(output_path):
+        os.remove(output_path) # left over from an encode that was interrupted
+
+    parts = os.path.splitext(video_filename)[0].split("_")
+    note = parts[3] if len(parts) > 3 else None
+    profile = ENCODE_PROFILE if ENCODE_PROFILE != "adaptive" else \
+        choose_profile(metadata, note, encode_queue.depth(), MAX_QUEUED_JOBS)
+    device = encode_device or next(iter(ENCODE_DEVICES))
+    encoder = choose_encoder(ENCODER, device)
+    with metrics.time("encode_seconds", device=device, encoder=encoder):
+        encode_success = encode_in_background_av1(incoming_filepath, output_path, device=device, profile=profile, encoder=encoder)
+    if not encode_success and encoder != "copy":
+        # a hardware or driver failure shouldn't lose the clip: try the next encoder down (at worst a remux)
+        fallback = choose_encoder(ENCODERS[ENCODERS.index(encoder) + 1])
+        logging.warning(f"Encoding {video_filename} with {encoder} failed, retrying with {fallback}")
+        metrics.inc("encodes_total", device=device, encoder=encoder, profile=profile, result="failed")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        encoder = fallback # what the metrics below are recorded against: the encoder that made the output
+        with metrics.time("encode_seconds", device=device, encoder=encoder):
+            encode_success = encode_in_background_av1(incoming_filepath, output_path, device=device, profile=profile, encoder=encoder)
+    metrics.inc("encodes_total", device=device, encoder=encoder, profile=profile, result="ok" if encode_success else "failed")
+    if not encode_success:
+        raise RuntimeError(f"Encoding {video_filename} failed")
     
     upload_to_immich(av1_video_filename)
 
 
+def immich_asset_fields(video_filename):
+    device_id, timestamp_str, timestamp_iso, clip_id, additional_note, motion_group_id = get_video_info(video_filename)
+    return {
+        'deviceId': device_id,
+        'deviceAssetId': f"{clip_id}-{additional_note}-{motion_group_id}",
+        'fileCreatedAt': timestamp_iso,
+        'fileModifiedAt': timestamp_iso
+    }
+
+
 def upload_to_immich(video_filename):
     logging.info(f"Uploading {video_filename} to immich")
+    immich_uploader.enqueue(video_filename)
+
+
+def queue_for_encoding(video_filename):
+    """Queue a clip that's arrived for encoding, unless it's a piece of a motion event that clip_groups holds on to."""
+    size = os.path.getsize(os.path.join(INCOMING_DIR, video_filename))
+    camera = camera_from_filename(video_filename)
+    metrics.inc("ingest_clips_total", camera=camera)
+    metrics.inc("ingest_bytes_total", size, camera=camera)
+    if MERGE_MOTION_GROUPS and clip_groups.add(video_filename, read_clip_metadata(video_filename)):
+        return
+    enqueue_encode(video_filename)
+
+
+def enqueue_encode(video_filename):
+    encode_queue.enqueue(video_filename, size=os.path.getsize(os.path.join(INCOMING_DIR, video_filename)))
+    encode_workers.notify()
+
+
+def busy_response(video_filename=None):
+    """
+    503 telling the client when to come back if the encode queue is full, or 429 if the clip's camera
+    has used up its share of it (MAX_QUEUED_PER_CAMERA). Otherwise None.
+    """
+    if encode_queue.saturated():
+        retry_after = encode_queue.retry_after()
+        logging.warning(f"Encode queue is full, asking the client to retry in {retry_after}s")
+        response = jsonify({"error": "Encode queue is full", "retry_after": retry_after})
+        response.status_code = 503
+    elif video_filename and encode_queue.camera_saturated(camera_from_filename(video_filename)):
+        camera = camera_from_filename(video_filename)
+        retry_after = encode_queue.retry_after(camera)
+        logging.warning(f"{camera} has {MAX_QUEUED_PER_CAMERA} clips queued, asking it to retry in {retry_after}s")
+        response = jsonify({"error": f"Too many clips queued for {camera}", "retry_after": retry_after})
+        response.status_code = 429
+    else:
+        return None
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    # by endpoint (the route's function) rather than path, so clip names and upload ids don't each get a series
+    if request.endpoint != "metrics_endpoint" and "request_start" in g:
+        metrics.observe("http_request_seconds", time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or "none", status=response.status_code)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus scrape target: counters from every worker, plus queue depths as of now."""
+    queued = {(("camera", camera),): counts.get("queued", 0) for camera, counts in encode_queue.cameras().items()}
+    encode_counts = encode_queue.status()["counts"]
+    immich_counts = immich_uploader.status()["counts"]
+    gauges = [
+        ("encode_queue_jobs", "Encode jobs by state", {(("state", state),): n for state, n in encode_counts.items()}),
+        ("encode_queue_queued", "Queued encode jobs by camera", queued),
+        ("immich_queue_uploads", "Immich uploads by state", {(("state", state),): n for state, n in immich_counts.items()}),
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/jobs", methods=["GET"])
+def jobs_status():
+    return jsonify({**encode_queue.status(), "immich": immich_uploader.status(), "clip_groups": clip_groups.status()}), 200
+
+
+@app.route("/jobs/<filename>", methods=["GET"])
+def job_status(filename):
+    """Where a clip is: its latest encode job, and whether its encoded file is still waiting to go to Immich."""
+    filename = os.path.basename(filename)
+    group = clip_groups.group_of(filename)
+    if group and group["merged_filename"]:
+        filename = group["merged_filename"] # the clip was joined with the rest of its motion event
+    job = encode_queue.job(filename)
+    if job is None and group:
+        return jsonify({"filename": filename, "state": "held", "group": group}), 200
+    if job is None:
+        return jsonify({"error": "No job for that file"}), 404
+    encoded = os.path.splitext(job["filename"])[0] + ".mkv"
+    job["immich_pending"] = os.path.exists(os.path.join(ENCODED_DIR, encoded))
+    return jsonify(job), 200
+
+
+@app.route("/cameras", methods=["GET"])
+def cameras_status():
+    """Per-camera ingest and queue accounting."""
+    cameras = encode_queue.cameras()
+    for camera, counts in immich_uploader.status()["by_camera"].items():
+        cameras.setdefault(camera, {})["immich"] = counts
+    return jsonify(cameras), 200
+
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Start or resume a chunked upload. Body: {"filename", "size", "sha256"}. Returns the offset to send from."""
+    body = request.get_json(silent=True) or {}
+    busy = busy_response(os.path.basename(body.get("filename") or ""))
+    if busy:
+        return busy
+    try:
+        upload_id, offset = resumable_uploads.create(body.get("filename"), body.get("size"), body.get("sha256"),
+                                                     body.get("metadata"))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    logging.info(f"Upload {upload_id[:12]} of {body.get('filename')} at offset {offset}/{body.get('size')}")
+    return jsonify({"upload_id": upload_id, "offset": offset}), 200
 
-    encoded_video_path = os.path.join(ENCODED_DIR, video_filename)
-    
-    device_id, timestamp_str, timestamp_iso, clip_id, additional_note, motion_group_id = get_video_info(video_filename)
 
-    device_asset_id = f"{clip_id}-{additional_note}-{motion_group_id}"
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def get_upload(upload_id):
     try:
-        with open(encoded_video_path, 'rb') as f:
-            headers = {'x-api-key': IMMICH_API_KEY}
-            files = {'assetData': f}
-            data = {
-                'deviceId': device_id,
-                'deviceAssetId': device_asset_id,
-                'fileCreatedAt': timestamp_iso,
-                'fileModifiedAt': timestamp_iso
-            }
-            logging.info(f"Uploading video to Immich with deviceAssetId: {device_asset_id}")
-            response = requests.post(IMMICH_UPLOAD_URL, files=files, data=data, headers=headers)
-
-        logging.info(f"Upload response code: {response.status_code}")
-        os.remove(encoded_video_path)
-    except Exception as e:
-        logging.error("Error during /upload", exc_info=True)
+        return jsonify({"upload_id": upload_id, "offset": resumable_uploads.offset(upload_id)}), 200
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """Append one chunk. Headers: Upload-Offset (where the chunk goes) and optionally Chunk-SHA256."""
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header required"}), 400
+    try:
+        new_offset, complete_path = resumable_uploads.append(upload_id, offset, request.get_data(),
+                                                             request.headers.get("Chunk-SHA256"))
+    except UploadError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), e.status
+
+    if complete_path is None:
+        return jsonify({"offset": new_offset}), 200
+    queue_for_encoding(os.path.basename(complete_path))
+    return jsonify({
+        "offset": new_offset,
+        "status": "saved, ready to encode and upload",
+        "saved_to": complete_path,
+    }), 201
 
 
 @app.route("/upload_clip", methods=["POST"])
 def upload_clip():
     logging.info("Received POST /upload_clip request")
+    busy = busy_response()
+    if busy:
+        return busy
     if "file" not in request.files:
         logging.warning("No file uploaded")
         return jsonify({"error": "No file uploaded"}), 400
@@ -154,13 +368,21 @@ def upload_clip():
         logging.warning("Empty filename")
         return jsonify({"error": "Empty filename"}), 400
 
-    video_filename = file.filename
+    video_filename = os.path.basename(file.filename)
+    busy = busy_response(video_filename) # the camera is only known once the form is read
+    if busy:
+        return busy
     temp_path = os.path.join(INCOMING_DIR, video_filename)
     logging.debug(f"Saving the incoming video to {temp_path}")
-    file.save(temp_path)
+    if getattr(file.stream, "name", None) and os.path.dirname(file.stream.name) == INCOMING_DIR:
+        file.stream.flush()
+        os.link(file.stream.name, temp_path + ".part") # the temp file deletes itself on close, so keep a link
+        os.replace(temp_path + ".part", temp_path)
+    else:
+        file.save(temp_path)
     logging.debug(f"Video saved.")
     
-    threading.Thread(target=encode_and_upload, args=(video_filename,)).start()
+    queue_for_encoding(video_filename)
 
     return jsonify({
         "status": "saved, ready to encode and upload",
@@ -168,11 +390,55 @@ def upload_clip():
     }), 200
 
 
+@app.route("/upload_clip/<filename>", methods=["PUT"])
+def put_clip(filename):
+    """
+    Upload a whole clip as a raw application/octet-stream body. It's streamed to disk in fixed-size blocks,
+    so big clips don't sit in the worker's memory. Optional Content-SHA256 header is checked before it's kept.
+    """
+    video_filename = os.path.basename(filename)
+    if not video_filename:
+        return jsonify({"error": "Empty filename"}), 400
+    busy = busy_response(video_filename)
+    if busy:
+        return busy
+
+    dest_path = os.path.join(INCOMING_DIR, video_filename)
+    logging.debug(f"Streaming the incoming video to {dest_path}")
+    try:
+        size, sha256 = stream_to_file(request.stream, dest_path, request.content_length,
+                                      request.headers.get("Content-SHA256"))
+    except UploadError as e:
+        logging.warning(f"Rejected upload of {video_filename}: {e}")
+        return jsonify({"error": str(e)}), e.status
+    logging.debug(f"Video saved ({size} bytes).")
+
+    queue_for_encoding(video_filename)
+
+    return jsonify({
+        "status": "saved, ready to encode and upload",
+        "saved_to": dest_path,
+        "size": size,
+        "sha256": sha256,
+    }), 201
+
+
 @app.route('/test', methods=['GET'])
 def test_endpoint():
     logging.info("Received GET /test request")
     return "hello world"
 
 
+# every gunicorn worker runs encode and upload threads; the shared queues keep the limits
+immich_uploader = ImmichUploader(JOBS_DB, ENCODED_DIR, IMMICH_UPLOAD_URL, IMMICH_API_KEY, immich_asset_fields,
+                                 concurrency=IMMICH_CONCURRENCY, camera_weights=CAMERA_WEIGHTS, metrics=metrics)
+immich_uploader.start()
+clip_groups = ClipGroups(JOBS_DB, INCOMING_DIR, enqueue_encode, hold_secs=CLIP_GROUP_HOLD_SECS)
+clip_groups.prune(JOB_RETENTION_SECS)
+clip_groups.start()
+encode_workers = EncodeWorkers(encode_queue, encode_and_upload)
+encode_workers.start()
+
+
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0')
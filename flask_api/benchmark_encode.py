@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Encode fps against output size for each encoder and profile in encode_policy, on real clips:
+    python3 benchmark_encode.py clip1.h264 clip2.mp4
+    python3 benchmark_encode.py --encoders av1_vaapi libsvtav1 --profiles standard backlog --device /dev/dri/renderD129 *.h264
+Encoders that aren't available here are skipped. Use it to pick the profiles' quality settings: for each
+profile, how much smaller each encoder makes the clips and how many of them it can keep up with.
+"""
+import os
+import re
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from encode_policy import ENCODERS, PROFILES, encoder_available, encode_command
+
+_FRAME_RE = re.compile(r"frame=\s*(\d+)")
+
+
+def run_encode(clip, encoder, profile, device, framerate, out_dir):
+    """(seconds, frames, output bytes) for one encode, or None if ffmpeg failed."""
+    output_path = os.path.join(out_dir, f"{encoder}-{profile}.mkv")
+    cmd = encode_command(clip, output_path, profile, encoder, device=device, framerate=framerate)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    secs = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"  {encoder}/{profile} failed: {result.stderr.strip().splitlines()[-1:]}")
+        return None
+    frames = _FRAME_RE.findall(result.stderr)
+    size = os.path.getsize(output_path)
+    os.remove(output_path)
+    return secs, int(frames[-1]) if frames else 0, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("clips", nargs="+")
+    parser.add_argument("--encoders", nargs="+", default=list(ENCODERS), choices=ENCODERS)
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument("--device", default="/dev/dri/renderD129", help="VAAPI render device for av1_vaapi")
+    parser.add_argument("--framerate", default="30", help="rate of raw .h264 clips, as the server's H264_FRAMERATE")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON instead of a table")
+    args = parser.parse_args()
+
+    encoders = [e for e in args.encoders if encoder_available(e, args.device)]
+    skipped = sorted(set(args.encoders) - set(encoders))
+    if skipped:
+        print(f"Not available here, skipping: {', '.join(skipped)}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for encoder in encoders:
+            # copy ignores the profile settings, so once is enough
+            for profile in (args.profiles[:1] if encoder == "copy" else args.profiles):
+                secs = frames = out_bytes = in_bytes = 0
+                for clip in args.clips:
+                    result = run_encode(clip, encoder, profile, args.device, args.framerate, out_dir)
+                    if result is None:
+                        break
+                    secs += result[0]
+                    frames += result[1]
+                    out_bytes += result[2]
+                    in_bytes += os.path.getsize(clip)
+                else:
+                    results.append({"encoder": encoder, "profile": "-" if encoder == "copy" else profile,
+                                    "secs": round(secs, 2), "fps": round(frames / secs, 1) if secs else 0,
+                                    "output_mb": round(out_bytes / 1e6, 2), "size_ratio": round(out_bytes / in_bytes, 3)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{len(args.clips)} clips, {sum(os.path.getsize(c) for c in args.clips) / 1e6:.1f} MB in")
+    print(f"{'encoder':>11} {'profile':>9} {'secs':>8} {'fps':>7} {'out MB':>8} {'of input':>8}")
+    for r in results:
+        print(f"{r['encoder']:>11} {r['profile']:>9} {r['secs']:>8.2f} {r['fps']:>7.1f} {r['output_mb']:>8.2f} {r['size_ratio']:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Throughput of the Immich uploader against a local stand-in Immich server, compared with the old
+one-fresh-request-per-asset upload. The stand-in answers like Immich (201 created, 200 duplicate) after
+a configurable latency, and can fail a fraction of requests to exercise the retry queue:
+    python3 benchmark_immich.py --assets 200 --size-kb 2048 --latency 0.05 --concurrency 1 4 8
+    python3 benchmark_immich.py --assets 100 --fail-rate 0.2
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+
+import immich_uploader
+from immich_uploader import ImmichUploader
+
+
+class StandInImmich(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real server
+    disable_nagle_algorithm = True # headers and body go out in separate writes
+    latency = 0.0
+    fail_rate = 0.0
+    seen = set()
+    lock = threading.Lock()
+    connections = set()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.lock:
+            self.connections.add(self.client_address)
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            return self._reply(500, {"message": "stand-in failure"})
+        m = re.search(rb'name="deviceAssetId"\r\n\r\n([^\r]*)', body)
+        asset_id = m.group(1) if m else b""
+        with self.lock:
+            duplicate = asset_id in self.seen
+            self.seen.add(asset_id)
+        self._reply(200 if duplicate else 201, {"id": asset_id.decode(), "status": "duplicate" if duplicate else "created"})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(latency, fail_rate):
+    StandInImmich.latency = latency
+    StandInImmich.fail_rate = fail_rate
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInImmich)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/api/assets"
+
+
+def make_assets(directory, count, size_kb, run):
+    names = []
+    for i in range(count):
+        name = f"devX_20250101-{i:06d}_clip{run}x{i}_None_.mkv"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size_kb * 1024))
+        names.append(name)
+    return names
+
+
+def asset_fields(filename):
+    parts = filename.replace(".mkv", "").split("_")
+    return {"deviceId": parts[0], "deviceAssetId": f"{parts[2]}-{parts[3]}-{parts[4]}",
+            "fileCreatedAt": "2025-01-01T00:00:00-07:00", "fileModifiedAt": "2025-01-01T00:00:00-07:00"}
+
+
+def run_naive(directory, names, url):
+    """The old way: a fresh connection per asset, one at a time, no retry."""
+    start = time.perf_counter()
+    accepted = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        with open(path, "rb") as f:
+            response = requests.post(url, files={"assetData": f}, data=asset_fields(name), headers={"x-api-key": "x"})
+        accepted += response.ok
+        os.remove(path)
+    return time.perf_counter() - start, accepted
+
+
+def run_uploader(directory, names, url, concurrency, timeout):
+    db_path = os.path.join(directory, f"uploads-{concurrency}.sqlite")
+    uploader = ImmichUploader(db_path, directory, url, "x", asset_fields, concurrency=concurrency)
+    start = time.perf_counter()
+    for name in names:
+        uploader.enqueue(name)
+    uploader.start()
+    while time.perf_counter() - start < timeout:
+        counts = uploader.status()["counts"]
+        if not counts.get("pending") and not counts.get("uploading"):
+            break
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - start
+    uploader.stop()
+    left = sum(os.path.exists(os.path.join(directory, n)) for n in names)
+    return elapsed, len(names) - left
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets", type=int, default=100)
+    parser.add_argument("--size-kb", type=int, default=1024)
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in server processing time per asset")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests the stand-in fails with 500")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # retry quickly so failures show up in the numbers instead of stalling the run
+    immich_uploader.BACKOFF_BASE_SECS = 0.05
+    immich_uploader.POLL_INTERVAL_SECS = 0.05
+
+    server, url = start_server(args.latency, args.fail_rate)
+    total_mb = args.assets * args.size_kb / 1024
+    print(f"{args.assets} assets x {args.size_kb} KB, {args.latency * 1000:.0f} ms server latency, "
+          f"{args.fail_rate:.0%} failures")
+    with tempfile.TemporaryDirectory() as directory:
+        if args.fail_rate == 0: # the naive path loses failed assets, so it's only comparable without failures
+            names = make_assets(directory, args.assets, args.size_kb, "naive")
+            StandInImmich.connections.clear()
+            elapsed, accepted = run_naive(directory, names, url)
+            print(f"  naive          : {args.assets / elapsed:7.1f} assets/s {total_mb / elapsed:7.1f} MB/s "
+                  f"{accepted}/{args.assets} accepted, {len(StandInImmich.connections)} connections")
+        for concurrency in args.concurrency:
+            names = make_assets(directory, args.assets, args.size_kb, f"c{concurrency}")
+            StandInImmich.connections.clear()
+            elapsed, uploaded = run_uploader(directory, names, url, concurrency, args.timeout)
+            print(f"  concurrency {concurrency:<3}: {args.assets / elapsed:7.1f} assets/s {total_mb / elapsed:7.1f} MB/s "
+                  f"{uploaded}/{args.assets} uploaded and deleted, {len(StandInImmich.connections)} connections")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from fair_share import camera_from_filename
+from resumable_uploads import METADATA_SUFFIX
+
+IN_PROGRESS = "partial" # clip notes, as motion_postprocess_lib names them
+FINAL = "final"
+MERGED = "merged" # the note of a clip put together from a group
+GROUP_HOLD_SECS = 10 * 60 # an open group with no new part for this long is merged with what it has
+GROUP_MAX_SECS = 60 * 60 # and one open this long, however it's going, so a long event still shows up in Immich
+MERGE_STALE_SECS = 10 * 60 # a merge not finished by then is from a dead worker, so it's done again
+SWEEP_INTERVAL_SECS = 30
+CONCAT_FORMATS = {".mp4": "mp4", ".mov": "mov", ".mkv": "matroska"} # containers ffmpeg's concat demuxer can join
+
+
+def clip_name_fields(filename):
+    """(camera, note, motion_group_id) from a clip name (devId_timestamp_clipId_note_groupId.ext), None where missing."""
+    parts = os.path.splitext(os.path.basename(filename))[0].split("_")
+    field = lambda i: parts[i] if len(parts) > i and parts[i] not in ("", "None") else None
+    return camera_from_filename(filename), field(3), field(4)
+
+
+def merge_metadata(parts_metadata):
+    """One clip's metadata from its parts' in order: their durations add up and motion intervals shift along."""
+    if not parts_metadata or any(m is None or "duration" not in m for m in parts_metadata):
+        return None
+    offset, intervals = 0.0, []
+    for metadata in parts_metadata:
+        for start, end in metadata.get("motion_intervals", []):
+            start, end = round(start + offset, 2), round(end + offset, 2)
+            if intervals and start - intervals[-1][1] <= 0.01: # motion carrying on over the cut between parts
+                intervals[-1][1] = end
+            else:
+                intervals.append([start, end])
+        offset += metadata["duration"]
+    return {"duration": round(offset, 2), "motion_intervals": intervals}
+
+
+class ClipGroups:
+    """
+    Holds the partial clips of a long motion event until its final clip arrives, then joins them losslessly
+    into one clip for ready(filename) (which queues it for the encode), so the event is one encode and one
+    Immich asset rather than one per piece. Groups are keyed by camera and motion_group_id, and kept in SQLite
+    (like the queues) so they survive restarts and any gunicorn worker can finish a group another one started.
+
+    The camera numbers a run's clips (group_part in their metadata), so a final clip that overtakes a partial
+    waits for it; a final clip without a number doesn't complete its group, as partials may still be coming.
+    A group that stops getting parts (the camera went away, a piece was lost, or it isn't numbered) is merged
+    after GROUP_HOLD_SECS; one still going after GROUP_MAX_SECS is merged too, and later parts start a new group.
+    Merging is left to the sweeper thread (woken straight away for a group that's complete), so the upload
+    that completes a group doesn't wait for the join.
+    """
+    def __init__(self, db_path, incoming_dir, ready, hold_secs=GROUP_HOLD_SECS, max_secs=GROUP_MAX_SECS):
+        self.db_path = db_path
+        self.incoming_dir = incoming_dir
+        self.ready = ready
+        self.hold_secs = hold_secs
+        self.max_secs = max_secs
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS clip_groups (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    camera TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'open',
+                    expected INTEGER,
+                    created REAL NOT NULL,
+                    last_arrival REAL NOT NULL,
+                    merge_started REAL,
+                    merged_filename TEXT
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS clip_group_parts (
+                    filename TEXT PRIMARY KEY,
+                    group_row INTEGER NOT NULL,
+                    part INTEGER,
+                    arrived REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS clip_groups_key ON clip_groups (camera, group_id, state)")
+            conn.execute("CREATE INDEX IF NOT EXISTS clip_group_parts_group ON clip_group_parts (group_row, part)")
+
+    @contextmanager
+    def _db(self):
+        # a connection per call: sqlite connections can't be shared between threads
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def add(self, filename, metadata=None):
+        """
+        Take a clip that arrived if it's part of a motion run. Returns False if it isn't, and should be encoded
+        as it is; True if it's held (if it completes its group, the sweeper merges it and passes it to ready()).
+        """
+        camera, note, group_id = clip_name_fields(filename)
+        if note not in (IN_PROGRESS, FINAL) or group_id is None:
+            return False
+        part = (metadata or {}).get("group_part")
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT id FROM clip_groups WHERE camera=? AND group_id=? AND state='open'",
+                                   (camera, group_id)).fetchone()
+                group_row = row["id"] if row else conn.execute(
+                    "INSERT INTO clip_groups (camera, group_id, created, last_arrival) VALUES (?, ?, ?, ?)",
+                    (camera, group_id, now, now)).lastrowid
+                conn.execute("INSERT OR REPLACE INTO clip_group_parts (filename, group_row, part, arrived) VALUES (?, ?, ?, ?)",
+                             (filename, group_row, part, now))
+                conn.execute("UPDATE clip_groups SET last_arrival=? WHERE id=?", (now, group_row))
+                if note == FINAL:
+                    # -1: a camera that doesn't number its clips; its partials may still be on their way, so the
+                    # group isn't complete until it has gone GROUP_HOLD_SECS without a clip
+                    conn.execute("UPDATE clip_groups SET expected=? WHERE id=?", (part + 1 if part is not None else -1, group_row))
+                complete = self._complete(conn, group_row)
+                if complete:
+                    conn.execute("UPDATE clip_groups SET state='ready' WHERE id=?", (group_row,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        logging.info(f"Holding {filename} as part {part} of motion group {group_id}")
+        if complete:
+            self.wakeup.set()
+        return True
+
+    def _complete(self, conn, group_row):
+        """Whether every part of the group's run is in, counting ones merged by earlier groups of the same run."""
+        group = conn.execute("SELECT * FROM clip_groups WHERE id=?", (group_row,)).fetchone()
+        if group["expected"] is None or group["expected"] < 0:
+            return False
+        # group ids are short, so only recent groups can be the same run
+        parts = {row[0] for row in conn.execute("""
+            SELECT part FROM clip_group_parts JOIN clip_groups ON clip_groups.id=group_row
+            WHERE camera=? AND group_id=? AND part IS NOT NULL AND created > ?""",
+            (group["camera"], group["group_id"], group["created"] - 2 * self.max_secs))}
+        return parts >= set(range(group["expected"]))
+
+    def sweep(self):
+        """Merge the complete groups and the ones that have waited long enough, and redo merges a dead worker left half done."""
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = [row[0] for row in conn.execute("""
+                    SELECT id FROM clip_groups
+                    WHERE state='ready' OR (state='open' AND (last_arrival < ? OR created < ?))
+                          OR (state='merging' AND merge_started < ?)""",
+                    (now - self.hold_secs, now - self.max_secs, now - MERGE_STALE_SECS))]
+                conn.executemany("UPDATE clip_groups SET state='merging', merge_started=? WHERE id=?", [(now, r) for r in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        for group_row in rows:
+            self._merge(group_row)
+
+    def _merge(self, group_row):
+        with self._db() as conn:
+            group = conn.execute("SELECT * FROM clip_groups WHERE id=?", (group_row,)).fetchone()
+            filenames = [row[0] for row in conn.execute(
+                # unnumbered clips after the numbered ones (sqlite puts NULLs first), in name order: timestamp then clipId
+                "SELECT filename FROM clip_group_parts WHERE group_row=? ORDER BY part IS NULL, part, filename", (group_row,))]
+        logging.info(f"Merging {len(filenames)} clips of motion group {group['group_id']}"
+                     + ("" if group["expected"] is not None else " without waiting any longer for its final clip"))
+        paths = [os.path.join(self.incoming_dir, f) for f in filenames if os.path.exists(os.path.join(self.incoming_dir, f))]
+        merged = None
+        try:
+            merged = self._join(group, paths)
+        except Exception as e:
+            logging.exception(f"Couldn't merge motion group {group['group_id']}, encoding its clips one by one: {e}")
+        # queue the encode before forgetting the parts: a crash in between means a duplicate encode, not a lost clip
+        for filename in [merged] if merged else [os.path.basename(p) for p in paths]:
+            self.ready(filename)
+        if merged:
+            for path in paths:
+                for p in (path, path + METADATA_SUFFIX):
+                    if os.path.exists(p):
+                        os.remove(p)
+        with self._db() as conn:
+            conn.execute("UPDATE clip_groups SET state='done', merged_filename=? WHERE id=?", (merged, group_row))
+
+    def _join(self, group, paths):
+        """Join the parts into one clip in incoming_dir without re-encoding. Returns its name, or None to keep them apart."""
+        if len(paths) < 2:
+            return None # nothing to join, the part goes on as it is
+        exts = {os.path.splitext(p)[1] for p in paths}
+        ext = exts.pop()
+        if exts or (ext != ".h264" and ext not in CONCAT_FORMATS):
+            logging.warning(f"Can't join motion group {group['group_id']}'s {[os.path.basename(p) for p in paths]}")
+            return None
+        # named after the first part, so it sorts and dates like it
+        device_id, timestamp_str, clip_id = os.path.basename(paths[0]).split("_")[:3]
+        merged = f"{device_id}_{timestamp_str}_{clip_id}_{MERGED}_{group['group_id']}{ext}"
+        merged_path = os.path.join(self.incoming_dir, merged)
+        if ext == ".h264":
+            # each clip starts with its own SPS/PPS and keyframe, so the byte streams can just follow one another
+            with open(merged_path + ".part", "wb") as out:
+                for path in paths:
+                    with open(path, "rb") as f:
+                        while True:
+                            sent = os.sendfile(out.fileno(), f.fileno(), None, 1 << 30)
+                            if sent == 0:
+                                break
+        else:
+            with tempfile.NamedTemporaryFile("w", dir=self.incoming_dir, prefix=".concat-", suffix=".txt") as listing:
+                listing.writelines(f"file '{path}'\n" for path in paths)
+                listing.flush()
+                subprocess.run(["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", listing.name, "-c", "copy",
+                                "-f", CONCAT_FORMATS[ext], merged_path + ".part"],
+                               check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        metadata = merge_metadata([self._metadata(path) for path in paths])
+        if metadata is not None:
+            with open(merged_path + METADATA_SUFFIX, "w") as f:
+                json.dump(metadata, f)
+        os.replace(merged_path + ".part", merged_path)
+        logging.info(f"Merged {len(paths)} clips of motion group {group['group_id']} into {merged}")
+        return merged
+
+    def _metadata(self, path):
+        try:
+            with open(path + METADATA_SUFFIX) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def group_of(self, filename):
+        """The group a held clip is in: {"group_id", "state", "merged_filename"}, or None."""
+        with self._db() as conn:
+            row = conn.execute("""SELECT group_id, state, merged_filename FROM clip_group_parts
+                                  JOIN clip_groups ON clip_groups.id=group_row WHERE filename=?""", (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def status(self):
+        with self._db() as conn:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM clip_groups GROUP BY state").fetchall())
+
+    def prune(self, max_age_secs):
+        with self._db() as conn:
+            old = [row[0] for row in conn.execute("SELECT id FROM clip_groups WHERE state='done' AND last_arrival < ?",
+                                                  (time.time() - max_age_secs,))]
+            conn.executemany("DELETE FROM clip_group_parts WHERE group_row=?", [(r,) for r in old])
+            conn.executemany("DELETE FROM clip_groups WHERE id=?", [(r,) for r in old])
+
+    def _sweep_forever(self):
+        while True:
+            self.wakeup.wait(SWEEP_INTERVAL_SECS)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.exception(f"Error sweeping motion groups: {e}")
+
+    def start(self):
+        threading.Thread(target=self._sweep_forever, name="clip-groups", daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import logging
+import subprocess
+from functools import lru_cache
+
+# encoders in the order "auto" tries them; "copy" just remuxes into the output container, for when nothing can encode AV1
+ENCODERS = ("av1_vaapi", "libsvtav1", "libaom-av1", "copy")
+IN_PROGRESS = "partial" # clip notes, as motion_postprocess_lib names them
+FINAL = "final"
+
+# Each profile sets every encoder's quality knob, since their scales differ: av1_vaapi's global_quality (30 was found
+# through testing to be as low as it could reasonably go without losing too much quality), and the software encoders'
+# crf (0-63) and speed (SVT-AV1 preset 0-13 and libaom cpu-used 0-8, higher is faster). max_height scales down
+# anything taller; None keeps the camera's resolution.
+PROFILES = {
+    # most of the frame is moving: the detail is worth the bits
+    "detail": {"denoise": "3:3:6:6", "vaapi_quality": 28, "crf": 30, "svt_preset": 8, "aom_cpu_used": 6, "max_height": None},
+    # what every clip got before there were profiles; only "still" and "backlog" go below it
+    "standard": {"denoise": "3:3:6:6", "vaapi_quality": 30, "crf": 32, "svt_preset": 9, "aom_cpu_used": 7, "max_height": None},
+    # little motion: the scene is mostly static, so denoise harder (sensor noise is most of what changes) and quantize more
+    "still": {"denoise": "5:4:9:9", "vaapi_quality": 36, "crf": 40, "svt_preset": 10, "aom_cpu_used": 8, "max_height": None},
+    # the encode queue is backing up: cheaper filtering, fewer pixels, faster presets, so it drains
+    "backlog": {"denoise": "2:2:4:4", "vaapi_quality": 36, "crf": 40, "svt_preset": 12, "aom_cpu_used": 8, "max_height": 720},
+}
+LOW_MOTION_FRACTION = 0.15 # clips moving for less than this fraction of their length get "still"
+HIGH_MOTION_FRACTION = 0.6 # and more than this, "detail"
+BACKLOG_FRACTION = 0.5 # with the queue this full (of MAX_QUEUED_JOBS), everything gets "backlog"
+PARTIAL_BACKLOG_FRACTION = 0.25 # partial clips have more of the event behind them in the queue, so they switch sooner
+
+
+@lru_cache(maxsize=None)
+def _ffmpeg_encoders():
+    """Output of `ffmpeg -encoders`, or "" without a working ffmpeg."""
+    try:
+        return subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def encoder_available(encoder, device=None):
+    if encoder == "copy":
+        return shutil.which("ffmpeg") is not None
+    if encoder == "av1_vaapi" and not (device and os.path.exists(device)):
+        return False
+    if encoder not in ENCODERS:
+        raise ValueError(f"Unknown encoder {encoder!r}, expected auto or one of {', '.join(ENCODERS)}")
+    return f" {encoder} " in _ffmpeg_encoders()
+
+
+def choose_encoder(preference="auto", device=None):
+    """The encoder to use on device: preference if it's available here, else the first available of ENCODERS."""
+    if preference != "auto":
+        if encoder_available(preference, device):
+            return preference
+        logging.warning(f"Encoder {preference} isn't available here, picking another")
+    for encoder in ENCODERS:
+        if encoder_available(encoder, device):
+            return encoder
+    return "copy"
+
+
+def motion_fraction(metadata):
+    """How much of a clip its motion intervals cover, from its metadata sidecar, or None if that isn't known."""
+    if not metadata or not metadata.get("duration"):
+        return None
+    moving = sum(end - start for start, end in metadata.get("motion_intervals", []))
+    return min(1.0, moving / metadata["duration"])
+
+
+def choose_profile(metadata, note, queue_depth, max_queued):
+    """Which of PROFILES to encode a clip with, from what's in it and how far behind the encode queue is."""
+    backlog = queue_depth / max_queued if max_queued else 0
+    if backlog >= (PARTIAL_BACKLOG_FRACTION if note == IN_PROGRESS else BACKLOG_FRACTION):
+        return "backlog"
+    fraction = motion_fraction(metadata)
+    if fraction is None:
+        return "standard"
+    # a partial clip is the middle of a longer event, so however quiet this piece is the rest isn't
+    if fraction < LOW_MOTION_FRACTION and note != IN_PROGRESS:
+        return "still"
+    if fraction > HIGH_MOTION_FRACTION:
+        return "detail"
+    return "standard"
+
+
+def encode_command(input_path, output_path, profile, encoder, device=None, framerate=None):
+    """The ffmpeg command encoding input_path to output_path with encoder, using the settings of PROFILES[profile]."""
+    settings = PROFILES[profile]
+    # raw .h264 clips carry no timestamps, so the demuxer has to be told the rate
+    input_args = ["-f", "h264", "-framerate", str(framerate)] if framerate and input_path.endswith(".h264") else []
+    if encoder == "copy":
+        return ["ffmpeg", "-y", *input_args, "-i", input_path, "-c", "copy", output_path]
+
+    filters = [f"hqdn3d={settings['denoise']}"]
+    if settings["max_height"]:
+        filters.append(f"scale=-2:'min(ih,{settings['max_height']})'")
+    if encoder == "av1_vaapi":
+        return ["ffmpeg", "-y", "-hwaccel", "vaapi", "-hwaccel_device", device, *input_args, "-i", input_path,
+                "-vf", ",".join(filters + ["format=nv12", "hwupload"]),
+                "-c:v", "av1_vaapi", "-global_quality", str(settings["vaapi_quality"]), "-low_power", "0", "-profile:v", "0",
+                "-c:a", "copy", output_path]
+    if encoder == "libsvtav1":
+        codec = ["-c:v", "libsvtav1", "-preset", str(settings["svt_preset"]), "-crf", str(settings["crf"])]
+    elif encoder == "libaom-av1":
+        codec = ["-c:v", "libaom-av1", "-crf", str(settings["crf"]), "-b:v", "0",
+                 "-cpu-used", str(settings["aom_cpu_used"]), "-row-mt", "1"]
+    else:
+        raise ValueError(f"Unknown encoder {encoder!r}")
+    return ["ffmpeg", "-y", *input_args, "-i", input_path, "-vf", ",".join(filters + ["format=yuv420p"]),
+            *codec, "-c:a", "copy", output_path]
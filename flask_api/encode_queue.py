@@ -0,0 +1,290 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+import fair_share
+from fair_share import camera_from_filename
+
+POLL_INTERVAL_SECS = 2 # how often idle workers look for jobs queued by another gunicorn worker
+HEARTBEAT_SECS = 30
+STALE_AFTER_SECS = 120 # running jobs without a heartbeat for this long are from a dead worker, so requeue them
+MAX_ATTEMPTS = 3
+DEFAULT_ENCODE_SECS = 60 # used for Retry-After estimates until some jobs have finished
+MIN_JOB_COST_BYTES = 1024 * 1024 # a job's fair-share cost is its size (encode time goes with it), but at least this
+
+
+def parse_devices(spec):
+    """"/dev/dri/renderD129:2,/dev/dri/renderD128:1" -> {"/dev/dri/renderD129": 2, "/dev/dri/renderD128": 1}"""
+    devices = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        path, _, limit = entry.strip().rpartition(":")
+        if not path: # no ":N" given
+            path, limit = limit, "1"
+        devices[path] = int(limit)
+    return devices
+
+
+class EncodeQueue:
+    """
+    Persistent encode job queue in SQLite, shared by all gunicorn workers and surviving restarts.
+    A job is claimed for an encode device only while that device has fewer running jobs than its
+    limit, so the total number of encodes per device is bounded across processes.
+
+    Jobs are tagged with the camera that sent them. With scheduling="fair" the next job goes to the camera
+    that has had the least encode time (by clip size, scaled by camera_weights) rather than the oldest job,
+    so one busy camera can't starve the rest; "fifo" is plain arrival order. max_queued_per_camera caps how
+    much of the queue any one camera can fill.
+    """
+    def __init__(self, db_path, devices, max_queued, camera_weights=None, max_queued_per_camera=None, scheduling="fair"):
+        self.db_path = db_path
+        self.devices = devices
+        self.max_queued = max_queued
+        self.camera_weights = camera_weights or {}
+        self.max_queued_per_camera = max_queued_per_camera or max_queued
+        self.scheduling = scheduling
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    encode_device TEXT,
+                    owner TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    heartbeat REAL,
+                    error TEXT,
+                    camera TEXT NOT NULL DEFAULT 'unknown',
+                    size INTEGER
+                )""")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "camera" not in columns: # queue from before jobs were tagged by camera
+                conn.execute("ALTER TABLE jobs ADD COLUMN camera TEXT NOT NULL DEFAULT 'unknown'")
+                conn.execute("ALTER TABLE jobs ADD COLUMN size INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_camera ON jobs (state, camera, id)")
+            fair_share.ensure_table(conn)
+
+    def _connect(self):
+        # a connection per call: sqlite connections can't be shared between threads
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _db(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, filename, camera=None, size=None):
+        camera = camera or camera_from_filename(filename)
+        with self._db() as conn:
+            job_id = conn.execute("INSERT INTO jobs (filename, created, camera, size) VALUES (?, ?, ?, ?)",
+                                  (filename, time.time(), camera, size)).lastrowid
+        logging.info(f"Queued encode job {job_id} for {filename} from {camera}")
+        return job_id
+
+    def _next_job(self, conn):
+        if self.scheduling == "fifo":
+            return conn.execute("SELECT * FROM jobs WHERE state='queued' ORDER BY id LIMIT 1").fetchone()
+        waiting = [row[0] for row in conn.execute("SELECT DISTINCT camera FROM jobs WHERE state='queued'")]
+        camera = fair_share.pick(conn, "encode", waiting)
+        if camera is None:
+            return None
+        job = conn.execute("SELECT * FROM jobs WHERE state='queued' AND camera=? ORDER BY id LIMIT 1", (camera,)).fetchone()
+        fair_share.charge(conn, "encode", camera, max(job["size"] or 0, MIN_JOB_COST_BYTES) / MIN_JOB_COST_BYTES,
+                          self.camera_weights)
+        return job
+
+    def claim(self):
+        """The next queued job (see scheduling), marked running on a device with a free slot, or None."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE") # one claimer at a time across processes
+            running = dict(conn.execute(
+                "SELECT encode_device, COUNT(*) FROM jobs WHERE state='running' GROUP BY encode_device").fetchall())
+            free = [d for d, limit in self.devices.items() if running.get(d, 0) < limit]
+            job = self._next_job(conn) if free else None
+            if job is None:
+                conn.execute("COMMIT")
+                return None
+            device = min(free, key=lambda d: running.get(d, 0) / self.devices[d])
+            now = time.time()
+            conn.execute("""UPDATE jobs SET state='running', encode_device=?, owner=?, attempts=attempts+1,
+                            started=?, heartbeat=? WHERE id=?""", (device, self.owner, now, now, job["id"]))
+            conn.execute("COMMIT")
+            return dict(job, encode_device=device, attempts=job["attempts"] + 1)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        with self._db() as conn:
+            conn.execute(f"UPDATE jobs SET heartbeat=? WHERE id IN ({','.join('?' * len(job_ids))})",
+                         (time.time(), *job_ids))
+
+    def finish(self, job, error=None):
+        with self._db() as conn:
+            if error is None:
+                conn.execute("UPDATE jobs SET state='done', finished=?, error=NULL WHERE id=?", (time.time(), job["id"]))
+            elif job["attempts"] < MAX_ATTEMPTS:
+                logging.warning(f"Encode job {job['id']} failed ({error}), requeueing")
+                conn.execute("UPDATE jobs SET state='queued', error=? WHERE id=?", (error, job["id"]))
+            else:
+                logging.error(f"Encode job {job['id']} failed {job['attempts']} times, giving up: {error}")
+                conn.execute("UPDATE jobs SET state='failed', finished=?, error=? WHERE id=?",
+                             (time.time(), error, job["id"]))
+
+    def requeue_stale(self):
+        with self._db() as conn:
+            cursor = conn.execute("UPDATE jobs SET state='queued' WHERE state='running' AND heartbeat < ?",
+                                  (time.time() - STALE_AFTER_SECS,))
+        if cursor.rowcount:
+            logging.warning(f"Requeued {cursor.rowcount} encode jobs from a worker that went away")
+
+    def depth(self, camera=None):
+        with self._db() as conn:
+            if camera is None:
+                return conn.execute("SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()[0]
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state='queued' AND camera=?", (camera,)).fetchone()[0]
+
+    def saturated(self):
+        return self.depth() >= self.max_queued
+
+    def camera_saturated(self, camera):
+        """Whether camera has used up its share of the queue (max_queued_per_camera)."""
+        return self.depth(camera) >= self.max_queued_per_camera
+
+    def retry_after(self, camera=None):
+        """
+        Rough seconds until there's room in the queue again, for Retry-After headers. For a camera over its quota,
+        until it has room in its share, given that it gets about 1/(cameras waiting) of the encode slots.
+        """
+        with self._db() as conn:
+            avg = conn.execute("""SELECT AVG(finished - started) FROM (SELECT finished, started FROM jobs
+                                  WHERE state='done' ORDER BY finished DESC LIMIT 20)""").fetchone()[0]
+            waiting = conn.execute("SELECT COUNT(DISTINCT camera) FROM jobs WHERE state='queued'").fetchone()[0]
+        slots = max(1, sum(self.devices.values()))
+        if camera is None:
+            overflow = self.depth() - self.max_queued + 1
+        else:
+            overflow = self.depth(camera) - self.max_queued_per_camera + 1
+            slots /= max(1, waiting)
+        return int(max(1, overflow) * (avg or DEFAULT_ENCODE_SECS) / slots) + 1
+
+    def status(self, limit=100):
+        with self._db() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            running = dict(conn.execute(
+                "SELECT encode_device, COUNT(*) FROM jobs WHERE state='running' GROUP BY encode_device").fetchall())
+            jobs = [dict(row) for row in conn.execute(
+                """SELECT id, filename, state, encode_device, attempts, created, started, error FROM jobs
+                   WHERE state IN ('queued', 'running') ORDER BY state DESC, id LIMIT ?""", (limit,))]
+        return {
+            "counts": counts,
+            "max_queued": self.max_queued,
+            "devices": {d: {"limit": limit, "running": running.get(d, 0)} for d, limit in self.devices.items()},
+            "jobs": jobs,
+        }
+
+    def job(self, filename):
+        """The latest job for filename, or None."""
+        with self._db() as conn:
+            row = conn.execute("""SELECT id, filename, camera, state, encode_device, attempts, created, started, finished, error
+                                  FROM jobs WHERE filename=? ORDER BY id DESC LIMIT 1""", (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def cameras(self):
+        """Per-camera ingest accounting over the retained jobs: clips and bytes received, job states, latency."""
+        with self._db() as conn:
+            rows = conn.execute("""
+                SELECT camera, COUNT(*) AS clips, COALESCE(SUM(size), 0) AS bytes, MAX(created) AS last_seen,
+                       SUM(state='queued') AS queued, SUM(state='running') AS running,
+                       SUM(state='done') AS done, SUM(state='failed') AS failed,
+                       AVG(CASE WHEN state='done' THEN started - created END) AS avg_wait_secs,
+                       AVG(CASE WHEN state='done' THEN finished - created END) AS avg_latency_secs
+                FROM jobs GROUP BY camera ORDER BY camera""").fetchall()
+        return {row["camera"]: {**{k: row[k] for k in row.keys() if k != "camera"},
+                                "weight": self.camera_weights.get(row["camera"], 1),
+                                "max_queued": self.max_queued_per_camera} for row in rows}
+
+    def prune(self, max_age_secs):
+        with self._db() as conn:
+            conn.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                         (time.time() - max_age_secs,))
+
+
+class EncodeWorkers:
+    """
+    Threads in this gunicorn worker that claim jobs from the queue and run handler(filename, encode_device).
+    There are as many threads as total device slots, so any one process can fill the devices if the others are idle.
+    """
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self.wakeup = threading.Event()
+        self.running = {} # job id -> job, for heartbeats
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.queue.requeue_stale()
+        for i in range(sum(self.queue.devices.values())):
+            threading.Thread(target=self._work, name=f"encode-worker-{i}", daemon=True).start()
+        threading.Thread(target=self._heartbeat, name="encode-heartbeat", daemon=True).start()
+
+    def notify(self):
+        """Something was just queued in this process, no need to wait for the next poll."""
+        self.wakeup.set()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECS)
+            try:
+                with self.lock:
+                    job_ids = list(self.running)
+                self.queue.heartbeat(job_ids)
+                self.queue.requeue_stale()
+            except Exception as e:
+                logging.exception(f"Encode heartbeat error: {e}")
+
+    def _work(self):
+        while True:
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                logging.exception(f"Error claiming an encode job: {e}")
+                job = None
+            if job is None:
+                self.wakeup.wait(POLL_INTERVAL_SECS)
+                self.wakeup.clear()
+                continue
+
+            with self.lock:
+                self.running[job["id"]] = job
+            logging.info(f"Encode job {job['id']} ({job['filename']}) running on {job['encode_device']}")
+            error = None
+            try:
+                self.handler(job["filename"], job["encode_device"])
+            except Exception as e:
+                logging.exception(f"Encode job {job['id']} failed: {e}")
+                error = repr(e)
+            finally:
+                with self.lock:
+                    del self.running[job["id"]]
+            self.queue.finish(job, error)
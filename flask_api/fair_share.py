@@ -0,0 +1,58 @@
+import logging
+
+# Start-time fair queueing across cameras, with its state in the same SQLite database as the queue it schedules,
+# so every gunicorn worker takes turns from the same books. Each camera has a virtual time that advances by
+# cost / weight whenever one of its jobs is started; the next job goes to the waiting camera furthest behind.
+# A camera that was idle starts again from the current virtual clock, so it can't save up turns while away.
+CLOCK = "" # the row holding the queue's virtual clock (camera ids come from filenames and are never empty)
+
+
+def ensure_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fair_share (
+            queue TEXT NOT NULL,
+            camera TEXT NOT NULL,
+            vtime REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (queue, camera)
+        )""")
+
+
+def pick(conn, queue, cameras):
+    """Which of the cameras with waiting jobs goes next. Call inside the claiming transaction."""
+    if not cameras:
+        return None
+    vtimes = dict(conn.execute("SELECT camera, vtime FROM fair_share WHERE queue=?", (queue,)).fetchall())
+    clock = vtimes.get(CLOCK, 0.0)
+    return min(sorted(cameras), key=lambda camera: max(vtimes.get(camera, clock), clock))
+
+
+def charge(conn, queue, camera, cost=1.0, weights=None):
+    """Account for starting one of camera's jobs, costing cost (e.g. its size) divided by the camera's weight."""
+    weight = (weights or {}).get(camera, 1) or 1
+    row = conn.execute("SELECT vtime FROM fair_share WHERE queue=? AND camera=?", (queue, camera)).fetchone()
+    clock = conn.execute("SELECT vtime FROM fair_share WHERE queue=? AND camera=?", (queue, CLOCK)).fetchone()
+    start = max(row[0] if row else 0.0, clock[0] if clock else 0.0)
+    conn.executemany("INSERT INTO fair_share (queue, camera, vtime) VALUES (?, ?, ?) "
+                     "ON CONFLICT (queue, camera) DO UPDATE SET vtime=excluded.vtime",
+                     [(queue, CLOCK, start), (queue, camera, start + cost / weight)])
+    logging.debug(f"Fair share {queue}: {camera} starts at {start:.2f}, next at {start + cost / weight:.2f}")
+
+
+def parse_weights(spec):
+    """"devIdabc:2,devIddef:0.5" (or devIdabc=2) -> {"devIdabc": 2.0, "devIddef": 0.5}. Weights must be positive."""
+    weights = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        camera, sep, weight = entry.strip().replace("=", ":").rpartition(":")
+        if not sep or not camera:
+            raise ValueError(f"Camera weight {entry.strip()!r} isn't camera:weight")
+        weights[camera] = float(weight)
+        if not weights[camera] > 0:
+            raise ValueError(f"Camera weight {entry.strip()!r} isn't positive")
+    return weights
+
+
+def camera_from_filename(filename):
+    """The camera's device id, the first _ field of the clip names cameras send (devIdXXXX_timestamp_...)."""
+    return filename.split("_", 1)[0] or "unknown"
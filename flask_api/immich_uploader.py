@@ -0,0 +1,219 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fair_share
+from fair_share import camera_from_filename
+
+IMMICH_CONCURRENCY = 4 # uploads in flight at once, across all gunicorn workers
+UPLOAD_TIMEOUT = (10, 300) # connect, read seconds
+LEASE_SECS = 15 * 60 # a claimed upload not finished by then is from a dead worker, so it's up for grabs again
+BACKOFF_BASE_SECS = 30
+BACKOFF_MAX_SECS = 60 * 60
+MAX_UPLOAD_ATTEMPTS = 20 # ~15 hours of backoff before an upload is marked failed (the file is kept)
+POLL_INTERVAL_SECS = 2
+
+
+def make_session(pool_size):
+    """A session whose connection pool holds pool_size keep-alive connections, retrying failed connects."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=Retry(connect=2, read=0, status=0, backoff_factor=0.5))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def is_duplicate(response):
+    if response.status_code == 409:
+        return True
+    try:
+        return response.json().get("status") == "duplicate"
+    except ValueError:
+        return False
+
+
+class ImmichUploader:
+    """
+    Durable upload queue for encoded clips, in SQLite so it survives restarts and is shared by all gunicorn workers.
+    Uploads reuse pooled connections and at most `concurrency` run at once. A failed upload is retried with
+    exponential backoff, and the file is only deleted after Immich answers 2xx or says it's a duplicate.
+    Due uploads are taken in turns across cameras (see fair_share), weighted by camera_weights.
+
+    asset_fields(filename) gives the form fields (deviceId, deviceAssetId, ...) for an asset.
+    """
+    def __init__(self, db_path, encoded_dir, upload_url, api_key, asset_fields, concurrency=IMMICH_CONCURRENCY,
+                 camera_weights=None, metrics=None):
+        self.db_path = db_path
+        self.encoded_dir = encoded_dir
+        self.upload_url = upload_url
+        self.api_key = api_key
+        self.asset_fields = asset_fields
+        self.concurrency = concurrency
+        self.camera_weights = camera_weights or {}
+        self.metrics = metrics # a MetricsStore to record uploads in, or None
+        if metrics is not None:
+            metrics.counter("immich_uploads_total", "Immich upload attempts by result (ok, failed)")
+            metrics.counter("immich_upload_bytes_total", "Encoded clip bytes uploaded to Immich")
+            metrics.histogram("immich_upload_seconds", "Time for one Immich upload attempt")
+        self.session = make_session(concurrency)
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS immich_uploads (
+                    filename TEXT PRIMARY KEY,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    lease_until REAL,
+                    created REAL NOT NULL,
+                    error TEXT,
+                    camera TEXT NOT NULL DEFAULT 'unknown'
+                )""")
+            if "camera" not in [row[1] for row in conn.execute("PRAGMA table_info(immich_uploads)")]:
+                conn.execute("ALTER TABLE immich_uploads ADD COLUMN camera TEXT NOT NULL DEFAULT 'unknown'")
+            fair_share.ensure_table(conn)
+
+    @contextmanager
+    def _db(self):
+        # a connection per call: sqlite connections can't be shared between threads
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL") # with WAL, a crash can't corrupt the queue, only lose the last commit
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, filename, camera=None):
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("""INSERT INTO immich_uploads (filename, next_attempt, created, camera) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (filename) DO UPDATE SET state='pending', attempts=0, next_attempt=?""",
+                         (filename, now, now, camera or camera_from_filename(filename), now))
+        logging.info(f"Queued {filename} for upload to Immich")
+        self.wakeup.set()
+
+    def claim(self):
+        """The next due upload (in turns across cameras), leased to this process, or None if there's none or all slots are busy."""
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                active = conn.execute("SELECT COUNT(*) FROM immich_uploads WHERE state='uploading' AND lease_until > ?",
+                                      (now,)).fetchone()[0]
+                row = None
+                due = "((state='pending' AND next_attempt <= ?) OR (state='uploading' AND lease_until <= ?))"
+                if active < self.concurrency:
+                    cameras = [r[0] for r in conn.execute(f"SELECT DISTINCT camera FROM immich_uploads WHERE {due}", (now, now))]
+                    camera = fair_share.pick(conn, "immich", cameras)
+                    if camera is not None:
+                        row = conn.execute(f"SELECT * FROM immich_uploads WHERE camera=? AND {due} ORDER BY next_attempt LIMIT 1",
+                                           (camera, now, now)).fetchone()
+                        fair_share.charge(conn, "immich", camera, weights=self.camera_weights)
+                if row is not None:
+                    conn.execute("UPDATE immich_uploads SET state='uploading', lease_until=?, attempts=attempts+1 WHERE filename=?",
+                                 (now + LEASE_SECS, row["filename"]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return None if row is None else dict(row, attempts=row["attempts"] + 1)
+
+    def _done(self, filename):
+        with self._db() as conn:
+            conn.execute("DELETE FROM immich_uploads WHERE filename=?", (filename,))
+
+    def _failed(self, upload, error):
+        with self._db() as conn:
+            if upload["attempts"] >= MAX_UPLOAD_ATTEMPTS:
+                logging.error(f"Giving up on uploading {upload['filename']} to Immich after {upload['attempts']} tries, "
+                              f"keeping the file: {error}")
+                conn.execute("UPDATE immich_uploads SET state='failed', error=? WHERE filename=?", (error, upload["filename"]))
+                return
+            delay = min(BACKOFF_BASE_SECS * 2 ** (upload["attempts"] - 1), BACKOFF_MAX_SECS)
+            logging.warning(f"Upload of {upload['filename']} to Immich failed ({error}), retrying in {delay}s")
+            conn.execute("UPDATE immich_uploads SET state='pending', next_attempt=?, error=? WHERE filename=?",
+                         (time.time() + delay, error, upload["filename"]))
+
+    def upload(self, filename):
+        """One upload attempt. Returns None if Immich has the asset (and the file is deleted), else the error."""
+        path = os.path.join(self.encoded_dir, filename)
+        fields = self.asset_fields(filename)
+        logging.info(f"Uploading video to Immich with deviceAssetId: {fields.get('deviceAssetId')}")
+        try:
+            with open(path, "rb") as f:
+                response = self.session.post(self.upload_url, files={"assetData": f}, data=fields,
+                                             headers={"x-api-key": self.api_key}, timeout=UPLOAD_TIMEOUT)
+        except requests.RequestException as e:
+            return repr(e)
+
+        logging.info(f"Upload response code: {response.status_code}")
+        if response.ok or is_duplicate(response):
+            os.remove(path)
+            return None
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                upload = self.claim()
+            except Exception as e:
+                logging.exception(f"Error claiming an Immich upload: {e}")
+                upload = None
+            if upload is None:
+                self.wakeup.wait(POLL_INTERVAL_SECS)
+                self.wakeup.clear()
+                continue
+
+            if not os.path.exists(os.path.join(self.encoded_dir, upload["filename"])):
+                logging.warning(f"{upload['filename']} is gone, dropping its Immich upload")
+                self._done(upload["filename"])
+                continue
+            size = os.path.getsize(os.path.join(self.encoded_dir, upload["filename"]))
+            start = time.monotonic()
+            try:
+                error = self.upload(upload["filename"])
+            except Exception as e:
+                logging.exception(f"Error uploading {upload['filename']} to Immich: {e}")
+                error = repr(e)
+            if self.metrics is not None:
+                self.metrics.observe("immich_upload_seconds", time.monotonic() - start)
+                self.metrics.inc("immich_uploads_total", result="ok" if error is None else "failed")
+                if error is None:
+                    self.metrics.inc("immich_upload_bytes_total", size)
+            if error is None:
+                self._done(upload["filename"])
+            else:
+                self._failed(upload, error)
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._work, name=f"immich-upload-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Let in-flight uploads finish and stop the upload threads."""
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+
+    def status(self):
+        with self._db() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM immich_uploads GROUP BY state").fetchall())
+            by_camera = {}
+            for camera, state, count in conn.execute("SELECT camera, state, COUNT(*) FROM immich_uploads GROUP BY camera, state"):
+                by_camera.setdefault(camera, {})[state] = count
+            failed = [dict(row) for row in conn.execute(
+                "SELECT filename, attempts, error FROM immich_uploads WHERE state='failed' ORDER BY created")]
+        return {"counts": counts, "by_camera": by_camera, "concurrency": self.concurrency, "failed": failed}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Simulates N cameras sending clips, some of them noisy (sending many times as often), and reports per-camera
+end-to-end latency (accepted -> encoded), rejections and throughput.
+
+Against a running server, with PUT /upload_clip/<filename> and GET /jobs/<filename> (use a real clip with
+--clip, or the encodes will fail):
+    python3 load_generator.py --url http://localhost:5002 --cameras 6 --noisy 1 --duration 300 --clip sample.h264
+In-process, against the encode queue alone with a stand-in encoder that sleeps, comparing schedulers:
+    python3 load_generator.py --simulate --cameras 6 --noisy 1 --noisy-factor 8 --encode-secs 0.05 --slots 1
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+import encode_queue
+from encode_queue import EncodeQueue, EncodeWorkers
+
+
+def camera_ids(n):
+    return [f"devIdload{i:04d}" for i in range(n)]
+
+
+def arrivals(cameras, noisy, noisy_factor, interval, duration, seed=0):
+    """[(secs from start, camera)] of clip arrivals: Poisson per camera, the first `noisy` cameras noisy_factor x as often."""
+    rng = random.Random(seed)
+    events = []
+    for i, camera in enumerate(cameras):
+        rate = (noisy_factor if i < noisy else 1) / interval
+        t = rng.expovariate(rate)
+        while t < duration:
+            events.append((t, camera))
+            t += rng.expovariate(rate)
+    return sorted(events)
+
+
+def clip_name(camera, n):
+    return f"{camera}_{time.strftime('%Y%m%d-%H%M%S')}_load{n:06d}_None_.h264"
+
+
+class CameraStats:
+    def __init__(self):
+        self.sent = self.accepted = self.rejected = self.failed = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+
+def report(stats, wall):
+    print(f"{'camera':>14} {'sent':>5} {'accepted':>8} {'rejected':>8} {'failed':>6} {'done':>5} "
+          f"{'latency p50':>11} {'p95':>7} {'max':>7}")
+    for camera, s in sorted(stats.items()):
+        lat = np.array(s.latencies) if s.latencies else None
+        print(f"{camera:>14} {s.sent:>5} {s.accepted:>8} {s.rejected:>8} {s.failed:>6} {len(s.latencies):>5} "
+              + (f"{np.percentile(lat, 50):>10.2f}s {np.percentile(lat, 95):>6.2f}s {lat.max():>6.2f}s" if lat is not None else ""))
+    done = sum(len(s.latencies) for s in stats.values())
+    print(f"  {done} clips encoded in {wall:.1f}s, {done / wall:.2f} clips/s")
+
+
+def run_http(args, cameras, events):
+    session = requests.Session()
+    payload = open(args.clip, "rb").read() if args.clip else os.urandom(args.size_kb * 1024)
+    stats = {camera: CameraStats() for camera in cameras}
+    pending = {} # filename -> (camera, sent at)
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def send(n, at, camera):
+        time.sleep(max(0, start + at - time.monotonic()))
+        filename = clip_name(camera, n)
+        sent = time.time()
+        try:
+            response = session.put(f"{args.url}/upload_clip/{filename}", data=payload, timeout=60,
+                                    headers={"Content-Type": "application/octet-stream"})
+        except requests.RequestException as e:
+            logging.warning(f"{camera}: {e!r}")
+            stats[camera].add(sent=1, failed=1)
+            return
+        if response.status_code in (429, 503):
+            stats[camera].add(sent=1, rejected=1)
+        elif response.ok:
+            stats[camera].add(sent=1, accepted=1)
+            with lock:
+                pending[filename] = (camera, sent)
+        else:
+            stats[camera].add(sent=1, failed=1)
+
+    with ThreadPoolExecutor(max_workers=len(cameras) * 2) as pool:
+        futures = [pool.submit(send, n, at, camera) for n, (at, camera) in enumerate(events)]
+
+        # poll the accepted clips until they're encoded, while the rest are still being sent
+        deadline = start + args.duration + args.drain_timeout
+        while time.monotonic() < deadline:
+            with lock:
+                waiting = list(pending.items())
+            if not waiting and all(future.done() for future in futures):
+                break
+            for filename, (camera, sent) in waiting:
+                job = session.get(f"{args.url}/jobs/{filename}", timeout=10).json()
+                if job.get("state") in ("done", "failed"):
+                    with lock:
+                        del pending[filename]
+                    if job["state"] == "failed":
+                        stats[camera].add(failed=1)
+                    else:
+                        with stats[camera].lock:
+                            stats[camera].latencies.append(job["finished"] - sent)
+            time.sleep(args.poll)
+    report(stats, time.monotonic() - start)
+
+
+def run_simulated(args, cameras, events, scheduling, tmp_dir):
+    db_path = os.path.join(tmp_dir, f"jobs-{scheduling}.sqlite")
+    queue = EncodeQueue(db_path, {"stand-in": args.slots}, args.max_queued, max_queued_per_camera=args.max_queued_per_camera,
+                        scheduling=scheduling)
+    workers = EncodeWorkers(queue, lambda filename, device: time.sleep(args.encode_secs))
+    workers.start()
+    stats = {camera: CameraStats() for camera in cameras}
+    accepted = []
+    start = time.monotonic()
+    for n, (at, camera) in enumerate(events):
+        time.sleep(max(0, start + at - time.monotonic()))
+        filename = clip_name(camera, n)
+        if queue.saturated() or queue.camera_saturated(camera): # what the server's busy_response checks
+            stats[camera].add(sent=1, rejected=1)
+            continue
+        queue.enqueue(filename, camera=camera, size=args.size_kb * 1024)
+        workers.notify()
+        stats[camera].add(sent=1, accepted=1)
+        accepted.append(filename)
+
+    deadline = time.monotonic() + args.drain_timeout
+    while queue.depth() or queue.status()["counts"].get("running"):
+        if time.monotonic() > deadline:
+            logging.warning("Gave up waiting for the queue to drain")
+            break
+        time.sleep(0.05)
+    wall = time.monotonic() - start
+    for filename in accepted:
+        job = queue.job(filename)
+        if job["state"] == "done":
+            stats[job["camera"]].latencies.append(job["finished"] - job["created"])
+        elif job["state"] == "failed":
+            stats[job["camera"]].add(failed=1)
+    print(f"{scheduling} scheduling:")
+    report(stats, wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="server to send clips to, e.g. http://localhost:5002")
+    parser.add_argument("--simulate", action="store_true", help="drive an in-process encode queue instead of a server")
+    parser.add_argument("--cameras", type=int, default=6)
+    parser.add_argument("--noisy", type=int, default=1, help="how many of the cameras are noisy")
+    parser.add_argument("--noisy-factor", type=float, default=8, help="how much more often noisy cameras send clips")
+    parser.add_argument("--interval", type=float, default=1.0, help="average seconds between a quiet camera's clips")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to send clips for")
+    parser.add_argument("--clip", help="clip file to send (default: --size-kb of random bytes)")
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--poll", type=float, default=0.5, help="seconds between job status checks (--url)")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="how long to wait for the backlog after sending")
+    parser.add_argument("--encode-secs", type=float, default=0.1, help="stand-in encode time (--simulate)")
+    parser.add_argument("--slots", type=int, default=1, help="stand-in encode slots (--simulate)")
+    parser.add_argument("--max-queued", type=int, default=50)
+    parser.add_argument("--max-queued-per-camera", type=int, default=20)
+    parser.add_argument("--scheduling", nargs="+", default=["fifo", "fair"], choices=["fifo", "fair"], help="(--simulate)")
+    args = parser.parse_args()
+    if not args.url and not args.simulate:
+        parser.error("give --url or --simulate")
+
+    logging.basicConfig(level=logging.WARNING)
+    cameras = camera_ids(args.cameras)
+    events = arrivals(cameras, args.noisy, args.noisy_factor, args.interval, args.duration)
+    print(f"{len(events)} clips from {args.cameras} cameras ({args.noisy} noisy, {args.noisy_factor:g}x) over {args.duration:g}s")
+    if args.url:
+        run_http(args, cameras, events)
+        return
+    encode_queue.POLL_INTERVAL_SECS = 0.05
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scheduling in args.scheduling:
+            run_simulated(args, cameras, events, scheduling, tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import time
+import sqlite3
+import logging
+import bisect
+from contextlib import contextmanager
+
+# seconds, from a quick request up to a long encode or Immich upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _value_text(value):
+    """A sample value at full precision (:g would cut a byte counter down to 6 digits)."""
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class MetricsStore:
+    """
+    Counters and histograms for GET /metrics, in the Prometheus text format. Every gunicorn worker serves
+    requests and runs encode and upload threads, and any of them can get the scrape, so the values live in
+    a table in the jobs database rather than in process memory: recording is one small upsert, and a scrape
+    reads what all the workers have added up. Gauges (queue depths and the like) aren't stored; the caller
+    works them out when rendering.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.defined = {} # name -> (kind, help, buckets)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metrics (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (name, labels)
+                )""")
+
+    @contextmanager
+    def _db(self):
+        # a connection per call: sqlite connections can't be shared between threads
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def counter(self, name, help_text=""):
+        self.defined[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        self.defined[name] = ("histogram", help_text, tuple(buckets))
+
+    def _add(self, rows):
+        try:
+            with self._db() as conn:
+                conn.executemany("INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+                                 "ON CONFLICT (name, labels) DO UPDATE SET value=value+excluded.value", rows)
+        except sqlite3.Error as e:
+            # a metric isn't worth failing an upload or an encode over
+            logging.warning(f"Couldn't record metrics {[row[0] for row in rows]}: {e}")
+
+    def inc(self, name, value=1, **labels):
+        self._add([(name, _label_text(sorted(labels.items())), value)])
+
+    def observe(self, name, value, **labels):
+        """Add value to histogram name: its buckets from the first one it fits in, _sum and _count."""
+        buckets = self.defined[name][2]
+        labels = sorted(labels.items())
+        first = bisect.bisect_left(buckets, value)
+        rows = [(f"{name}_bucket", _label_text(labels + [("le", f"{bound:g}")]), 1) for bound in buckets[first:]]
+        rows.append((f"{name}_bucket", _label_text(labels + [("le", "+Inf")]), 1))
+        rows.append((f"{name}_sum", _label_text(labels), value))
+        rows.append((f"{name}_count", _label_text(labels), 1))
+        self._add(rows)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe how long the with block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, gauges=()):
+        """
+        Everything recorded, plus gauges: [(name, help, {labels dict as sorted tuple: value})].
+        """
+        with self._db() as conn:
+            rows = conn.execute("SELECT name, labels, value FROM metrics ORDER BY name, labels").fetchall()
+        stored = {}
+        for name, labels, value in rows:
+            stored.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self.defined.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                lines.extend(f"{name}{labels} {_value_text(value)}" for labels, value in stored.get(name, []))
+                continue
+            # every bucket for each label set, in bound order (ones nothing has fallen into yet aren't stored)
+            by_labels = {}
+            for labels, value in stored.get(f"{name}_bucket", []):
+                cut = labels.rindex('le="')
+                by_labels.setdefault(labels[:cut], {})[labels[cut + 4:-2]] = value
+            for prefix, counts in by_labels.items():
+                for le in [f"{bound:g}" for bound in buckets] + ["+Inf"]:
+                    lines.append(f'{name}_bucket{prefix}le="{le}"}} {_value_text(counts.get(le, 0))}')
+            for suffix in ("_sum", "_count"):
+                lines.extend(f"{name}{suffix}{labels} {_value_text(value)}" for labels, value in stored.get(name + suffix, []))
+        for name, help_text, values in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_label_text(labels)} {_value_text(value)}" for labels, value in sorted(values.items()))
+        return "\n".join(lines) + "\n"
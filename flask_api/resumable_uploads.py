@@ -0,0 +1,156 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import logging
+
+PARTIAL_MAX_AGE_SECS = 3 * 24 * 60 * 60 # abandoned partial uploads are deleted after this long
+HASH_BLOCK_SIZE = 1024 * 1024
+METADATA_SUFFIX = ".meta.json" # clip metadata sent with an upload (e.g. motion intervals) is saved next to it
+
+UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def stream_to_file(stream, dest_path, expected_size=None, expected_sha256=None):
+    """
+    Copy a request body to dest_path in fixed-size blocks, hashing as it goes, so a clip is written
+    exactly once and memory use doesn't grow with its size. It goes to dest_path.part first and is only
+    renamed into place once the size and sha256 (when given) check out. Returns (size, sha256).
+    """
+    part_path = dest_path + ".part"
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, "wb") as f:
+            for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+                f.write(block)
+                size += len(block)
+        if expected_size is not None and size != expected_size:
+            raise UploadError(f"Got {size} of {expected_size} bytes", 400)
+        if expected_sha256 and sha.hexdigest() != expected_sha256.lower():
+            raise UploadError("File checksum mismatch", 422)
+    except BaseException:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, dest_path)
+    return size, sha.hexdigest()
+
+
+class ResumableUploads:
+    """
+    Chunked uploads that survive dropped connections. The partial file and its metadata live on disk,
+    keyed by a hash of (filename, size, sha256), so a client re-creating the same upload later, in any
+    gunicorn worker, gets the offset to resume from. Each chunk is checked against its own sha256, and
+    the whole file against the declared one before it's moved into complete_dir.
+    """
+    def __init__(self, partial_dir, complete_dir):
+        self.partial_dir = partial_dir
+        self.complete_dir = complete_dir
+        os.makedirs(partial_dir, exist_ok=True)
+
+    def _paths(self, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise UploadError("Invalid upload id", 404)
+        base = os.path.join(self.partial_dir, upload_id)
+        return base + ".part", base + ".json"
+
+    def _meta(self, upload_id):
+        _, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError("Unknown upload", 404)
+
+    def create(self, filename, size, sha256, metadata=None):
+        """
+        Start (or resume) an upload. Returns (upload_id, offset to send from).
+        metadata (a dict) is written next to the file as <filename>.meta.json once it's complete.
+        """
+        filename = os.path.basename(filename or "")
+        if not filename or not isinstance(size, int) or size < 0 or not re.match(r"^[0-9a-f]{64}$", sha256 or ""):
+            raise UploadError("filename, size and sha256 are required")
+        if metadata is not None and not isinstance(metadata, dict):
+            raise UploadError("metadata has to be an object")
+        self.prune()
+        upload_id = hashlib.sha256(f"{filename}:{size}:{sha256}".encode()).hexdigest()
+        part_path, meta_path = self._paths(upload_id)
+        if not os.path.exists(meta_path):
+            with open(meta_path + ".tmp", "w") as f:
+                json.dump({"filename": filename, "size": size, "sha256": sha256, "created": time.time(),
+                           "metadata": metadata}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+            open(part_path, "ab").close()
+        return upload_id, self.offset(upload_id)
+
+    def offset(self, upload_id):
+        part_path, _ = self._paths(upload_id)
+        self._meta(upload_id)
+        return os.path.getsize(part_path)
+
+    def append(self, upload_id, offset, chunk, chunk_sha256=None):
+        """
+        Write chunk at offset, which has to be where the partial file currently ends.
+        Returns (new offset, path of the finished file or None if there's more to come).
+        """
+        meta = self._meta(upload_id)
+        part_path, meta_path = self._paths(upload_id)
+        if chunk_sha256 and hashlib.sha256(chunk).hexdigest() != chunk_sha256:
+            raise UploadError("Chunk checksum mismatch", 422, offset=offset)
+
+        with open(part_path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX) # two workers could get retries of the same chunk
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadError(f"Expected offset {current}", 409, offset=current)
+            if current + len(chunk) > meta["size"]:
+                raise UploadError("Chunk goes past the declared size", 400, offset=current)
+            f.write(chunk)
+            f.flush()
+            new_offset = f.tell()
+
+            if new_offset < meta["size"]:
+                return new_offset, None
+
+            if file_sha256(part_path) != meta["sha256"]:
+                logging.error(f"Checksum mismatch for completed upload {meta['filename']}, discarding it")
+                os.remove(part_path)
+                os.remove(meta_path)
+                raise UploadError("File checksum mismatch, start over", 422, offset=0)
+            complete_path = os.path.join(self.complete_dir, meta["filename"])
+            if meta.get("metadata") is not None:
+                with open(complete_path + METADATA_SUFFIX, "w") as m:
+                    json.dump(meta["metadata"], m)
+            os.replace(part_path, complete_path)
+            os.remove(meta_path)
+        logging.info(f"Completed resumable upload of {meta['filename']} ({meta['size']} bytes)")
+        return new_offset, complete_path
+
+    def prune(self, max_age=PARTIAL_MAX_AGE_SECS):
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    logging.info(f"Removed abandoned partial upload file {name}")
+            except FileNotFoundError:
+                pass
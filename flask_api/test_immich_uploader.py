@@ -0,0 +1,205 @@
+"""
+ImmichUploader against the stand-in Immich server from benchmark_immich: leases and requeueing, backoff after
+failures, deleting a clip only once Immich has it, and the queue surviving a restart.
+    python3 -m pytest test_immich_uploader.py
+"""
+import os
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer
+
+import immich_uploader
+from immich_uploader import ImmichUploader
+from benchmark_immich import StandInImmich, asset_fields
+
+BACKOFF_SECS = 60 # long enough that a backed-off upload can't come due again during a test
+
+
+class ScriptedImmich(StandInImmich):
+    """The stand-in, answering with the statuses queued in `replies` first (one per request) before behaving like Immich."""
+    replies = []
+    requests = []
+
+    def do_POST(self):
+        with self.lock:
+            status = self.replies.pop(0) if self.replies else None
+            self.requests.append(self.path)
+        if status is None:
+            return super().do_POST()
+        self.rfile.read(int(self.headers["Content-Length"]))
+        if status == 200:
+            return self._reply(200, {"id": "", "status": "duplicate"})
+        self._reply(status, {"message": f"stand-in {status}"})
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class ImmichUploaderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.ERROR)
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedImmich)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/api/assets"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ScriptedImmich.replies = []
+        ScriptedImmich.requests = []
+        StandInImmich.seen = set()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.db_path = os.path.join(self.dir, "jobs.sqlite")
+        for name, value in (("BACKOFF_BASE_SECS", BACKOFF_SECS), ("POLL_INTERVAL_SECS", 0.02)):
+            patcher = mock.patch.object(immich_uploader, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.uploaders = []
+
+    def tearDown(self):
+        for uploader in self.uploaders:
+            uploader.stop()
+        self.tmp.cleanup()
+
+    def uploader(self, concurrency=1):
+        uploader = ImmichUploader(self.db_path, self.dir, self.url, "key", asset_fields, concurrency=concurrency)
+        self.uploaders.append(uploader)
+        return uploader
+
+    def clip(self, i, camera="devIdaaaa"):
+        name = f"{camera}_20250101-{i:06d}_clipId{i:06d}_None_.mkv"
+        with open(os.path.join(self.dir, name), "wb") as f:
+            f.write(os.urandom(4096))
+        return name
+
+    def row(self, filename):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM immich_uploads WHERE filename=?", (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def exists(self, filename):
+        return os.path.exists(os.path.join(self.dir, filename))
+
+    def test_created_and_duplicate_delete_the_clip(self):
+        ScriptedImmich.replies = [201, 200, 409]
+        uploader = self.uploader()
+        names = [self.clip(i) for i in range(3)]
+        for name in names:
+            uploader.enqueue(name)
+        uploader.start()
+        self.assertTrue(wait_for(lambda: not any(self.exists(n) for n in names)))
+        self.assertTrue(wait_for(lambda: all(self.row(n) is None for n in names)))
+        self.assertEqual(len(ScriptedImmich.requests), 3)
+
+    def test_failures_keep_the_clip_and_back_off(self):
+        for status in (500, 503, 429, 400):
+            with self.subTest(status=status):
+                ScriptedImmich.replies = [status, status]
+                uploader = self.uploader()
+                name = self.clip(status)
+                before = time.time()
+                uploader.enqueue(name)
+                uploader.start()
+                self.assertTrue(wait_for(lambda: self.row(name)["attempts"] == 1 and self.row(name)["state"] == "pending"))
+                row = self.row(name)
+                self.assertTrue(self.exists(name))
+                self.assertIn(str(status), row["error"])
+                self.assertAlmostEqual(row["next_attempt"] - before, BACKOFF_SECS, delta=5)
+                self.assertIsNone(uploader.claim()) # not due again until the backoff is over
+
+                # the second failure waits twice as long
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute("UPDATE immich_uploads SET next_attempt=0 WHERE filename=?", (name,))
+                before = time.time()
+                uploader.wakeup.set()
+                self.assertTrue(wait_for(lambda: self.row(name)["attempts"] == 2 and self.row(name)["state"] == "pending"))
+                self.assertAlmostEqual(self.row(name)["next_attempt"] - before, 2 * BACKOFF_SECS, delta=5)
+                self.assertTrue(self.exists(name))
+                uploader.stop()
+
+    def test_gives_up_after_max_attempts_and_keeps_the_clip(self):
+        ScriptedImmich.replies = [500]
+        uploader = self.uploader()
+        name = self.clip(1)
+        uploader.enqueue(name)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE immich_uploads SET attempts=? WHERE filename=?", (immich_uploader.MAX_UPLOAD_ATTEMPTS - 1, name))
+        uploader.start()
+        self.assertTrue(wait_for(lambda: self.row(name)["state"] == "failed"))
+        self.assertTrue(self.exists(name))
+        self.assertEqual(uploader.status()["counts"], {"failed": 1})
+
+    def test_expired_lease_is_requeued(self):
+        # a worker that claimed an upload and died: nobody else takes it while the lease holds
+        dead = self.uploader()
+        name = self.clip(1)
+        dead.enqueue(name)
+        claimed = dead.claim()
+        self.assertEqual((claimed["filename"], claimed["attempts"]), (name, 1))
+        self.assertEqual(self.row(name)["state"], "uploading")
+        self.assertIsNone(dead.claim())
+
+        # once it runs out, another worker picks the upload up and finishes it
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE immich_uploads SET lease_until=? WHERE filename=?", (time.time() - 1, name))
+        survivor = self.uploader()
+        survivor.start()
+        self.assertTrue(wait_for(lambda: not self.exists(name)))
+        self.assertTrue(wait_for(lambda: self.row(name) is None))
+        self.assertEqual(len(ScriptedImmich.requests), 1)
+
+    def test_concurrency_limits_live_leases(self):
+        uploader = self.uploader(concurrency=2)
+        names = [self.clip(i) for i in range(3)]
+        for name in names:
+            uploader.enqueue(name)
+        self.assertIsNotNone(uploader.claim())
+        self.assertIsNotNone(uploader.claim())
+        self.assertIsNone(uploader.claim())
+        self.assertEqual(uploader.status()["counts"], {"pending": 1, "uploading": 2})
+
+    def test_queue_survives_a_restart(self):
+        ScriptedImmich.replies = [500]
+        first = self.uploader()
+        names = [self.clip(i) for i in range(3)]
+        for name in names:
+            first.enqueue(name)
+        first.start()
+        # one upload fails and backs off; stop before the rest go, as a restart would
+        self.assertTrue(wait_for(lambda: self.row(names[0])["attempts"] == 1 and self.row(names[0])["state"] == "pending"))
+        first.stop()
+        pending = {n for n in names if self.row(n) is not None}
+        self.assertIn(names[0], pending)
+
+        second = self.uploader()
+        self.assertEqual(second.status()["counts"].get("pending"), len(pending))
+        second.start()
+        done = names[1:]
+        self.assertTrue(wait_for(lambda: not any(self.exists(n) for n in done)))
+        self.assertTrue(wait_for(lambda: all(self.row(n) is None for n in done)))
+        # the backed-off one keeps its attempts and its wait across the restart
+        row = self.row(names[0])
+        self.assertEqual((row["state"], row["attempts"]), ("pending", 1))
+        self.assertGreater(row["next_attempt"], time.time() + BACKOFF_SECS / 2)
+        self.assertTrue(self.exists(names[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import asyncio
+import logging
+import threading
+import metrics
+
+PREVIEW_PORT = 8090
+MAX_VIEWERS = 8
+VIEWER_QUEUE_FRAMES = 90 # about one keyframe interval: a viewer further behind than this skips to the next keyframe
+MAX_GOP_FRAMES = 300 # frames kept from the last keyframe, so a new viewer gets a picture straight away
+
+_viewers = metrics.gauge("capture_preview_viewers", "Clients watching the live preview")
+_sent_total = metrics.counter("capture_preview_bytes_total", "Bytes of live preview sent to viewers")
+_skips_total = metrics.counter("capture_preview_skips_total", "Times a slow viewer was skipped ahead to a keyframe")
+
+
+class _Viewer:
+    def __init__(self):
+        self.queue = asyncio.Queue(VIEWER_QUEUE_FRAMES)
+        self.skipping = False # fell behind, waiting for a keyframe to carry on from
+
+
+class LivePreview:
+    """
+    Serves the recording's own h264 stream to viewers as it's encoded, so the preview is a frame behind
+    rather than a segment, and costs no extra encode however many are watching. The recorder hands each
+    encoded frame to publish(); a small asyncio server (on its own thread) fans it out:
+        GET /live.h264      raw h264 from the last keyframe on, e.g. ffplay -fflags nobuffer -f h264 http://pi:8090/live.h264
+        GET /snapshot.h264  the last keyframe on its own (the encoder repeats SPS/PPS, so it decodes by itself)
+        GET /status         viewers and frame counts, as JSON
+    A viewer that can't keep up has its backlog dropped and resumes at the next keyframe, so it can't hold
+    up the others or the recording.
+    """
+    def __init__(self, port=PREVIEW_PORT, host="0.0.0.0", max_viewers=MAX_VIEWERS):
+        self.port = port
+        self.host = host
+        self.max_viewers = max_viewers
+        self.viewers = set()
+        self.gop = [] # encoded frames since the last keyframe
+        self.frames = 0
+        self.loop = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            logging.info(f"Serving the live preview on http://{self.host}:{self.port}/live.h264")
+            ready.set()
+            self.loop.run_until_complete(server.serve_forever())
+        threading.Thread(target=run, name="live-preview", daemon=True).start()
+        ready.wait(10)
+
+    def publish(self, frame, keyframe):
+        """Called from the encoder's thread with each encoded frame. Copies it, since the encoder reuses its buffer."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._publish, bytes(frame), keyframe)
+
+    def _publish(self, frame, keyframe):
+        self.frames += 1
+        if keyframe:
+            self.gop = [frame]
+        elif self.gop and len(self.gop) < MAX_GOP_FRAMES:
+            self.gop.append(frame)
+        for viewer in self.viewers:
+            if viewer.skipping and not keyframe:
+                continue
+            viewer.skipping = False
+            try:
+                viewer.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                while not viewer.queue.empty():
+                    viewer.queue.get_nowait()
+                viewer.skipping = True
+                _skips_total.inc()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): # the headers aren't needed
+                pass
+            path = request_line[1] if len(request_line) > 1 else ""
+            if path == "/live.h264":
+                await self._stream(writer)
+            elif path == "/snapshot.h264" and self.gop:
+                self._reply(writer, 200, "video/h264", self.gop[0])
+            elif path == "/status":
+                self._reply(writer, 200, "application/json",
+                            json.dumps({"viewers": len(self.viewers), "frames": self.frames}).encode())
+            else:
+                self._reply(writer, 404, "text/plain", b"GET /live.h264, /snapshot.h264 or /status\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _reply(self, writer, status, content_type, body):
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+
+    async def _stream(self, writer):
+        if len(self.viewers) >= self.max_viewers:
+            self._reply(writer, 503, "text/plain", b"Too many viewers\n")
+            return
+        viewer = _Viewer()
+        self.viewers.add(viewer)
+        _viewers.set(len(self.viewers))
+        peer = writer.get_extra_info("peername")
+        logging.info(f"Live preview viewer {peer} connected ({len(self.viewers)} watching)")
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: video/h264\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            for frame in self.gop: # start from the last keyframe rather than waiting for the next
+                writer.write(frame)
+            while True:
+                frame = await viewer.queue.get()
+                writer.write(frame)
+                _sent_total.inc(len(frame))
+                await writer.drain()
+        finally:
+            self.viewers.discard(viewer)
+            _viewers.set(len(self.viewers))
+            logging.info(f"Live preview viewer {peer} left")
@@ -0,0 +1,218 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TEXTFILE_INTERVAL_SECS = 15
+# seconds, from a keyframe decode on a fast machine up to a long clip save or upload from the Pi
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels) + "}"
+
+
+def _value_text(value):
+    """A sample value at full precision (:g would cut a byte counter down to 6 digits)."""
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {} # sorted (label, value) pairs -> value
+        self.lock = threading.Lock()
+
+    def _lines(self):
+        with self.lock:
+            return [f"{self.name}{_label_text(labels)} {_value_text(value)}" for labels, value in sorted(self.values.items())]
+
+    def _drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def _merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def _merge(self, values):
+        with self.lock:
+            for key, (counts, total) in values.items():
+                mine = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+                mine[0] = [a + b for a, b in zip(mine[0], counts)]
+                mine[1] += total
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _lines(self):
+        lines = []
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_label_text(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {_value_text(total)}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    This process's metrics, rendered in the Prometheus text format. Recording is a dict update under a lock,
+    so it's cheap enough for every segment; exposing them is a text file rewritten every few seconds (for
+    node_exporter's textfile collector, or to cat) and/or a /metrics HTTP endpoint.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help_text, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help_text=""):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def drain(self):
+        """Counters and histograms recorded since the last drain (and reset), to merge() into another process's registry."""
+        with self.lock:
+            metrics = [m for m in self.metrics.values() if hasattr(m, "_merge")]
+        return {metric.name: metric._drain() for metric in metrics}
+
+    def merge(self, drained):
+        """Add what another process (e.g. an analysis worker) drained to this registry's metrics of the same name."""
+        for name, values in drained.items():
+            metric = self.metrics.get(name)
+            if metric is not None and values:
+                metric._merge(values)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric._lines())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    def start_textfile_writer(self, path, interval=TEXTFILE_INTERVAL_SECS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def write_forever():
+            while True:
+                try:
+                    self.write_textfile(path)
+                except Exception as e:
+                    logging.warning(f"Couldn't write metrics to {path}: {e}")
+                time.sleep(interval)
+        threading.Thread(target=write_forever, name="metrics-textfile", daemon=True).start()
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve GET /metrics on host:port from a background thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def expose(textfile_path=None, port=None):
+    """Expose this process's metrics as a text file and/or on a local HTTP port (either can be None)."""
+    if textfile_path:
+        REGISTRY.start_textfile_writer(textfile_path)
+    if port:
+        REGISTRY.serve(port)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+On-disk index of every segment's motion scores, keyed by segment name, size and mtime, so a restarted
+post-processor never decodes a segment twice. It can also re-threshold old footage without decoding it:
+    python3 motion_index.py /home/piuser/videos/motion_index.sqlite --change-ratio 0.01
+    python3 motion_index.py /home/piuser/videos/motion_index.sqlite --change-ratio 0.05 --detector background
+--detector is the scoring key segments were recorded under (motion_postprocess_lib.SCORING_KEY): the detector's
+name, plus /roi-<digest> with a region mask, since ratios from different detectors or masks aren't comparable.
+"""
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import numpy as np
+
+from motion_scoring import motion_from_ratios
+
+INDEX_RETENTION_DAYS = 30 # rows for segments scored longer ago than this are pruned on startup
+
+SEGMENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        pixel_thresh INTEGER NOT NULL,
+        ratios BLOB NOT NULL,
+        motion INTEGER NOT NULL,
+        scored_at REAL NOT NULL,
+        detector TEXT NOT NULL DEFAULT 'diff',
+        PRIMARY KEY (name, size, mtime_ns, pixel_thresh, detector)
+    )"""
+
+
+class MotionIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(SEGMENTS_TABLE.format(name="segments"))
+        columns = {row[1]: row[5] for row in self.conn.execute("PRAGMA table_info(segments)")} # name -> position in the key
+        if "detector" not in columns: # index from before there was a choice of detector
+            self.conn.execute("ALTER TABLE segments ADD COLUMN detector TEXT NOT NULL DEFAULT 'diff'")
+            columns["detector"] = 0
+        if not columns["detector"]:
+            # the key didn't include the detector, so one detector's row replaced another's: rebuild it with it
+            self.conn.execute(SEGMENTS_TABLE.format(name="segments_new"))
+            self.conn.execute("""INSERT INTO segments_new (name, size, mtime_ns, pixel_thresh, ratios, motion, scored_at, detector)
+                                 SELECT name, size, mtime_ns, pixel_thresh, ratios, motion, scored_at, detector FROM segments""")
+            self.conn.execute("DROP TABLE segments")
+            self.conn.execute("ALTER TABLE segments_new RENAME TO segments")
+        self.conn.commit()
+
+    @staticmethod
+    def _key(seg_path):
+        stat = os.stat(seg_path)
+        return os.path.basename(seg_path), stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, seg_path, pixel_thresh, detector="diff"):
+        """The segment's stored ratios if it's been scored with this pixel_thresh and detector before, else None."""
+        row = self.conn.execute(
+            "SELECT ratios FROM segments WHERE name=? AND size=? AND mtime_ns=? AND pixel_thresh=? AND detector=?",
+            (*self._key(seg_path), pixel_thresh, detector)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def record(self, seg_path, ratios, motion, pixel_thresh, detector="diff"):
+        self.conn.execute(
+            """INSERT OR REPLACE INTO segments (name, size, mtime_ns, pixel_thresh, ratios, motion, scored_at, detector)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (*self._key(seg_path), pixel_thresh, np.asarray(ratios, dtype=np.float32).tobytes(),
+             int(motion), time.time(), detector))
+        self.conn.commit()
+
+    def prune(self, max_age_days=INDEX_RETENTION_DAYS):
+        cursor = self.conn.execute("DELETE FROM segments WHERE scored_at < ?", (time.time() - max_age_days * 86400,))
+        self.conn.commit()
+        if cursor.rowcount:
+            logging.info(f"Pruned {cursor.rowcount} old rows from the motion index")
+
+    def segments(self, pixel_thresh=None, detector="diff"):
+        """(name, ratios, motion) for every segment indexed with this detector (scoring key), oldest first."""
+        query = "SELECT name, ratios, motion FROM segments WHERE detector=?"
+        params = (detector,)
+        if pixel_thresh is not None:
+            query += " AND pixel_thresh=?"
+            params += (pixel_thresh,)
+        for name, ratios, motion in self.conn.execute(query + " ORDER BY scored_at", params):
+            yield name, np.frombuffer(ratios, dtype=np.float32), bool(motion)
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db_path")
+    parser.add_argument("--change-ratio", type=float, required=True, help="threshold to re-evaluate the stored ratios with")
+    parser.add_argument("--pixel-thresh", type=int, default=None, help="only segments scored with this pixel threshold")
+    parser.add_argument("--detector", default="diff",
+                        help="only segments scored with this detector / scoring key, e.g. background or diff/roi-<digest>")
+    parser.add_argument("--changes-only", action="store_true", help="only list segments whose verdict would change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    index = MotionIndex(args.db_path)
+    total = was_motion = now_motion = 0
+    for name, ratios, motion in index.segments(args.pixel_thresh, args.detector):
+        new_motion = len(ratios) > 0 and bool(motion_from_ratios(ratios, args.change_ratio))
+        total += 1
+        was_motion += motion
+        now_motion += new_motion
+        if new_motion != motion or not args.changes_only:
+            print(f"{name}: {'motion' if motion else 'still'} -> {'motion' if new_motion else 'still'}")
+    print(f"{total} segments: {was_motion} had motion, {now_motion} would at change_ratio={args.change_ratio}")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
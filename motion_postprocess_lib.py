@@ -1,5 +1,5 @@
 import os
-import cv2
+import math
 import numpy as np
 import subprocess
 import shutil
@@ -7,20 +7,47 @@ import logging
 from pathlib import Path
 import time
 import uuid
-import requests
-import email.utils
-from zoneinfo import ZoneInfo
+import json
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from segment_decoder import SegmentDecoder, choose_backend, decode_args, keyframe_cut_offsets, keyframe_offsets
+from motion_index import MotionIndex
+from file_watcher import FileWatcher
+from network_clock import NetworkClock
+from motion_scoring import (MotionScorer, make_detector, load_region, motion_from_ratios, motion_intervals,
+                            read_motion_sidecar, sample_log, MOTION_SIDECAR_SUFFIX)
+import metrics
 
 LOG_FILE = f"/home/piuser/videos/logs/motion_detect.log"
 
 SLEEP_INTERVAL=2
+STATS_LOG_INTERVAL = 60 # seconds between backlog/lag log lines (and status file updates) while busy
 PIXEL_THRESHOLD=10
+DETECTOR = "diff" # "diff": each keyframe vs the previous one. "background": vs a running-average background (see motion_scoring)
 CHANGE_RATIO=0.006
 FLUSH_N_CLIPS = 3 # if you have more than this many clips in a row with motion, flush them out into another clip even if you'll cut up the motion. 
+ANALYSIS_WORKERS = 1 # processes decoding/scoring segments in parallel. The Pi Zero 2 W has 4 cores but only 512 MB, so try 2-3 there
 
 LQ_WIDTH, LQ_HEIGHT = 160, 90  # resize early in ffmpeg
+ROI_MASK_PATH = "/home/piuser/videos/roi_mask.png" # optional, this camera's region of interest: white = watch, black = ignore (any size, it's scaled)
+TILE_GRID = None # e.g. (3, 4): score rows x cols tiles and trigger on the busiest one instead of the whole frame
+USE_PERSISTENT_DECODER = True # keep one ffmpeg running and feed it segments, instead of an ffmpeg per segment
+DECODE_BACKEND = "auto" # "auto" picks the first available of v4l2m2m (Pi), vaapi, software. Or name one, or "stub" for CI
+FRAME_BUFFER_SIZE = 16 # keyframes per segment to preallocate for (a 20s segment with an I-frame every 3s has 7), grows if needed
  
+SEGMENT_SECS = 20 # keep in sync with capture_lib._SECS_PER_SEGMENT
+KEYFRAME_SECS = 3 # keep in sync with capture_lib._I_FRAME_EVERY: keyframes are this far apart from a segment's start, so the last one's interval is cut short
+# "h264": clips are the segments appended byte for byte (rpicam-vid's --inline repeats SPS/PPS, so it's one valid stream),
+#   no ffmpeg pass on the Pi; the server gives it timestamps when it encodes. "mp4": remux with ffmpeg, for clips played as-is
+CLIP_CONTAINER = "mp4"
+PRE_ROLL_SECS = 20 # still footage kept before the first motion segment of a clip, rounded up to whole segments
+POST_ROLL_SECS = 20 # and after the last one
+TRIM_CLIPS = True # cut h264 clips down to their motion (at keyframes, no re-encode) plus TRIM_PAD_SECS either side
+TRIM_PAD_SECS = 6 # two keyframes at capture_lib's I-frame every 3s; taken out of the pre/post-roll
+CLIP_METADATA_SUFFIX = ".meta.json" # clip.h264.meta.json holds the clip's motion intervals, uploaded with it
+
 MIN_FREE_SPACE = 2 * 1024 * 1024 * 1024  # 2 GB
+SESSION_GAP_SECS = 60 # a gap this long between buffered files (3 segments) means capture was restarted in between
 
 IN_PROGRESS = "partial"
 FINAL = "final"
@@ -38,12 +65,33 @@ logging.basicConfig(level=logging.DEBUG,
 
 logging.debug("test")
 
-def ensure_space_for_video(new_video_path: Path, clip_dir):
-    """If SD card is too full, delete the new video to prevent overflow."""
+_backend = choose_backend(DECODE_BACKEND)
+_region = load_region(ROI_MASK_PATH, (LQ_HEIGHT, LQ_WIDTH), TILE_GRID)
+_scorer = MotionScorer(region=_region)
+_detector = make_detector(DETECTOR, PIXEL_THRESHOLD, region=_region)
+# what the motion index keys ratios by, besides pixel_thresh: they change with the detector and region
+SCORING_KEY = DETECTOR + (f"/roi-{_region.digest}" if _region else "")
+
+_decode_secs = metrics.histogram("motion_decode_seconds", "Keyframe decode time per segment")
+_score_secs = metrics.histogram("motion_score_seconds", "Motion scoring time per segment")
+_segments_total = metrics.counter("motion_segments_total", "Segments analyzed, by verdict")
+_reused_total = metrics.counter("motion_ratios_reused_total", "Segments scored from a live sidecar or the motion index, not decoded")
+_clip_save_secs = metrics.histogram("motion_clip_save_seconds", "Time to write a clip from its segments")
+_clips_total = metrics.counter("motion_clips_total", "Clips saved, by result")
+_clip_bytes_total = metrics.counter("motion_clip_bytes_total", "Bytes of clips saved")
+_queue_depth = metrics.gauge("motion_queue_depth", "Finished segments waiting to be analyzed")
+_lag_secs = metrics.gauge("motion_lag_seconds", "How long ago the segment being analyzed finished recording")
+clock = NetworkClock()
+
+def ensure_space_for_video(new_video_path: Path, clip_dir, evict=None):
+    """If SD card is too full, delete the new video to prevent overflow. evict() is tried first if given (e.g. dropping pre-roll)."""
     try:
         stat = shutil.disk_usage(clip_dir)
         free_space = stat.free
 
+        if free_space < MIN_FREE_SPACE and evict is not None and evict():
+            free_space = shutil.disk_usage(clip_dir).free
+
         if free_space < MIN_FREE_SPACE:
             logging.warning(
                 f"Low disk space ({free_space / (1024**2):.1f} MB free). Deleting {new_video_path.name}"
@@ -62,37 +110,70 @@ def ensure_space_for_video(new_video_path: Path, clip_dir):
         logging.error(f"Error checking disk space: {e}")
         return False
 
-def extract_sample_frames(input_path, tmp_dir):
-    """Efficiently extract sample frames directly from .h264 via ffmpeg pipe."""
-    logging.debug(f"Extracting sample frames (optimized) from {input_path}")
-    vf_filter = f"scale={LQ_WIDTH}:{LQ_HEIGHT},format=yuv420p"
-    output_pattern = os.path.join(tmp_dir, "frame_%04d.jpg")
+def _read_frames_into(stream, frames):
+    """Fill a preallocated (N, H, W) uint8 buffer from a raw gray stream, growing it if needed."""
+    frame_bytes = LQ_WIDTH * LQ_HEIGHT
+    n = 0
+    while True:
+        if n == len(frames):
+            frames = np.concatenate([frames, np.empty_like(frames)])
+        view = memoryview(frames[n].reshape(-1))
+        got = 0
+        while got < frame_bytes:
+            read = stream.readinto(view[got:])
+            if not read:
+                break
+            got += read
+        if got < frame_bytes:
+            if got:
+                logging.warning(f"Dropping partial frame ({got}/{frame_bytes} bytes)")
+            return frames[:n]
+        n += 1
+
+def extract_sample_frames(input_path, tmp_dir=None, backend=None):
+    """
+    Decode just the keyframes of a .h264 segment straight into a (N, LQ_HEIGHT, LQ_WIDTH) uint8 array.
+    ffmpeg writes raw gray frames to its stdout, so there are no temp files or jpeg encode/decode.
+    backend defaults to the one picked at startup (see DECODE_BACKEND).
+    tmp_dir is unused and only kept so older callers still work.
+    """
+    backend = backend or _backend
+    logging.debug(f"Extracting sample frames (raw pipe, {backend}) from {input_path}")
+    if backend == "stub":
+        with open(input_path, "rb") as f:
+            return np.zeros((len(keyframe_offsets(f.read())), LQ_HEIGHT, LQ_WIDTH), dtype=np.uint8)
+    input_args, vf_filter = decode_args(backend, LQ_WIDTH, LQ_HEIGHT)
     cmd = [
         "ffmpeg", "-hide_banner", 
         "-loglevel", "warning",
-        "-skip_frame", "nokey", # efficiently extract just the keyframes
+        *input_args,
         "-i", input_path,
         "-vf", vf_filter,
         "-fps_mode", "vfr",
-        "-q:v", "4",              # JPEG quality
-        "-y", output_pattern
+        "-f", "rawvideo",
+        "-pix_fmt", "gray",
+        "pipe:1"
     ]
 
-    # logging.debug(cmd)
-
-    subprocess.run(cmd, check=True)
-
-    # Read frames back into memory
-    frames = []
-    for file in os.listdir(tmp_dir):
-        path = os.path.join(tmp_dir, file)
-        frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-        if frame is not None:
-            frames.append(frame)
-        os.remove(path) #hopefully not a mistake?
+    frames = np.empty((FRAME_BUFFER_SIZE, LQ_HEIGHT, LQ_WIDTH), dtype=np.uint8)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        frames = _read_frames_into(process.stdout, frames)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        if backend != "software":
+            logging.warning(f"{backend} decode of {input_path} failed with {returncode}, retrying in software")
+            return extract_sample_frames(input_path, backend="software")
+        raise subprocess.CalledProcessError(returncode, cmd)
     logging.debug(f"generated/read {len(frames)} frames")
     return frames
 
+def score_frames(frames, pixel_thresh=PIXEL_THRESHOLD):
+    """Per-pair changed-pixel ratios for a segment's keyframes (see motion_scoring.MotionScorer)."""
+    return _scorer.score(frames, pixel_thresh)
+
 def detect_motion(frames, pixel_thresh=PIXEL_THRESHOLD, change_ratio=CHANGE_RATIO):
     """
     Detect motion based on % of pixels with large changes between frames.
@@ -103,67 +184,136 @@ def detect_motion(frames, pixel_thresh=PIXEL_THRESHOLD, change_ratio=CHANGE_RATI
     if len(frames) < 2:
         logging.warning(f"not enough frames, only {len(frames)} of them")
         return False
-    
-    # frames = [cv2.resize(f, (0,0), fx=0.25, fy=0.25) for f in frames] # no longer needed
-    frames = [cv2.GaussianBlur(f, (7,7), 0) for f in frames]
-
-    total_pixels = frames[0].size
-    # logging.info(f"total pixels {total_pixels}")
-    ratios = []
-
-    for a, b in zip(frames, frames[1:]):
-        diff = cv2.absdiff(a, b)
-        motion_mask = diff > pixel_thresh
-        ratio = np.count_nonzero(motion_mask) / total_pixels
-        ratios.append(ratio)
-    logging.info(f"ratios: {[f'{ratio:0.3f}, ' for ratio in ratios]}")
-    ratios = [ratio for ratio in ratios if ratio < 0.90] # Remove noisy light issues?
-    if len(ratios) == 0:
-        return True # todo: this isn't the best way to handle all of this, but this handles the edge case if all of the ratios are extremely large. 
-    logging.info(f"cleaned ratios: {[f'{ratio:0.3f}, ' for ratio in ratios]}")
-    avg_ratio = np.mean(ratios)
-    logging.info(f"motion pixel ratio: {avg_ratio:.6f}")
-    return avg_ratio > change_ratio
-
-def get_timestamp():
-    """
-    Sends a HEAD request to Google and extracts the HTTP Date header.
-    Converts the result to America/Denver.
-    Returns a timezone-aware datetime if successful, otherwise None.
-    """
-    try:
-        resp = requests.head("https://www.google.com", timeout=3)
-        resp.raise_for_status()
 
-        date_header = resp.headers.get("Date")
-        if not date_header:
-            return None
+    ratios = score_frames(frames, pixel_thresh)
+    if sample_log("ratios"):
+        logging.debug(f"ratios: {[f'{ratio:0.3f}' for ratio in ratios]}")
+    return motion_from_ratios(ratios, change_ratio)
 
-        # Parse RFC 2822 date header → UTC datetime
-        dt_utc = email.utils.parsedate_to_datetime(date_header)
+def extract_sample_frames_software(input_path):
+    """Fallback for a persistent decoder whose segment failed: one ffmpeg, without any hardware in the way."""
+    return extract_sample_frames(input_path, backend="stub" if _backend == "stub" else "software")
 
-        # Convert to Denver
-        timezone = ZoneInfo("America/Denver")
-        dt_tz = dt_utc.astimezone(timezone)
+def make_segment_decoder():
+    return SegmentDecoder(LQ_WIDTH, LQ_HEIGHT, fallback=extract_sample_frames_software, backend=_backend)
 
-        formatted = dt_tz.strftime("%Y%m%d-%H%M%S")
-        return formatted
+def segment_frames(seg_path, decoder=None, tmp_dir=None):
+    """A segment's keyframes, as a (N, LQ_HEIGHT, LQ_WIDTH) array."""
+    with _decode_secs.time():
+        return decoder.extract(seg_path) if decoder else extract_sample_frames(seg_path, tmp_dir=tmp_dir)
 
-    except Exception:
-        return None
+def frames_ratios(frames, detector=None):
+    """Per-pair motion ratios for a segment's keyframes, from the configured detector."""
+    detector = detector or _detector
+    if len(frames) < 2:
+        logging.warning(f"not enough frames, only {len(frames)} of them")
+        if len(frames):
+            detector.ratios(frames) # a stateful detector still learns from the frame
+        return []
+    with _score_secs.time():
+        ratios = detector.ratios(frames)
+    if sample_log("ratios"):
+        logging.debug(f"ratios: {[f'{ratio:0.3f}' for ratio in ratios]}")
+    return ratios
+
+def segment_ratios(seg_path, decoder=None, tmp_dir=None, detector=None):
+    """
+    Per-pair motion ratios for a segment, from its live-motion sidecar or else by decoding its keyframes.
+    Live sidecars are whole-frame differences, so they're only used with the "diff" detector and no ROI.
+    """
+    seg = os.path.basename(seg_path)
+    if DETECTOR == "diff" and _region is None:
+        ratios = read_motion_sidecar(seg_path, PIXEL_THRESHOLD)
+        if ratios is not None:
+            logging.debug(f"Using live motion ratios for {seg}")
+            _reused_total.inc(source="sidecar")
+            return ratios
+    return frames_ratios(segment_frames(seg_path, decoder, tmp_dir), detector)
+
+_worker_decoder = None
+
+def _init_analysis_worker():
+    global _worker_decoder
+    metrics.REGISTRY.drain() # a forked worker starts with the parent's counts; only send back its own
+    if USE_PERSISTENT_DECODER:
+        _worker_decoder = make_segment_decoder()
+
+def _segment_ratios_in_worker(seg_path, tmp_dir):
+    """(ratios, or frames for a stateful detector, and this worker's metrics to merge into the parent's)"""
+    if _detector.stateful:
+        # the detector's state has to see segments in order, so only decode here and score in the parent
+        result = segment_frames(seg_path, decoder=_worker_decoder, tmp_dir=tmp_dir)
+    else:
+        result = segment_ratios(seg_path, decoder=_worker_decoder, tmp_dir=tmp_dir)
+    return result, metrics.REGISTRY.drain()
+
+class SegmentAnalyzer:
+    """
+    Scores segments either in this process (workers=1) or on a pool of worker processes, each with its own
+    decoder, so several segments can be decoded and scored at once. submit() hands back a ticket and
+    result(ticket) its (ratios, motion); the caller collects them in submission order. Ratios come from the
+    motion index when the segment was scored before, and new ones are indexed, always from this process.
+    """
+    def __init__(self, workers=1, tmp_dir=None, index=None):
+        self.tmp_dir = tmp_dir
+        self.index = index
+        self.pool = None
+        self.decoder = None
+        if workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_analysis_worker)
+        elif USE_PERSISTENT_DECODER:
+            self.decoder = make_segment_decoder()
+
+    def submit(self, seg_path):
+        if self.index:
+            ratios = self.index.lookup(seg_path, PIXEL_THRESHOLD, SCORING_KEY)
+            if ratios is not None:
+                logging.debug(f"Using indexed motion ratios for {os.path.basename(seg_path)}")
+                _reused_total.inc(source="index")
+                return seg_path, ratios, True
+        if self.pool:
+            return seg_path, self.pool.submit(_segment_ratios_in_worker, seg_path, self.tmp_dir), False
+        return seg_path, None, False # scored in this process when its result is asked for
+
+    def result(self, ticket):
+        seg_path, ratios, from_index = ticket
+        if ratios is None:
+            ratios = segment_ratios(seg_path, decoder=self.decoder, tmp_dir=self.tmp_dir)
+        elif isinstance(ratios, Future):
+            ratios, worker_metrics = ratios.result()
+            metrics.REGISTRY.merge(worker_metrics)
+            if _detector.stateful: # the worker sent back frames
+                ratios = frames_ratios(ratios)
+        motion = len(ratios) > 0 and motion_from_ratios(ratios, CHANGE_RATIO)
+        _segments_total.inc(motion=str(bool(motion)).lower())
+        if self.index and not from_index:
+            self.index.record(seg_path, ratios, motion, PIXEL_THRESHOLD, SCORING_KEY)
+        return ratios, motion
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+        if self.decoder:
+            self.decoder.close()
+
+def get_segment_start_time(seg_path):
+    """When a segment started recording (epoch secs, network-corrected): its mtime is when it finished."""
+    return clock.from_system_time(os.path.getmtime(seg_path) - SEGMENT_SECS)
 
 def get_output_file_name(segments, 
                          motion_group_id=None, 
-                         additional_note=None):
+                         additional_note=None,
+                         container=CLIP_CONTAINER,
+                         start_offset=0):
     if (len(segments)) == 0:
         return None
     first_clip_number = os.path.basename(segments[0]).replace('segment_', '').replace('.h264','')
 
     clip_id = f"clipId{first_clip_number}-{uuid.uuid1().hex[:5]}"
 
-    timestampstr = get_timestamp()
+    timestampstr = clock.timestamp(get_segment_start_time(segments[0]) + start_offset)
     
-    output_file_name = f"{DEVICE_ID}_{timestampstr}_{clip_id}_{additional_note}_{motion_group_id}.mp4"
+    output_file_name = f"{DEVICE_ID}_{timestampstr}_{clip_id}_{additional_note}_{motion_group_id}.{container}"
 
     return output_file_name
 
@@ -171,12 +321,36 @@ def get_output_file_name(segments,
 def save_clip(segments,  
               clip_dir, 
               tmp_dir, 
-              output_clip_name):
-    """Concatenate motion segments into a single mp4 clip."""
+              output_clip_name,
+              ranges=None,
+              metadata=None):
+    """
+    Concatenate motion segments into a single clip, in the container output_clip_name's extension says.
+    ranges ({segment: (start byte, end byte)}, see plan_trim) trims h264 clips. metadata is written next to the clip.
+    """
     if not segments:
         return
     
+    save_start = time.perf_counter()
     clip_path = os.path.join(clip_dir, output_clip_name)
+    if metadata is not None:
+        # before the clip shows up, so the uploader always finds it
+        with open(clip_path + CLIP_METADATA_SUFFIX, "w") as f:
+            json.dump(metadata, f)
+
+    if clip_path.endswith(".h264"):
+        try:
+            logging.info(f"Appending {len(ranges) if ranges else len(segments)} segments → {clip_path}")
+            append_segments(segments, clip_path + ".part", ranges)
+            os.replace(clip_path + ".part", clip_path)
+            logging.info(f"✅ Saved clip: {clip_path}")
+            _clip_saved(clip_path, save_start)
+            for s in segments:
+                remove_segment(s)
+        except Exception as e:
+            logging.exception(f"Error while saving clip: {e}")
+            _clips_total.inc(result="failed")
+        return
 
     try:
         with open(os.path.join(tmp_dir, "segments.txt"), "w") as f:
@@ -185,28 +359,118 @@ def save_clip(segments,
 
         logging.info(f"Creating clip from {len(segments)} segments → {clip_path}")
 
+        # written under a temporary name and renamed into place, so the clip dir only ever has whole clips
         result = subprocess.run([
             "ffmpeg", "-f", "concat", "-safe", "0",
             "-i", os.path.join(tmp_dir, "segments.txt"), "-c", "copy",
-            clip_path, "-y"
+            "-f", "mp4", clip_path + ".part", "-y"
         ], capture_output=True, text=True)
 
         if result.returncode == 0:
+            os.replace(clip_path + ".part", clip_path)
             logging.info(f"✅ Saved clip: {clip_path}")
+            _clip_saved(clip_path, save_start)
             for s in segments:
-                os.remove(s)
+                remove_segment(s)
                 logging.debug(f"Deleted processed segment: {s}")
         else:
             logging.error(f"FFmpeg failed: {result.stderr}")
+            _clips_total.inc(result="failed")
 
     except Exception as e:
         logging.exception(f"Error while saving clip: {e}")
+        _clips_total.inc(result="failed")
+
+def _clip_saved(clip_path, save_start):
+    _clip_save_secs.observe(time.perf_counter() - save_start)
+    _clips_total.inc(result="saved")
+    _clip_bytes_total.inc(os.path.getsize(clip_path))
+
+
+def append_segments(segments, out_path, ranges=None):
+    """
+    Write the segments one after another into out_path, copying in the kernel rather than through Python.
+    With ranges, only each segment's (start, end) bytes are written, and segments without a range are skipped.
+    """
+    with open(out_path, "wb") as out:
+        for s in segments:
+            if ranges is not None and s not in ranges:
+                continue
+            with open(s, "rb") as f:
+                offset, end = ranges[s] if ranges is not None else (0, os.fstat(f.fileno()).st_size)
+                while offset < end:
+                    sent = os.sendfile(out.fileno(), f.fileno(), offset, end - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
 
 
-def clear_buffer_dir(buffer_dir, old_buffer_dir):
+def plan_trim(segments, keep_start, keep_end):
+    """
+    Byte ranges of the segments that cover keep_start..keep_end seconds of their combined timeline, widened
+    out to keyframes so the trimmed stream still decodes. Keyframes are KEYFRAME_SECS apart from the start of
+    each SEGMENT_SECS segment. Returns ({segment: (start byte, end byte)}, kept start secs, kept end secs).
+    """
+    ranges = {}
+    kept_start = kept_end = None
+    for i, seg in enumerate(segments):
+        seg_start, seg_end = i * SEGMENT_SECS, (i + 1) * SEGMENT_SECS
+        if seg_end <= keep_start or seg_start >= keep_end:
+            continue
+        start_byte, end_byte = 0, os.path.getsize(seg)
+        lo, hi = seg_start, seg_end
+        if keep_start > seg_start or keep_end < seg_end:
+            with open(seg, "rb") as f:
+                cuts = keyframe_cut_offsets(f.read())
+            if cuts:
+                if keep_start > seg_start:
+                    k = min(int((keep_start - seg_start) // KEYFRAME_SECS), len(cuts) - 1)
+                    start_byte, lo = (cuts[k] if k > 0 else 0), seg_start + k * KEYFRAME_SECS
+                if keep_end < seg_end:
+                    k = math.ceil((keep_end - seg_start) / KEYFRAME_SECS)
+                    if k < len(cuts):
+                        end_byte, hi = cuts[k], seg_start + k * KEYFRAME_SECS
+        ranges[seg] = (start_byte, end_byte)
+        kept_start = lo if kept_start is None else kept_start
+        kept_end = hi
+    return ranges, kept_start, kept_end
+
+
+def remove_segment(seg_path):
+    """Delete a buffered segment along with its live-motion sidecar, if it has one."""
+    os.remove(seg_path)
+    if os.path.exists(seg_path + MOTION_SIDECAR_SUFFIX):
+        os.remove(seg_path + MOTION_SIDECAR_SUFFIX)
+
+def current_session_segments(buffer_dir):
+    """
+    Files written by the capture run that's still going: walking back from now, everything until the
+    first gap of more than SESSION_GAP_SECS between files. Older ones are from a previous capture run,
+    whose segment numbers would collide with (and sort among) the new ones.
+    """
+    files = sorted(os.listdir(buffer_dir), key=lambda f: os.path.getmtime(os.path.join(buffer_dir, f)), reverse=True)
+    current = set()
+    newer_mtime = time.time()
+    for f in files:
+        mtime = os.path.getmtime(os.path.join(buffer_dir, f))
+        if newer_mtime - mtime > SESSION_GAP_SECS:
+            break
+        current.add(f)
+        newer_mtime = mtime
+    return current
+
+def clear_buffer_dir(buffer_dir, old_buffer_dir, keep_current_session=False):
+    """
+    Move old segments out of the buffer before starting. With keep_current_session, segments from the
+    ongoing capture run stay put so a restarted post-processor resumes on them (using the motion index).
+    """
     logging.info("Removing segments")
     segments = os.listdir(buffer_dir)
+    keep = current_session_segments(buffer_dir) if keep_current_session else set()
     for segment in segments:
+        if segment in keep:
+            logging.info(f"Keeping segment {segment} from the current capture session")
+            continue
         if "segment_000000.h264" in segment or "segment_000001.h264" in segment:
             logging.info(f"Skipping segment {segment} for removal")
             continue #Skip the first currently-recorded videos. 
@@ -222,79 +486,247 @@ def get_motion_group_id_if_not_exist(motion_group_id):
     else:
         return motion_group_id
 
-def run_motion_process_for_buffer(buffer_dir, clip_dir, tmp_dir):
-    motion_group = []
-    processed_segments = set()
-    motion_run_continuation = False
-    motion_group_id = ""
+class PipelineStats:
+    """
+    Queue depth (finished segments waiting to be scored) and processing lag (how long ago the segment
+    being processed finished recording) of the motion pipeline. Logged every STATS_LOG_INTERVAL and on
+    catching up, and written as json to status_path if given.
+    """
+    def __init__(self, status_path=None):
+        self.status_path = status_path
+        self.queue_depth = 0
+        self.lag_secs = 0.0
+        self.processed = 0
+        self.backlog_started = None
+        self.last_report = 0.0
+
+    def segment_started(self, seg_path, queue_depth):
+        self.queue_depth = queue_depth
+        self.lag_secs = max(0.0, time.time() - os.path.getmtime(seg_path))
+        _queue_depth.set(queue_depth)
+        _lag_secs.set(round(self.lag_secs, 3))
+        if self.backlog_started is None and queue_depth > 0:
+            self.backlog_started = time.monotonic()
+            self.processed = 0
+            logging.info(f"Working through a backlog of {queue_depth + 1} segments, {self.lag_secs:.0f}s behind")
+        self.processed += 1
+        if time.monotonic() - self.last_report >= STATS_LOG_INTERVAL:
+            logging.info(f"Queue depth {self.queue_depth}, processing lag {self.lag_secs:.1f}s")
+            self._write_status()
+
+    def caught_up(self):
+        if self.backlog_started is not None:
+            elapsed = time.monotonic() - self.backlog_started
+            logging.info(f"Caught up: {self.processed} segments in {elapsed:.1f}s ({self.processed / max(elapsed, 1e-6):.2f}/s)")
+            self.backlog_started = None
+        self.queue_depth = 0
+        _queue_depth.set(0)
+        self._write_status()
+
+    def _write_status(self):
+        self.last_report = time.monotonic()
+        if not self.status_path:
+            return
+        status = {"time": time.time(), "queue_depth": self.queue_depth, "lag_secs": round(self.lag_secs, 3)}
+        with open(self.status_path + ".tmp", "w") as f:
+            json.dump(status, f)
+        os.replace(self.status_path + ".tmp", self.status_path)
+
+def roll_segments(secs):
+    """Whole segments needed to cover secs of pre/post-roll."""
+    return math.ceil(secs / SEGMENT_SECS)
+
+class MotionGrouper:
+    """
+    Groups consecutive motion segments into clips: the group is saved once a still segment comes along,
+    or flushed early as an IN_PROGRESS clip once it's longer than FLUSH_N_CLIPS.
+    Segments have to be added in recording order.
+
+    Still segments aren't deleted right away: the last pre_roll of them are kept in a ring and lead into the
+    next clip, and the first post_roll after motion are added to the end of it, so clips include some context.
+    Disk use stays bounded by the ring, which evict() empties when space runs low.
+    """
+    def __init__(self, clip_dir, tmp_dir, container=CLIP_CONTAINER,
+                 pre_roll=roll_segments(PRE_ROLL_SECS), post_roll=roll_segments(POST_ROLL_SECS),
+                 flush_n=FLUSH_N_CLIPS, change_ratio=CHANGE_RATIO):
+        self.clip_dir = clip_dir
+        self.tmp_dir = tmp_dir
+        self.container = container
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.flush_n = flush_n
+        self.change_ratio = change_ratio
+        self.ring = deque() # the most recent still segments, oldest first
+        self.scores = {} # segment -> (ratios, motion) until it's saved or evicted
+        self.post_roll_left = 0
+        self.motion_group = []
+        self.motion_run_continuation = False
+        self.motion_group_id = "" # shared by the IN_PROGRESS clips and the FINAL one of a motion run
+        self.group_part = 0 # how many clips of the run have been saved
+
+    def add(self, seg_path, motion, ratios=None):
+        seg = os.path.basename(seg_path)
+        self.scores[seg_path] = (ratios, motion)
+        if motion:
+            if not self.motion_group and self.ring:
+                logging.debug(f"Starting the motion group with {len(self.ring)} pre-roll segments")
+                self.motion_group.extend(self.ring)
+                self.ring.clear()
+            logging.debug(f"Adding segment {seg} to the motion group")
+            self.motion_group.append(seg_path)
+            self.post_roll_left = self.post_roll
+            self._flush_if_long()
+        elif self.motion_group and self.post_roll_left > 0:
+            logging.debug(f"Adding segment {seg} to the motion group as post-roll")
+            self.motion_group.append(seg_path)
+            self.post_roll_left -= 1
+            if self.post_roll_left == 0:
+                self._save_group()
+            else:
+                self._flush_if_long()
+        else:
+            self._save_group()
+            self._keep_as_pre_roll(seg_path)
+
+    def _flush_if_long(self):
+        if len(self.motion_group) > self.flush_n:
+            logging.debug(f"Flushing all current motion group segments to a clip despite motion being detected")
+            self._save(self.motion_group[:-1], IN_PROGRESS)
+            self.motion_group = [self.motion_group[-1]] # motion_group = [seg_path] #note that this prioritizes cohesive video viewing over later recompilation into one big video. Think about changing later todo
+            self.motion_run_continuation = True
+
+    def _save_group(self):
+        if not self.motion_group:
+            return
+        logging.debug(f"Saving all current motion group segments to a clip")
+        self._save(self.motion_group, FINAL if self.motion_run_continuation else None)
+        self.motion_group = []
+        self.motion_run_continuation = False
+        self.post_roll_left = 0
+        self.motion_group_id = "" # the next run gets its own
+        self.group_part = 0
+
+    def _motion_intervals(self, segments):
+        """Motion (start, end) secs across the segments' combined timeline, from their per-keyframe ratios."""
+        intervals = []
+        for i, seg_path in enumerate(segments):
+            ratios, motion = self.scores.get(seg_path, (None, False))
+            if not motion:
+                continue
+            seg_intervals = motion_intervals(ratios, self.change_ratio, SEGMENT_SECS, KEYFRAME_SECS) if ratios is not None else []
+            if not seg_intervals: # motion without a timeline, e.g. every pair was too noisy to trust
+                seg_intervals = [(0, SEGMENT_SECS)]
+            # the stretch between one segment's last keyframe and the next one's first isn't scored, so bridge it
+            gap = max(0, SEGMENT_SECS - len(ratios) * KEYFRAME_SECS) if ratios is not None else 0
+            for j, (start, end) in enumerate(seg_intervals):
+                start, end = start + i * SEGMENT_SECS, end + i * SEGMENT_SECS
+                if intervals and start - intervals[-1][1] <= (gap if j == 0 else 0) + 1e-6:
+                    intervals[-1][1] = end
+                else:
+                    intervals.append([start, end])
+        return intervals
+
+    def _save(self, segments, additional_note):
+        """
+        Save segments as a clip. h264 clips are trimmed to their motion plus TRIM_PAD_SECS, except at the
+        edges where the motion run carries on into the previous/next clip of the group.
+        """
+        intervals = self._motion_intervals(segments)
+        ranges = None
+        kept_start, kept_end = 0, len(segments) * SEGMENT_SECS
+        if TRIM_CLIPS and self.container == "h264" and intervals:
+            keep_start = 0 if self.motion_run_continuation else max(0, intervals[0][0] - TRIM_PAD_SECS)
+            keep_end = kept_end if additional_note == IN_PROGRESS else intervals[-1][1] + TRIM_PAD_SECS
+            ranges, kept_start, kept_end = plan_trim(segments, keep_start, keep_end)
+            logging.debug(f"Trimmed clip to {kept_start:.1f}-{kept_end:.1f}s of {len(segments) * SEGMENT_SECS}s")
+        self.motion_group_id = get_motion_group_id_if_not_exist(self.motion_group_id)
+        metadata = {
+            "group_part": self.group_part, # where the clip goes in its motion run, for the server to put them back together
+            "duration": round(kept_end - kept_start, 2),
+            "motion_intervals": [[round(max(start, kept_start) - kept_start, 2), round(min(end, kept_end) - kept_start, 2)]
+                                 for start, end in intervals if end > kept_start and start < kept_end],
+        }
+        output_clip_name = get_output_file_name(segments,
+                                                motion_group_id=self.motion_group_id,
+                                                additional_note=additional_note,
+                                                container=self.container,
+                                                start_offset=kept_start)
+        save_clip(segments, 
+                  clip_dir=self.clip_dir, 
+                  tmp_dir=self.tmp_dir,
+                  output_clip_name=output_clip_name,
+                  ranges=ranges,
+                  metadata=metadata)
+        for seg_path in segments:
+            self.scores.pop(seg_path, None)
+        self.group_part += 1
+
+    def _keep_as_pre_roll(self, seg_path):
+        self.ring.append(seg_path)
+        while len(self.ring) > self.pre_roll:
+            old = self.ring.popleft()
+            self._discard(old)
+            logging.debug(f"Removed non-motion segment: {old}")
+
+    def _discard(self, seg_path):
+        """A still segment that won't be in any clip."""
+        self.scores.pop(seg_path, None)
+        remove_segment(seg_path)
+
+    def evict(self):
+        """Delete the buffered pre-roll to free space. Returns how many segments were removed."""
+        evicted = len(self.ring)
+        while self.ring:
+            self._discard(self.ring.popleft())
+        if evicted:
+            logging.warning(f"Evicted {evicted} pre-roll segments to free space")
+        return evicted
+
+def run_motion_process_for_buffer(buffer_dir, clip_dir, tmp_dir, index_path=None, status_path=None, workers=ANALYSIS_WORKERS,
+                                  clip_container=CLIP_CONTAINER, metrics_path=None, metrics_port=None):
+    metrics.expose(metrics_path, metrics_port)
+    index = MotionIndex(index_path) if index_path else None
+    if index:
+        index.prune()
+    clock.start()
+    analyzer = SegmentAnalyzer(workers, tmp_dir=tmp_dir, index=index)
+    grouper = MotionGrouper(clip_dir, tmp_dir, container=clip_container)
+    # hands out each segment once rpicam-vid has closed it (it's still writing the newest one)
+    watcher = FileWatcher(buffer_dir, ".h264", newest_may_be_open=True, poll_interval=SLEEP_INTERVAL) #assumes a sortable order
+    stats = PipelineStats(status_path)
+    backlog = []
+    in_flight = deque() # segments being analyzed, in recording order
+    # no sleeps: work through whatever is waiting at full speed, and only block on the watcher once caught up
     while True:
         try:
-            segments = sorted(os.listdir(buffer_dir)) #assumes a sortable order
-            # Skip already processed
-            segments = [s for s in segments if s not in processed_segments]
-            if not segments:
-                logging.debug("No available segments to process, sleeping")
-                time.sleep(SLEEP_INTERVAL)
-                continue
-
-            for i, seg in enumerate(segments):
-                logging.debug(f"Processing segment #{i}, {seg}")
-                seg_path = os.path.join(buffer_dir, seg)
-                # Always skip last one (may still be writing)
-                if i == (len(segments) - 1):
-                    logging.debug("Reached the end of the segments")
-                    time.sleep(SLEEP_INTERVAL)
-                    break
-
-                if not ensure_space_for_video(Path(seg_path), clip_dir=clip_dir):
+            if not backlog:
+                backlog = watcher.next_batch(timeout=0)
+            if not backlog and not in_flight:
+                stats.caught_up()
+                backlog = watcher.next_batch()
+
+            # keep the workers busy with the next few segments while this process groups them in order
+            while backlog and len(in_flight) < 2 * workers:
+                seg_path = backlog.pop(0)
+                logging.debug(f"Processing segment {os.path.basename(seg_path)}")
+                watcher.refresh()
+                stats.segment_started(seg_path, queue_depth=len(backlog) + len(watcher))
+
+                if not ensure_space_for_video(Path(seg_path), clip_dir=clip_dir, evict=grouper.evict):
                     logging.warning("Not enough space, new file deleted")
-                    time.sleep(SLEEP_INTERVAL)
-                    break
-
-                frames = extract_sample_frames(seg_path, tmp_dir=tmp_dir)
-                motion = detect_motion(frames)
-                if motion:
-                    logging.debug(f"Adding segment #{i}, {seg} to the motion group")
-                    motion_group.append(seg_path)
-                    if len(motion_group) > FLUSH_N_CLIPS:
-                        logging.debug(f"Flushing all current motion group segments to a clip despite motion being detected")
-                        motion_group_to_save = motion_group[:-1]
-                        output_clip_name = get_output_file_name(motion_group_to_save,
-                                                                motion_group_id=get_motion_group_id_if_not_exist(motion_group_id),
-                                                                additional_note=IN_PROGRESS)
-                        save_clip(motion_group_to_save, 
-                                  clip_dir=clip_dir, 
-                                  tmp_dir=tmp_dir,
-                                  output_clip_name=output_clip_name)
-                        motion_group = [motion_group[-1]] # motion_group = [seg_path] #note that this prioritizes cohesive video viewing over later recompilation into one big video. Think about changing later todo
-                        motion_run_continuation = True
-                else:
-                    logging.debug(f"Saving all current motion group segments to a clip")
-                    if motion_run_continuation:
-                        output_clip_name = get_output_file_name(motion_group,
-                                                                motion_group_id=get_motion_group_id_if_not_exist(motion_group_id),
-                                                                additional_note=FINAL)
-                        save_clip(motion_group, 
-                                  clip_dir=clip_dir, 
-                                  tmp_dir=tmp_dir, 
-                                  output_clip_name=output_clip_name)
-                    else:
-                        output_clip_name = get_output_file_name(motion_group,
-                                                                motion_group_id=get_motion_group_id_if_not_exist(motion_group_id),
-                                                                additional_note=None)
-                        save_clip(motion_group, 
-                                  clip_dir=clip_dir, 
-                                  tmp_dir=tmp_dir, 
-                                  output_clip_name=output_clip_name)
-                    motion_group = []
-                    os.remove(seg_path)
-                    logging.debug(f"Removed non-motion segment: {seg_path}")
-                    motion_run_continuation = False
-                
-                processed_segments.add(seg)
-                time.sleep(0.3)
-            first_run = False
-            time.sleep(SLEEP_INTERVAL)
+                    continue
+                in_flight.append(analyzer.submit(seg_path))
+
+            if in_flight:
+                ticket = in_flight.popleft()
+                try:
+                    ratios, motion = analyzer.result(ticket)
+                except Exception as e:
+                    # it's off the in-flight list now, so it has to go through the grouper as still or it's never deleted
+                    logging.exception(f"Couldn't score {os.path.basename(ticket[0])}, treating it as still: {e}")
+                    _segments_total.inc(motion="error")
+                    ratios, motion = None, False
+                grouper.add(ticket[0], motion, ratios)
 
         except Exception as e:
             logging.exception(f"Main loop error: {e}")
@@ -6,6 +6,9 @@ BUFFER_DIR = f"{TARGET_DIR}/videos/buffer"
 OLD_BUFFER_DIR = f"{TARGET_DIR}/videos/buffer_old"
 TMP_DIR = f"{TARGET_DIR}/videos/tmp"
 CLIP_DIR = f"{TARGET_DIR}/videos/clips"
+INDEX_PATH = f"{TARGET_DIR}/videos/motion_index.sqlite"
+STATUS_PATH = f"{TARGET_DIR}/videos/motion_status.json"
+METRICS_PATH = f"{TARGET_DIR}/videos/metrics/motion.prom" # Prometheus text format, for node_exporter's textfile collector
 
 os.makedirs(CLIP_DIR, exist_ok=True)
 os.makedirs(BUFFER_DIR, exist_ok=True)
@@ -15,7 +18,11 @@ os.makedirs(TMP_DIR, exist_ok=True)
 
 if __name__ == "__main__":
     clear_buffer_dir(buffer_dir=BUFFER_DIR,
-                     old_buffer_dir=OLD_BUFFER_DIR)
+                     old_buffer_dir=OLD_BUFFER_DIR,
+                     keep_current_session=True)
     run_motion_process_for_buffer(buffer_dir=BUFFER_DIR,
                                   clip_dir=CLIP_DIR,
-                                  tmp_dir=TMP_DIR)
\ No newline at end of file
+                                  tmp_dir=TMP_DIR,
+                                  index_path=INDEX_PATH,
+                                  status_path=STATUS_PATH,
+                                  metrics_path=METRICS_PATH)
\ No newline at end of file
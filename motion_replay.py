@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Offline calibration for the motion pipeline, instead of tuning by hand in the notebooks. Replays recorded
+segments through keyframe extraction -> detection -> clip grouping as fast as they'll go (no sleeps, and
+nothing is written to clip_dir or deleted), sweeping PIXEL_THRESHOLD, CHANGE_RATIO and FLUSH_N_CLIPS in
+parallel. Reports throughput, per-stage latency and, given labels, precision/recall for each combination:
+    python3 motion_replay.py /home/piuser/videos/buffer_old --labels labels.json --store ~/frame_store \\
+        --pixel-thresh 8 10 15 --change-ratio 0.003 0.006 0.01 --flush-n 2 3 5 --workers 4
+    python3 motion_replay.py --synthetic 400 --detectors diff background
+
+Decoding is by far the slowest stage, so decoded keyframes go into a frame store: one flat uint8 file,
+memory-mapped when replaying, plus an index of where each segment's frames are. Segments already in the
+store (same size and mtime) aren't decoded again, so after the first run a sweep only costs detection;
+only the decode phase's workers start a keyframe decoder. Logging is kept to warnings: the pipeline's
+per-segment ratio lines are sampled at DEBUG (motion_scoring.sample_log) and wouldn't show anyway.
+Labels are a JSON file of {"segment_000123.h264": true/false} (has motion).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import motion_postprocess_lib as lib
+from motion_scoring import DETECTORS, make_detector, load_region, motion_from_ratios
+from benchmark_motion import find_segments, load_labels, synthetic_footage
+
+FRAMES_FILE = "frames.u8"
+INDEX_FILE = "index.json"
+
+
+class FrameStore:
+    """
+    Decoded keyframes of many segments in one append-only file, read back through a memmap.
+    A segment whose file changed is decoded again and appended; the old copy is dead space until --rebuild.
+    """
+    def __init__(self, path, rebuild=False):
+        self.path = path
+        self.frame_shape = (lib.LQ_HEIGHT, lib.LQ_WIDTH)
+        os.makedirs(path, exist_ok=True)
+        self.index = {}
+        index_path = os.path.join(path, INDEX_FILE)
+        if not rebuild and os.path.exists(index_path):
+            with open(index_path) as f:
+                stored = json.load(f)
+            if tuple(stored["frame_shape"]) == self.frame_shape:
+                self.index = stored["segments"]
+        if not self.index:
+            open(os.path.join(path, FRAMES_FILE), "wb").close()
+        self._memmap = None
+
+    @staticmethod
+    def _stamp(seg_path):
+        stat = os.stat(seg_path)
+        return [stat.st_size, stat.st_mtime]
+
+    def missing(self, seg_paths):
+        """The segments that aren't in the store, or changed since they were decoded."""
+        return [seg for seg in seg_paths
+                if seg not in self.index or self.index[seg]["stamp"] != self._stamp(seg)]
+
+    def add(self, key, frames, stamp=None):
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        with open(os.path.join(self.path, FRAMES_FILE), "ab") as f:
+            start = f.tell() // (self.frame_shape[0] * self.frame_shape[1])
+            f.write(frames.tobytes())
+        self.index[key] = {"start": start, "count": len(frames), "stamp": stamp}
+        self._memmap = None
+
+    def save(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"frame_shape": self.frame_shape, "segments": self.index}, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def frames(self, key):
+        if self._memmap is None:
+            path = os.path.join(self.path, FRAMES_FILE)
+            self._memmap = np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, *self.frame_shape) \
+                if os.path.getsize(path) else np.empty((0, *self.frame_shape), dtype=np.uint8)
+        entry = self.index[key]
+        return self._memmap[entry["start"]:entry["start"] + entry["count"]]
+
+
+class ReplayGrouper(lib.MotionGrouper):
+    """A MotionGrouper that records the clips it would save instead of saving them, and deletes nothing."""
+    def __init__(self, **kwargs):
+        super().__init__(clip_dir=None, tmp_dir=None, **kwargs)
+        self.clips = [] # (segments, note)
+
+    def _save(self, segments, additional_note):
+        self.clips.append((list(segments), additional_note))
+        for seg_path in segments:
+            self.scores.pop(seg_path, None)
+
+    def _discard(self, seg_path):
+        self.scores.pop(seg_path, None)
+
+
+_decoder = None
+
+def _init_worker():
+    # every worker would repeat the same startup lines (decode backend, ROI); segment ratios are sampled at DEBUG
+    logging.getLogger().setLevel(logging.WARNING)
+
+def _init_decode_worker():
+    global _decoder
+    _init_worker()
+    _decoder = lib.make_segment_decoder() # only the decode phase needs one; the sweep reads the frame store
+
+def _decode(seg_path):
+    start = time.perf_counter()
+    frames = _decoder.extract(seg_path)
+    return frames, time.perf_counter() - start
+
+
+def fill_store(store, segments, workers):
+    """Decode the segments the store doesn't have yet. Returns each one's decode seconds."""
+    todo = store.missing(segments)
+    latencies = []
+    if not todo:
+        return latencies
+    print(f"decoding {len(todo)} of {len(segments)} segments into {store.path}")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker) as pool:
+        for seg_path, (frames, secs) in zip(todo, pool.map(_decode, todo, chunksize=4)):
+            store.add(seg_path, frames, FrameStore._stamp(seg_path))
+            latencies.append(secs)
+    store.save()
+    return latencies
+
+
+def percentiles(values, scale=1000):
+    """'p50/p95' of values (seconds), in ms by default."""
+    if not len(values):
+        return "-"
+    p50, p95 = np.percentile(values, [50, 95]) * scale
+    return f"{p50:.2f}/{p95:.2f}"
+
+
+def replay(store_path, keys, labels, detector_name, pixel_thresh, change_ratios, flush_ns, roi=None, tile_grid=None):
+    """
+    Run one detector setting over the stored segments in recording order, then group its verdicts for each
+    (change_ratio, flush_n). Ratios don't depend on either, so the detection pass is shared between them.
+    """
+    store = FrameStore(store_path)
+    region = load_region(roi, (lib.LQ_HEIGHT, lib.LQ_WIDTH), tile_grid)
+    detector = make_detector(detector_name, pixel_thresh, region=region)
+
+    all_ratios = []
+    detect_secs = []
+    for key in keys:
+        start = time.perf_counter()
+        frames = store.frames(key)
+        if len(frames) >= 2:
+            ratios = detector.ratios(frames)
+        else:
+            if len(frames): # a stateful detector still learns from the frame
+                detector.ratios(frames)
+            ratios = []
+        detect_secs.append(time.perf_counter() - start)
+        all_ratios.append(ratios)
+
+    rows = []
+    for change_ratio, flush_n in itertools.product(change_ratios, flush_ns):
+        grouper = ReplayGrouper(flush_n=flush_n, change_ratio=change_ratio)
+        verdicts = []
+        group_start = time.perf_counter()
+        for key, ratios in zip(keys, all_ratios):
+            motion = len(ratios) > 0 and bool(motion_from_ratios(ratios, change_ratio))
+            verdicts.append(motion)
+            grouper.add(key, motion, ratios)
+        grouper._save_group() # whatever is still open when the footage ends
+        group_secs = time.perf_counter() - group_start
+
+        in_clips = {seg for segments, _ in grouper.clips for seg in segments}
+        row = {
+            "detector": detector_name, "pixel_thresh": pixel_thresh, "change_ratio": change_ratio, "flush_n": flush_n,
+            "segments": len(keys), "flagged": sum(verdicts),
+            "clips": len(grouper.clips), "partial_clips": sum(note == lib.IN_PROGRESS for _, note in grouper.clips),
+            "clip_secs": len(in_clips) * lib.SEGMENT_SECS,
+            "detect_ms": percentiles(detect_secs), "group_us": 1e6 * group_secs / max(len(keys), 1),
+            "segments_per_sec": len(keys) / max(sum(detect_secs) + group_secs, 1e-9),
+        }
+        labeled = [(motion, labels[i], keys[i] in in_clips) for i, motion in enumerate(verdicts) if labels[i] is not None]
+        if labeled:
+            tp = sum(motion and label for motion, label, _ in labeled)
+            fp = sum(motion and not label for motion, label, _ in labeled)
+            fn = sum(label and not motion for motion, label, _ in labeled)
+            precision = tp / (tp + fp) if tp + fp else 1.0
+            recall = tp / (tp + fn) if tp + fn else 1.0
+            moving = [clipped for _, label, clipped in labeled if label]
+            row.update(precision=precision, recall=recall,
+                       f1=2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+                       # labeled motion that still ends up in a clip, e.g. as another segment's pre/post-roll
+                       clip_recall=sum(moving) / len(moving) if moving else 1.0)
+        rows.append(row)
+    return rows
+
+
+def print_rows(rows, top):
+    labeled = "f1" in rows[0]
+    if labeled:
+        rows = sorted(rows, key=lambda r: (-r["f1"], -r["clip_recall"], r["clip_secs"]))
+    header = f"{'detector':>10} {'pixel':>5} {'ratio':>7} {'flush':>5} {'flagged':>7} {'clips':>5} {'partial':>7} {'clip min':>8}"
+    header += f" {'detect ms p50/p95':>17} {'group us':>8} {'seg/s':>7}"
+    if labeled:
+        header += f" {'prec':>5} {'recall':>6} {'f1':>5} {'in clip':>7}"
+    print(header)
+    for r in rows[:top] if top else rows:
+        line = (f"{r['detector']:>10} {r['pixel_thresh']:>5} {r['change_ratio']:>7.4f} {r['flush_n']:>5} {r['flagged']:>7} "
+                f"{r['clips']:>5} {r['partial_clips']:>7} {r['clip_secs'] / 60:>8.1f} {r['detect_ms']:>17} "
+                f"{r['group_us']:>8.1f} {r['segments_per_sec']:>7.0f}")
+        if labeled:
+            line += f" {r['precision']:>5.2f} {r['recall']:>6.2f} {r['f1']:>5.2f} {r['clip_recall']:>7.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help=".h264 segments or directories of them, in recording order")
+    parser.add_argument("--labels", help='JSON file of {"segment_000123.h264": true/false} (has motion)')
+    parser.add_argument("--synthetic", type=int, default=0, help="use N labeled segments of a fake scene instead")
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N segments")
+    parser.add_argument("--store", help="frame store directory (default: a temporary one, decoded every run)")
+    parser.add_argument("--rebuild", action="store_true", help="empty the frame store and decode everything again")
+    parser.add_argument("--detectors", nargs="+", default=[lib.DETECTOR], choices=sorted(DETECTORS))
+    parser.add_argument("--pixel-thresh", type=int, nargs="+", default=[lib.PIXEL_THRESHOLD])
+    parser.add_argument("--change-ratio", type=float, nargs="+", default=[lib.CHANGE_RATIO])
+    parser.add_argument("--flush-n", type=int, nargs="+", default=[lib.FLUSH_N_CLIPS])
+    parser.add_argument("--roi", help="ROI mask image (white = watch) to score with")
+    parser.add_argument("--tiles", help="score a ROWSxCOLS tile grid, e.g. 3x4, triggering on the busiest tile")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes for decoding and the sweep")
+    parser.add_argument("--top", type=int, default=0, help="only print the best N combinations")
+    parser.add_argument("--json", help="also write every combination's results to this file")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmp = None
+    store_path = args.store
+    if not store_path:
+        tmp = tempfile.TemporaryDirectory()
+        store_path = tmp.name
+    store = FrameStore(store_path, rebuild=args.rebuild or bool(args.synthetic))
+
+    decode_secs = []
+    if args.synthetic:
+        footage = synthetic_footage(args.synthetic)
+        for name, frames, _ in footage:
+            store.add(name, frames)
+        store.save()
+        keys = [name for name, _, _ in footage]
+        labels = [motion for _, _, motion in footage]
+    else:
+        keys = [os.path.abspath(seg) for seg in find_segments(args.paths, args.limit)]
+        if not keys:
+            sys.exit("no .h264 segments found (or pass --synthetic N)")
+        decode_start = time.perf_counter()
+        decode_secs = fill_store(store, keys, args.workers)
+        if decode_secs:
+            wall = time.perf_counter() - decode_start
+            print(f"decode: {len(decode_secs)} segments in {wall:.1f}s ({len(decode_secs) / wall:.1f} segments/s "
+                  f"on {args.workers} workers), ms/segment p50/p95 {percentiles(decode_secs)}")
+        by_name = load_labels(args.labels)
+        labels = [by_name.get(os.path.basename(key)) for key in keys]
+
+    tile_grid = tuple(int(n) for n in args.tiles.split("x")) if args.tiles else None
+    jobs = list(itertools.product(args.detectors, args.pixel_thresh))
+    n_combos = len(jobs) * len(args.change_ratio) * len(args.flush_n)
+    print(f"replaying {len(keys)} segments ({sum(labels[i] is not None for i in range(len(keys)))} labeled) "
+          f"through {n_combos} combinations on {min(args.workers, len(jobs))} workers")
+    sweep_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs)), initializer=_init_worker) as pool:
+        futures = [pool.submit(replay, store_path, keys, labels, detector, pixel_thresh, args.change_ratio,
+                               args.flush_n, args.roi, tile_grid) for detector, pixel_thresh in jobs]
+        rows = [row for future in futures for row in future.result()]
+    wall = time.perf_counter() - sweep_start
+    print(f"sweep: {wall:.1f}s, {n_combos * len(keys) / wall:.0f} segment-combinations/s "
+          f"({len(keys) * lib.SEGMENT_SECS * n_combos / wall:.0f}x real time)")
+    print_rows(rows, args.top)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"decode_ms": [1000 * s for s in decode_secs], "results": rows}, f, indent=1)
+    if tmp:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
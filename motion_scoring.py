@@ -0,0 +1,277 @@
+import os
+import json
+import hashlib
+import logging
+import cv2
+import numpy as np
+
+BLUR_KSIZE = (7, 7)
+MOTION_SIDECAR_SUFFIX = ".motion.json" # segment_000123.h264.motion.json holds ratios scored live at capture time
+BACKGROUND_ALPHA = 0.1 # how fast BackgroundDetector's background follows the scene, per keyframe (every 3s)
+NOISY_RATIO = 0.90 # pairs with more changed pixels than this are treated as lighting glitches, not motion
+LOG_RATIOS_EVERY = 50 # per-segment ratio lists are only logged (at DEBUG) for one segment in this many
+
+_log_counts = {}
+
+
+def sample_log(kind):
+    """Whether to log this one of a per-segment `kind` of debug line, so they cost a line per LOG_RATIOS_EVERY segments."""
+    n = _log_counts.get(kind, 0)
+    _log_counts[kind] = n + 1
+    return n % LOG_RATIOS_EVERY == 0 and logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+class RegionMask:
+    """
+    Which pixels of a camera's frames count toward motion, from a mask image (white = watch, black = ignore)
+    scaled to the frame size, optionally split into a rows x cols grid of tiles.
+
+    Everything is worked out once: frames are cropped to the mask's bounding box (plus the blur's reach) before
+    any work is done on them, and changed pixels are gathered through a precomputed index of the watched
+    pixels in that crop, so ignored pixels outside the box are never blurred or diffed and inside it never counted.
+    With tiles, a pair's ratio is that of its busiest tile, so motion confined to one part of the frame
+    isn't diluted by the rest of it (CHANGE_RATIO then means "this much of any one tile").
+    """
+    def __init__(self, mask, tile_grid=None, margin=BLUR_KSIZE[0] // 2):
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            raise ValueError("ROI mask doesn't include any pixels")
+        self.shape = mask.shape
+        ys, xs = np.nonzero(mask)
+        self.y0, self.y1 = max(ys.min() - margin, 0), min(ys.max() + 1 + margin, mask.shape[0])
+        self.x0, self.x1 = max(xs.min() - margin, 0), min(xs.max() + 1 + margin, mask.shape[1])
+        cropped = mask[self.y0:self.y1, self.x0:self.x1]
+        index = np.flatnonzero(cropped)
+        self.tile_starts = None
+        if tile_grid:
+            rows, cols = tile_grid
+            crop_ys, crop_xs = np.unravel_index(index, cropped.shape)
+            tiles = ((crop_ys + self.y0) * rows // mask.shape[0]) * cols + (crop_xs + self.x0) * cols // mask.shape[1]
+            order = np.argsort(tiles, kind="stable") # group each tile's pixels together for reduceat
+            index, tiles = index[order], tiles[order]
+            self.tile_starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]])
+            self.tile_sizes = np.diff(np.r_[self.tile_starts, len(index)])
+        self.index = index
+        self.digest = hashlib.sha1(mask.tobytes() + repr(tile_grid).encode()).hexdigest()[:8]
+
+    @classmethod
+    def from_file(cls, path, shape, tile_grid=None):
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Couldn't read ROI mask {path}")
+        height, width = shape
+        return cls(cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA) > 127, tile_grid)
+
+    def crop(self, frames):
+        """(..., H, W) frames cropped to the mask's bounding box, as a view."""
+        return frames[..., self.y0:self.y1, self.x0:self.x1]
+
+    def watched(self, values):
+        """(N, crop H, crop W) per-pixel values of cropped frames -> (N, watched pixels), in tile order."""
+        return values.reshape(len(values), -1)[:, self.index]
+
+    def ratios(self, changed):
+        """(N, crop H, crop W) bool changed pixels -> N ratios (of the busiest tile, with tiles)."""
+        watched = self.watched(changed)
+        if self.tile_starts is None:
+            return np.count_nonzero(watched, axis=1) / watched.shape[1]
+        counts = np.add.reduceat(watched, self.tile_starts, axis=1, dtype=np.int32)
+        return (counts / self.tile_sizes).max(axis=1)
+
+
+def load_region(path, shape, tile_grid=None):
+    """The RegionMask in the mask image at path, or a plain tile grid (or None) if there's no file there."""
+    if path and os.path.exists(path):
+        region = RegionMask.from_file(path, shape, tile_grid)
+        logging.info(f"Scoring motion in the {len(region.index)} pixels of {path}" + (f" in {tile_grid} tiles" if tile_grid else ""))
+        return region
+    if tile_grid:
+        return RegionMask(np.ones(shape, dtype=bool), tile_grid)
+    return None
+
+
+class MotionScorer:
+    """
+    Scores every consecutive pair of a segment's frames at once instead of looping per pair in python.
+    The (N, H, W) frames are blurred as one N-channel image and diffed with one absdiff over the whole stack.
+    Working buffers are kept between calls and only reallocated when the frame count/size changes.
+    With a RegionMask, only its cropped region is blurred and diffed, and only its pixels are counted.
+    """
+    def __init__(self, ksize=BLUR_KSIZE, region=None):
+        self.ksize = ksize
+        self.region = region
+        self._shape = None
+
+    def _buffers(self, shape):
+        if shape != self._shape:
+            n, h, w = shape
+            self._hwn = np.empty((h, w, n), dtype=np.uint8)
+            self._blurred_hwn = np.empty((h, w, n), dtype=np.uint8)
+            self._blurred = np.empty((n, h, w), dtype=np.uint8)
+            self._diff = np.empty((n - 1, h, w), dtype=np.uint8)
+            self._mask = np.empty((n - 1, h, w), dtype=bool)
+            self._shape = shape
+
+    def score(self, frames, pixel_thresh):
+        """
+        frames: (N, H, W) uint8 array (or list of equally sized 2D frames).
+        Returns a float array of N-1 ratios: the fraction of pixels that changed by more than pixel_thresh
+        between each frame and the next.
+        """
+        frames = np.asarray(frames, dtype=np.uint8)
+        n = len(frames)
+        if n < 2:
+            return np.empty(0)
+        if self.region is not None:
+            frames = self.region.crop(frames)
+        self._buffers(frames.shape)
+
+        # frames as channels, so one GaussianBlur call blurs each frame independently
+        np.copyto(self._hwn, frames.transpose(1, 2, 0))
+        cv2.GaussianBlur(self._hwn, self.ksize, 0, dst=self._blurred_hwn)
+        np.copyto(self._blurred, self._blurred_hwn.transpose(2, 0, 1))
+
+        cv2.absdiff(self._blurred[1:], self._blurred[:-1], dst=self._diff)
+        np.greater(self._diff, pixel_thresh, out=self._mask)
+        if self.region is not None:
+            return self.region.ratios(self._mask)
+        changed = np.count_nonzero(self._mask.reshape(n - 1, -1), axis=1)
+        return changed / self._mask[0].size
+
+
+class FrameDiffDetector:
+    """Compares each keyframe with the previous one (the original detector). Keeps no state between segments."""
+    stateful = False
+
+    def __init__(self, pixel_thresh, ksize=BLUR_KSIZE, region=None):
+        self.pixel_thresh = pixel_thresh
+        self.scorer = MotionScorer(ksize, region)
+
+    def ratios(self, frames):
+        return self.scorer.score(frames, self.pixel_thresh)
+
+    def reset(self):
+        pass
+
+
+class BackgroundDetector:
+    """
+    Compares each keyframe with a running-average background instead of the previous keyframe, so slow changes
+    (shadows, dusk, swaying noise) get absorbed into the background rather than flagged. The frame's median
+    difference from the background is subtracted first, so a global brightness jump (a cloud, auto-exposure)
+    doesn't count as motion either. The background carries over between segments, so segments have to be
+    scored in recording order. It's one float32 frame (56 KB at 160x90): numpy's float16 math is emulated and
+    ~30x slower, which costs more on a Pi than the 28 KB it would save.
+
+    Like FrameDiffDetector, N frames give N-1 ratios: the first frame only updates the background.
+    """
+    stateful = True
+
+    def __init__(self, pixel_thresh, alpha=BACKGROUND_ALPHA, ksize=BLUR_KSIZE, region=None):
+        self.pixel_thresh = pixel_thresh
+        self.alpha = alpha
+        self.ksize = ksize
+        self.region = region
+        self.background = None
+        self._shape = None
+
+    def _buffers(self, shape):
+        if shape != self._shape:
+            self._blurred = np.empty(shape, dtype=np.uint8)
+            self._diff = np.empty(shape, dtype=np.float32)
+            self._changed = np.empty(shape, dtype=np.uint8)
+            self._still = np.empty(shape, dtype=np.uint8)
+            self._shape = shape
+
+    def ratios(self, frames):
+        frames = np.asarray(frames, dtype=np.uint8)
+        ratios = np.zeros(max(len(frames) - 1, 0))
+        if self.region is not None:
+            frames = np.ascontiguousarray(self.region.crop(frames))
+        for i, frame in enumerate(frames):
+            self._buffers(frame.shape)
+            cv2.GaussianBlur(frame, self.ksize, 0, dst=self._blurred)
+            if self.background is None or self.background.shape != frame.shape:
+                self.background = self._blurred.astype(np.float32)
+                continue
+            np.subtract(self._blurred, self.background, out=self._diff)
+            watched = self._diff if self.region is None else self.region.watched(self._diff[None])
+            self._diff -= np.median(watched) # global lighting shift
+            np.abs(self._diff, out=self._diff)
+            np.greater(self._diff, self.pixel_thresh, out=self._changed.view(bool))
+            if i and self.region is not None:
+                ratios[i - 1] = self.region.ratios(self._changed.view(bool)[None])[0]
+            elif i:
+                ratios[i - 1] = np.count_nonzero(self._changed) / self._changed.size
+            # still pixels follow the scene at alpha, changed ones a quarter as fast, so a lasting change settles in
+            np.subtract(1, self._changed, out=self._still)
+            cv2.accumulateWeighted(self._blurred, self.background, self.alpha, mask=self._still)
+            cv2.accumulateWeighted(self._blurred, self.background, self.alpha / 4, mask=self._changed)
+        return ratios
+
+    def reset(self):
+        self.background = None
+
+
+DETECTORS = {"diff": FrameDiffDetector, "background": BackgroundDetector}
+
+
+def make_detector(name, pixel_thresh, region=None):
+    """A detector by name (see DETECTORS); each has ratios(frames) -> per-pair ratios, and reset()."""
+    try:
+        return DETECTORS[name](pixel_thresh, region=region)
+    except KeyError:
+        raise ValueError(f"Unknown motion detector {name!r}, expected one of {sorted(DETECTORS)}")
+
+
+def motion_from_ratios(ratios, change_ratio):
+    """Motion verdict for a segment from its per-pair ratios (see MotionScorer.score)."""
+    ratios = [ratio for ratio in ratios if ratio < NOISY_RATIO] # Remove noisy light issues?
+    if len(ratios) == 0:
+        return True # todo: this isn't the best way to handle all of this, but this handles the edge case if all of the ratios are extremely large.
+    avg_ratio = np.mean(ratios)
+    if sample_log("cleaned ratios"):
+        logging.debug(f"cleaned ratios: {[f'{ratio:0.3f}' for ratio in ratios]}, motion pixel ratio: {avg_ratio:.6f}")
+    return avg_ratio > change_ratio
+
+
+def motion_intervals(ratios, change_ratio, duration, keyframe_secs=None):
+    """
+    (start, end) seconds within a segment of `duration` where consecutive samples changed by more than change_ratio.
+    The N+1 samples behind N ratios are keyframes keyframe_secs apart from the start of the segment (the last
+    interval can be shorter, cut off by the segment's end), or evenly spread over it if that isn't given.
+    """
+    step = keyframe_secs or duration / (len(ratios) + 1)
+    intervals = []
+    for i, ratio in enumerate(ratios):
+        if not change_ratio < ratio < NOISY_RATIO:
+            continue
+        start, end = min(i * step, duration), min((i + 1) * step, duration)
+        if intervals and intervals[-1][1] == start:
+            intervals[-1][1] = end
+        else:
+            intervals.append([start, end])
+    return [tuple(interval) for interval in intervals]
+
+
+def write_motion_sidecar(segment_path, ratios, pixel_thresh):
+    """Written just before the segment is closed, so it's there by the time the post-processor picks the segment up."""
+    sidecar_path = segment_path + MOTION_SIDECAR_SUFFIX
+    with open(sidecar_path + ".tmp", "w") as f:
+        json.dump({"pixel_thresh": pixel_thresh, "ratios": ratios}, f)
+    os.replace(sidecar_path + ".tmp", sidecar_path)
+
+
+def read_motion_sidecar(segment_path, pixel_thresh):
+    """The segment's live ratios, or None if it has no sidecar or was scored with a different pixel_thresh."""
+    try:
+        with open(segment_path + MOTION_SIDECAR_SUFFIX) as f:
+            sidecar = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logging.warning(f"Unreadable motion sidecar for {segment_path}: {e}")
+        return None
+    if sidecar.get("pixel_thresh") != pixel_thresh:
+        return None
+    return sidecar["ratios"]
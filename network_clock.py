@@ -0,0 +1,80 @@
+import time
+import logging
+import threading
+import email.utils
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import requests
+
+SYNC_URL = "https://www.google.com"
+SYNC_INTERVAL_SECS = 6 * 60 * 60
+RETRY_INTERVAL_SECS = 60 # after a failed sync
+SYNC_TIMEOUT_SECS = 3
+TIMEZONE = "America/Denver"
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class NetworkClock:
+    """
+    Wall-clock time from the HTTP Date header of an occasional HEAD request (the Pi has no RTC and may
+    not have NTP), cached as an offset from time.monotonic() so reading it never touches the network.
+    Syncs in a background thread once started. Until the first sync succeeds it falls back to the
+    system clock, so there's always a timestamp.
+    """
+    def __init__(self, url=SYNC_URL, sync_interval=SYNC_INTERVAL_SECS, timezone=TIMEZONE):
+        self.url = url
+        self.sync_interval = sync_interval
+        self.timezone = ZoneInfo(timezone)
+        self.offset = None # network time - monotonic time
+        self.thread = None
+
+    def sync(self):
+        """One sync attempt. Returns whether it worked."""
+        try:
+            sent = time.monotonic()
+            resp = requests.head(self.url, timeout=SYNC_TIMEOUT_SECS)
+            received = time.monotonic()
+            resp.raise_for_status()
+            date_header = resp.headers.get("Date")
+            if not date_header:
+                raise ValueError("no Date header")
+            network_time = email.utils.parsedate_to_datetime(date_header).timestamp()
+            # the header has 1s resolution, so it was (on average) stamped half a second before it says
+            self.offset = network_time + 0.5 - (sent + received) / 2
+            logging.debug(f"Network clock synced, system clock is off by {self.system_clock_error():.1f}s")
+            return True
+        except Exception as e:
+            logging.warning(f"Network clock sync failed ({e}), {'keeping the last offset' if self.synced else 'using the system clock'}")
+            return False
+
+    def _sync_forever(self):
+        while True:
+            time.sleep(self.sync_interval if self.sync() else RETRY_INTERVAL_SECS)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._sync_forever, name="network-clock", daemon=True)
+            self.thread.start()
+
+    @property
+    def synced(self):
+        return self.offset is not None
+
+    def now(self):
+        """Current epoch seconds, network-corrected if synced."""
+        if self.offset is None:
+            return time.time()
+        return time.monotonic() + self.offset
+
+    def system_clock_error(self):
+        """How far the network time is ahead of the system clock, in seconds."""
+        return self.now() - time.time()
+
+    def from_system_time(self, system_epoch):
+        """Network-corrected version of a system-clock time, e.g. a file's mtime."""
+        return system_epoch + self.system_clock_error()
+
+    def timestamp(self, epoch=None):
+        """epoch (default now) formatted like 20251023-101552 in the local timezone."""
+        epoch = self.now() if epoch is None else epoch
+        return datetime.fromtimestamp(epoch, tz=self.timezone).strftime(TIMESTAMP_FORMAT)
@@ -0,0 +1,242 @@
+import os
+import re
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+from functools import lru_cache
+from concurrent.futures import Future
+import numpy as np
+
+DECODE_TIMEOUT = 15 # seconds to wait for a segment's frames before restarting ffmpeg
+DEMOTE_AFTER_FAILURES = 3 # a hardware backend failing this many segments in a row is swapped for software
+
+# keyframe decode backends, in the order "auto" tries them. "stub" (no ffmpeg, blank frames) is only ever picked by name
+DECODE_BACKENDS = ("v4l2m2m", "vaapi", "software", "stub")
+V4L2_DECODER_DEVICE = "/dev/video10" # the Pi's bcm2835-codec H.264 decoder
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# h264 access unit delimiter, written after each segment so ffmpeg's parser knows the last frame is complete
+_AUD = b"\x00\x00\x00\x01\x09\xf0"
+# start code + IDR slice NAL header (any nonzero nal_ref_idc)
+_IDR_NAL = re.compile(rb"\x00\x00\x01[\x25\x45\x65]")
+_SPS_NAL = re.compile(rb"\x00\x00\x01[\x27\x47\x67]")
+SPS_SEARCH_BYTES = 1024 # how far before an IDR to look for its SPS/PPS
+
+
+@lru_cache(maxsize=None)
+def _ffmpeg_lists(flag):
+    """Output of e.g. `ffmpeg -decoders`, or "" without a working ffmpeg."""
+    try:
+        return subprocess.run(["ffmpeg", "-hide_banner", flag], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def backend_available(backend):
+    if backend == "stub":
+        return True
+    if backend == "software":
+        return shutil.which("ffmpeg") is not None
+    if backend == "v4l2m2m":
+        return os.path.exists(V4L2_DECODER_DEVICE) and "h264_v4l2m2m" in _ffmpeg_lists("-decoders")
+    if backend == "vaapi":
+        return os.path.exists(VAAPI_DEVICE) and "vaapi" in _ffmpeg_lists("-hwaccels").split()
+    raise ValueError(f"Unknown decode backend {backend!r}, expected auto or one of {', '.join(DECODE_BACKENDS)}")
+
+
+def choose_backend(preference="auto"):
+    """The decode backend to use: preference if it's available here, else the first available of DECODE_BACKENDS."""
+    if preference != "auto":
+        if backend_available(preference):
+            return preference
+        logging.warning(f"Decode backend {preference} isn't available here, falling back to software")
+        return "software"
+    for backend in DECODE_BACKENDS[:-1]:
+        if backend_available(backend):
+            logging.info(f"Using the {backend} keyframe decode backend")
+            return backend
+    return "software"
+
+
+def decode_args(backend, width, height):
+    """
+    ffmpeg (input options, filter graph) to decode just the keyframes of an h264 stream to width x height gray.
+    The hardware decoders hand frames back in their own memory/format, so they're scaled down before the copy out.
+    """
+    to_gray = f"scale={width}:{height},format=gray"
+    if backend == "v4l2m2m":
+        # the m2m wrapper ignores -skip_frame: the decoder block decodes every frame and the filter drops all but keyframes
+        return ["-c:v", "h264_v4l2m2m"], f"select='eq(pict_type,I)',{to_gray}"
+    if backend == "vaapi":
+        return (["-hwaccel", "vaapi", "-hwaccel_device", VAAPI_DEVICE, "-hwaccel_output_format", "vaapi",
+                 "-skip_frame", "nokey"],
+                f"scale_vaapi=w={width}:h={height}:format=nv12,hwdownload,format=nv12,format=gray")
+    if backend == "software":
+        return ["-skip_frame", "nokey"], to_gray # efficiently extract just the keyframes
+    raise ValueError(f"The {backend} backend doesn't use ffmpeg")
+
+
+def keyframe_offsets(data):
+    """Byte offsets of the IDR slices in an Annex B h264 stream that start a new picture."""
+    offsets = []
+    for match in _IDR_NAL.finditer(data):
+        end = match.end()
+        # first_mb_in_slice is the first ue(v) of the slice header, a leading 1 bit means it's 0
+        if end < len(data) and data[end] & 0x80:
+            offsets.append(match.start())
+    return offsets
+
+
+def keyframe_cut_offsets(data):
+    """
+    Byte offsets a stream can be cut at to start on each keyframe: the SPS in front of the IDR when it has one
+    (rpicam-vid --inline repeats SPS/PPS before every IDR), so each piece decodes on its own.
+    """
+    cuts = []
+    previous = 0
+    for offset in keyframe_offsets(data):
+        sps = None
+        for sps in _SPS_NAL.finditer(data, max(previous, offset - SPS_SEARCH_BYTES), offset):
+            pass
+        cut = sps.start() if sps else offset
+        if cut > 0 and data[cut - 1] == 0: # 4-byte start code
+            cut -= 1
+        cuts.append(cut)
+        previous = offset
+    return cuts
+
+
+class SegmentDecoder:
+    """
+    A long-lived ffmpeg that keyframe-decodes .h264 segments fed through its stdin, so there is no
+    process startup or codec init per segment. Segments go through a queue and are decoded one at a time.
+    If ffmpeg dies or stalls it's restarted, and that segment is decoded with `fallback` instead.
+    backend is one of DECODE_BACKENDS (see choose_backend); a hardware one that keeps failing is swapped
+    for software. The stub backend runs no ffmpeg and gives blank frames, one per keyframe, for CI.
+    """
+    def __init__(self, width, height, fallback=None, timeout=DECODE_TIMEOUT, backend="software"):
+        self.width = width
+        self.height = height
+        self.frame_bytes = width * height
+        self.fallback = fallback
+        self.timeout = timeout
+        self.backend = backend
+        self.failures = 0 # in a row
+        self.process = None
+        self.frames = None
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self._run_jobs, name="segment-decoder", daemon=True)
+        self.worker.start()
+
+    def _cmd(self):
+        input_args, vf_filter = decode_args(self.backend, self.width, self.height)
+        return [
+            "ffmpeg", "-hide_banner",
+            "-loglevel", "warning",
+            "-threads", "1", # frame threading would hold frames back until more input arrives
+            "-flags", "low_delay",
+            *input_args,
+            "-probesize", "32768",
+            "-analyzeduration", "0",
+            "-f", "h264",
+            "-i", "pipe:0",
+            "-vf", vf_filter,
+            "-fps_mode", "passthrough",
+            "-f", "rawvideo",
+            "-pix_fmt", "gray",
+            "-flush_packets", "1",
+            "pipe:1"
+        ]
+
+    def _start(self):
+        self.process = subprocess.Popen(self._cmd(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.frames = queue.Queue()
+        threading.Thread(target=self._read_frames, args=(self.process, self.frames),
+                         name="segment-decoder-reader", daemon=True).start()
+        logging.info(f"Started persistent ffmpeg decoder with PID {self.process.pid}")
+
+    def _stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait()
+        except Exception as e:
+            logging.warning(f"Error stopping ffmpeg decoder: {e}")
+        self.process = None
+
+    def _read_frames(self, process, frames):
+        """Reader thread: split ffmpeg's stdout into frames. Needed so ffmpeg never blocks on a full pipe."""
+        while True:
+            data = process.stdout.read(self.frame_bytes)
+            if len(data) < self.frame_bytes:
+                frames.put(None) # ffmpeg exited
+                return
+            frames.put(np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width))
+
+    def _decode(self, seg_path):
+        with open(seg_path, "rb") as f:
+            data = f.read()
+        n_keyframes = len(keyframe_offsets(data))
+        if self.backend == "stub":
+            return np.zeros((n_keyframes, self.height, self.width), dtype=np.uint8)
+
+        if self.process is None or self.process.poll() is not None:
+            if self.process is not None:
+                logging.warning(f"ffmpeg decoder exited with {self.process.returncode}, restarting it")
+            self._start()
+
+        while not self.frames.empty(): # anything left over from the last segment would shift this one's frames
+            if self.frames.get_nowait() is not None:
+                logging.warning(f"Discarding a stray decoded frame before {seg_path}")
+
+        self.process.stdin.write(data + _AUD)
+        self.process.stdin.flush()
+
+        frames = np.empty((n_keyframes, self.height, self.width), dtype=np.uint8)
+        for i in range(n_keyframes):
+            frame = self.frames.get(timeout=self.timeout)
+            if frame is None:
+                raise RuntimeError("ffmpeg decoder exited mid-segment")
+            frames[i] = frame
+        return frames
+
+    def _run_jobs(self):
+        while True:
+            seg_path, future = self.jobs.get()
+            if seg_path is None:
+                self._stop()
+                return
+            try:
+                future.set_result(self._decode(seg_path))
+                self.failures = 0
+            except Exception as e:
+                logging.warning(f"Persistent decode failed for {seg_path} ({e!r}), restarting decoder")
+                self._stop()
+                self.failures += 1
+                if self.backend not in ("software", "stub") and self.failures >= DEMOTE_AFTER_FAILURES:
+                    logging.warning(f"The {self.backend} decode backend failed {self.failures} segments in a row, "
+                                    f"switching to software")
+                    self.backend = "software"
+                if self.fallback is None:
+                    future.set_exception(e)
+                    continue
+                try:
+                    future.set_result(self.fallback(seg_path))
+                except Exception as fallback_error:
+                    future.set_exception(fallback_error)
+
+    def submit(self, seg_path):
+        """Queue a segment for decoding. Returns a Future of its (N, height, width) uint8 keyframes."""
+        future = Future()
+        self.jobs.put((seg_path, future))
+        return future
+
+    def extract(self, seg_path):
+        return self.submit(seg_path).result()
+
+    def close(self):
+        self.jobs.put((None, None))
+        self.worker.join()
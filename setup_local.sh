@@ -11,7 +11,7 @@ mkdir -p -m 755 "$VIDEOS_DIR/buffer" "$VIDEOS_DIR/clips"
 sudo chown -R piuser:piuser $VIDEOS_DIR
 
 echo "Installing ffmpeg and python libraries..."
-sudo apt install -y ffmpeg python3-opencv python3-numpy python3-dotenv
+sudo apt install -y ffmpeg python3-opencv python3-numpy python3-dotenv python3-picamera2
 
 echo "Stopping/disabling old services via shutdown_services.sh"
 sudo ./shutdown_services.sh